@@ -21,6 +21,7 @@ class App extends Component {
   render() {
     const query = new URLSearchParams(window.location.search);
     const token = query.get('token');
+    const arena = query.get('arena');
 
     const { classes } = this.props;
 
@@ -47,10 +48,10 @@ class App extends Component {
 
           <Switch>
             <Route exact path="/">
-              <Core token={token} />
+              <Core token={token} arena={arena} />
             </Route>
             <Route exact path="/events">
-              <Events token={token} />
+              <Events token={token} arena={arena} />
             </Route>
           </Switch>
         </div>
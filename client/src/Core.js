@@ -29,15 +29,19 @@ class Core extends Component {
       socket: null,
       core_state: [],
       thread_states: {},
-      thread_locs: {}
+      thread_locs: {},
+      // player colors by player id, thread updates only carry the player id
+      palette: {}
     }
   }
 
   componentDidMount() {
-    const { token } = this.props;
+    const { token, arena } = this.props;
 
     const socket = io(':5000', {
-      query: `token=${token}`,
+      // the core and thread events come as packed little endian arrays, see
+      // server/protocol.py
+      query: `token=${token}&protocol=binary` + (arena ? `&arena=${encodeURIComponent(arena)}` : ''),
     });
 
     socket.on('connect', () => {
@@ -48,30 +52,34 @@ class Core extends Component {
       console.log('Disconnected');
     });
 
-    socket.on('update_thread', thread_updates => {
-      const new_thread_states = thread_updates.reduce((prev, curr) => {
-        const [id, pc, color] = curr
-
-        prev[id] = [pc, color]
-
-        return prev
-      }, {})
-      const new_thread_locs = thread_updates.reduce((prev, curr) => {
-        const [id, pc] = curr
-
-        prev[pc] = id
+    socket.on('palette', players => {
+      const palette = {};
+      players.forEach(([id, color]) => { palette[id] = color; });
+      this.setState({ palette: palette });
+    });
 
-        return prev
-      }, {})
+    socket.on('update_thread', data => {
+      // u32 count, then count u32 thread ids, u32 pcs and u16 player ids
+      const count = new Uint32Array(data, 0, 1)[0];
+      const ids = new Uint32Array(data, 4, count);
+      const pcs = new Uint32Array(data, 4 + 4 * count, count);
+      const owners = new Uint16Array(data, 4 + 8 * count, count);
+      const { palette } = this.state;
+      const new_thread_states = {};
+      const new_thread_locs = {};
+      for (let i = 0; i < count; i++) {
+        new_thread_states[ids[i]] = [pcs[i], palette[owners[i]]];
+        new_thread_locs[pcs[i]] = ids[i];
+      }
 
       this.setState({ thread_states: new_thread_states, thread_locs: new_thread_locs })
     });
 
-    socket.on('kill_thread', thread_ids => {
-      thread_ids.forEach(thread_id => {
+    socket.on('kill_thread', data => {
+      new Uint32Array(data).forEach(thread_id => {
         const { thread_states, thread_locs } = this.state;
         this.setState({
-          thread_states: Object.keys(thread_states).filter(key => key !== thread_id).reduce((states, tid) => {
+          thread_states: Object.keys(thread_states).filter(key => key !== String(thread_id)).reduce((states, tid) => {
             states[tid] = thread_states[tid];
             return states;
           }, {}),
@@ -84,18 +92,27 @@ class Core extends Component {
       })
     });
 
-    socket.on('core_connection', core => {
-      var colified_core = core.map(byte => {
+    socket.on('core_connection', data => {
+      var colified_core = Array.from(new Uint8Array(data), byte => {
         return "#" + (255 - byte).toString(16).repeat(3);
       });
       this.setState({ core_state: colified_core });
     });
 
-    socket.on('core_state', updates => {
+    socket.on('core_state', data => {
+      // u32 count, then count u32 starts and u32 lengths, then the bytes
       var core = [...this.state.core_state];
-      updates.forEach(update => {
-        core[update[0]] = "#" + (255 - update[1]).toString(16).repeat(3);
-      });
+      const count = new Uint32Array(data, 0, 1)[0];
+      const starts = new Uint32Array(data, 4, count);
+      const lengths = new Uint32Array(data, 4 + 4 * count, count);
+      const bytes = new Uint8Array(data, 4 + 8 * count);
+      let offset = 0;
+      for (let i = 0; i < count; i++) {
+        for (let j = 0; j < lengths[i]; j++) {
+          core[starts[i] + j] = "#" + (255 - bytes[offset + j]).toString(16).repeat(3);
+        }
+        offset += lengths[i];
+      }
 
       this.setState({ core_state: core });
     });
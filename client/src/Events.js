@@ -33,23 +33,38 @@ class Events extends Component {
     this.state = {
       socket: null,
       events: [],
-      scores: []
+      // score rows by player id, [id, name, score, rank, color]
+      scores: {},
+      tick: 0
     };
   }
 
   componentDidMount(){
-    const { token } = this.props;
+    const { token, arena } = this.props;
 
     const socket = io(':5000', {
-      query: `token=${token}`,
+      query: `token=${token}&protocol=binary` + (arena ? `&arena=${encodeURIComponent(arena)}` : ''),
     });
 
     socket.on('connect', () => {
       console.log("Connected to events!");
     });
 
-    socket.on('player_scores', new_scores => {
-      this.setState({ scores: new_scores });
+    // the whole scoreboard on connect, then only the rows that changed
+    socket.on('player_scores', rows => {
+      var scores = {};
+      rows.forEach(row => { scores[row[0]] = row; });
+      this.setState({ scores: scores });
+    });
+
+    socket.on('score_updates', rows => {
+      var scores = Object.assign({}, this.state.scores);
+      rows.forEach(row => { scores[row[0]] = row; });
+      this.setState({ scores: scores });
+    });
+
+    socket.on('tick', tick => {
+      this.setState({ tick: tick });
     });
     
     socket.on('events', new_events => {
@@ -72,15 +87,19 @@ class Events extends Component {
   render() {
     const { classes } = this.props;
     const { events } = this.state;
-    const { scores } = this.state;
+    const { scores, tick } = this.state;
+    // the grid is laid out bottom up, so the highest score goes last
+    const rows = Object.values(scores).sort((a, b) => a[2] - b[2]);
 
     return (
       <div>
         <div className={classes.scores_grid}>
-          {scores.map((score, idx) =>
-            <div key={idx} className="scores_box" style={{backgroundColor: score[1]}}> {score[0]}
+          {rows.map(row =>
+            <div key={row[0]} className="scores_box" style={{backgroundColor: row[4]}}> {row[1]} ({row[0]}): {row[2]}
             </div>  
           )}
+          <div className="scores_box" style={{backgroundColor: "#FFFFFF"}}> Current tick count: {tick}
+          </div>
         </div>
         <div className={classes.events_grid}>
           {events.map((event, idx) =>
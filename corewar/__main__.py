@@ -0,0 +1,41 @@
+# coding: utf-8
+
+import argparse, sys
+
+from .tournament import load_bot, run_tournament, write_scoreboard
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m corewar', description='Yeetwar command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    tournament = commands.add_parser('tournament', help='play bot files against each other headlessly')
+    tournament.add_argument('bots', nargs='+', help='yeetcode bot files')
+    tournament.add_argument('--mode', choices=['round-robin', 'swiss'], default='round-robin')
+    tournament.add_argument('--rounds', type=int, help='swiss rounds, defaults to log2 of the number of bots')
+    tournament.add_argument('--games', type=int, default=1, help='games per pairing in a round robin')
+    tournament.add_argument('--seed', type=int, default=0)
+    tournament.add_argument('--core-size', type=int, default=8192)
+    tournament.add_argument('--ticks', type=int, default=1000, help='ticks per match')
+    tournament.add_argument('--max-processes', type=int, default=10, help='threads per bot')
+    tournament.add_argument('--score', choices=['steps', 'territory'], default='steps',
+                            help='what decides a match, the steps taken or the bytes owned at the end')
+    tournament.add_argument('--workers', type=int, help='worker processes, 0 plays in this process')
+    tournament.add_argument('--format', choices=['json', 'csv'], default='json')
+    tournament.add_argument('--output', help='file to write the scoreboard to instead of stdout')
+    args = parser.parse_args(argv)
+
+    bots = [load_bot(path) for path in args.bots]
+    results = run_tournament(bots, mode=args.mode, rounds=args.rounds, games=args.games, seed=args.seed,
+                             core_size=args.core_size, ticks=args.ticks, max_processes=args.max_processes,
+                             workers=args.workers, score=args.score)
+    if args.output:
+        with open(args.output, 'w', newline='') as w:
+            write_scoreboard(results, w, args.format)
+    else:
+        write_scoreboard(results, sys.stdout, args.format)
+    stats = results['stats']
+    print("%d matches, %d steps in %.2fs (%.0f steps/s)" % (stats['matches'], stats['steps'], stats['elapsed'],
+          stats['steps_per_second']), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
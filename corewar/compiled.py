@@ -0,0 +1,238 @@
+# coding: utf-8
+
+from collections import OrderedDict
+from struct import Struct
+
+from .mars import MARS, MOV_OPS, DIVIDE_BY_ZERO_MESSAGES, yeetTimeException
+from .yeetcode import *
+
+__all__ = ['CompiledMARS']
+
+# how the mov-like instructions combine their destination with their source
+MOV_OPERATORS = {YOINK: '+', KNIOY: '-', MUL: '*', DIV: '//', FITS: '%'}
+
+REGISTER_NAMES = {XD_REGISTER: 'thread._xd', DX_REGISTER: 'thread._dx'}
+
+class CompiledMARS(MARS):
+    """A MARS that translates yeetcode into generated Python functions instead
+    of interpreting each instruction through the dispatch table.
+
+    A function is generated for each distinct instruction, i.e. for its
+    opcode, addressing modes and operands, so its immediates and registers
+    are baked in while relative operands are taken from the thread's pc.
+    Bots copy the same instructions all over the core, so decodes are kept
+    by machine code and every copy of an instruction shares one decode cache
+    entry: an instruction is decoded and compiled the first time it is seen
+    anywhere, and a miss at any other address is a lookup. A write to any
+    byte of an instruction drops its address's entry like any other.
+    """
+
+    # decodes are kept by machine code, up to this many of the most recently
+    # used ones. Bots that write data all over the core would otherwise grow
+    # them without bound
+    max_compiled_instructions = 65536
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.functions_compiled = 0
+        # decode cache entry by machine code, least recently used first
+        self.compiled_instructions = OrderedDict()
+        core = self.core
+        self.namespace = {
+            'core': core,
+            'read_u8': core.read_u8,
+            'write_u8': core.write_u8,
+            'read_u32': core.read_u32,
+            'write_u32': core.write_u32,
+            'unpack_u32': Struct('>I').unpack_from,
+            'set_owner_range': core.set_owner_range,
+            'owner': core.owner,
+            'yeetTimeException': yeetTimeException,
+        }
+
+    def decode_cache_stats(self):
+        """Returns the decoded instruction cache's counters, how many distinct
+        instructions were decoded and how many of them were compiled"""
+        stats = super().decode_cache_stats()
+        stats['instructions'] = len(self.compiled_instructions)
+        stats['compiled'] = self.functions_compiled
+        return stats
+
+    def decode(self, address):
+        """Returns address's decode cache entry, which is shared with every
+        other address holding the same instruction.
+        """
+        entry = self.decode_cache.get(address)
+        if entry is not None:
+            self.decode_cache_hits += 1
+            return entry
+        self.decode_cache_misses += 1
+        key = bytes(self.core[address : address + INSTRUCTION_WIDTH])
+        compiled = self.compiled_instructions
+        entry = compiled.get(key)
+        if entry is not None:
+            compiled.move_to_end(key)
+        else:
+            if len(compiled) >= self.max_compiled_instructions:
+                compiled.popitem(last=False)
+            instr = Instruction()
+            instr.mcode = key
+            handler = self.compile(key, instr) or self.select_handler(instr)
+            entry = compiled[key] = (handler, instr.a_number, instr.b_number, instr)
+        if self.profile is not None:
+            # profiled handlers count executions by address
+            return self.cache_decoded(address, entry[0], entry[3])
+        self.decode_cache[address] = entry
+        return entry
+
+    def compile(self, key, instr):
+        """Returns the generated function for instr, whose machine code is key,
+        or None if it has to be left to the dispatch table.
+        """
+        source = self.translate(key, instr)
+        if source is None:
+            return None
+        namespace = dict(self.namespace)
+        exec(compile(source, '<%s>' % self.function_name(key), 'exec'), namespace)
+        self.functions_compiled += 1
+        return namespace[self.function_name(key)]
+
+    def function_name(self, key):
+        """Returns the name of the generated function for machine code key."""
+        return 'op_' + key.hex()
+
+    def translate(self, key, instr):
+        """Returns the source of a function that executes instr, whose machine
+        code is key, at the pc of the thread it is called with, or None if
+        instr has to be left to the dispatch table.
+        """
+        opcode, a_mode, b_mode = instr.opcode, instr.a_mode, instr.b_mode
+        a_number, b_number = instr.a_number, instr.b_number
+        if (a_mode == REGISTER_DIRECT or a_mode == REGISTER_INDIRECT) and a_number not in REGISTER_NAMES:
+            return None
+        if (b_mode == REGISTER_DIRECT or b_mode == REGISTER_INDIRECT) and b_number not in REGISTER_NAMES:
+            return None
+
+        if opcode in MOV_OPS:
+            body = self.translate_mov(opcode, a_mode, a_number, b_mode, b_number)
+        elif opcode == BOUNCE:
+            body = ['return %s' % self.target(b_mode, b_number)]
+        elif opcode == BOUNCEZ or opcode == BOUNCEN:
+            body = ['if %s %s 0:' % (self.operand(a_mode, a_number), '==' if opcode == BOUNCEZ else '!='),
+                    '    return %s' % self.target(b_mode, b_number)]
+        elif opcode == BOUNCED:
+            body = ['value = %s - 1' % self.word(a_mode, a_number),
+                    'if value < 0:',
+                    '    value = %d' % (WORD_MAX - 1),
+                    self.store(a_mode, a_number, 'value'),
+                    'if value != 0:',
+                    '    return %s' % self.target(b_mode, b_number)]
+        elif opcode == YEB:
+            body = ['a_value = %s' % self.word(a_mode, a_number),
+                    'b_value = %s' % self.word(b_mode, b_number),
+                    self.store(a_mode, a_number, 'b_value'),
+                    self.store(b_mode, b_number, 'a_value')]
+        elif opcode == NOPE:
+            body = ['pass']
+        else:
+            return None
+        if RELATIVE in (a_mode, b_mode):
+            body.insert(0, 'pc = thread.pc')
+        return 'def %s(thread, a_number, b_number, instr):\n    %s\n' % (self.function_name(key), '\n    '.join(body))
+
+    def translate_mov(self, opcode, a_mode, a_number, b_mode, b_number):
+        """Returns the body of a mov-like instruction's function, see make_mov.
+        """
+        operator = MOV_OPERATORS.get(opcode)
+        zero_check = DIVIDE_BY_ZERO_MESSAGES.get(opcode)
+        body = ['value = %s' % self.operand(a_mode, a_number)]
+        if zero_check and (a_mode != IMMEDIATE or a_number == 0):
+            body += ['if value == 0:',
+                     '    raise yeetTimeException(%r, thread, instr)' % zero_check]
+
+        if b_mode == REGISTER_DIRECT:
+            register = REGISTER_NAMES[b_number]
+            if operator:
+                body.append('%s = (%s %s value) %% %d' % (register, register, operator, WORD_MAX))
+            else:
+                body.append('%s = value %% %d' % (register, WORD_MAX))
+            return body
+
+        size = self.core.size
+        if b_mode == REGISTER_INDIRECT:
+            body.append('address = %s %% %d' % (REGISTER_NAMES[b_number], size))
+        elif b_mode == RELATIVE:
+            body.append('address = (pc + %d) %% %d' % (b_number, size))
+        else:
+            body.append('address = %d' % (b_number % size))
+        if a_mode == IMMEDIATE:
+            # an immediate source makes it a byte wide move, see make_mov
+            if operator:
+                body.append('value = core.bytes[address] %s value' % operator)
+            body.append('write_u8(address, value %% %d)' % BYTE_MAX)
+            width = 1
+        else:
+            if operator:
+                body.append('value = read_u32(address) %s value' % operator)
+            body.append('write_u32(address, value %% %d)' % WORD_MAX)
+            width = WORD_SIZE
+        # only call out to the core when the bytes change hands, which keeps
+        # its territory counts up to date. Words that wrap around the end of
+        # the core always do
+        checks = ['owner[address%s] != thread.owner' % (' + %d' % i if i else '') for i in range(width)]
+        if width > 1:
+            checks.insert(0, 'address > %d' % (size - width))
+        body.append('if %s: set_owner_range(address, %d, thread.owner)' % (' or '.join(checks), width))
+        return body
+
+    def address(self, mode, number):
+        """Returns an expression for the address a relative or immediate
+        operand refers to."""
+        if mode == RELATIVE:
+            return 'pc + %d' % number
+        return str(number % self.core.size)
+
+    def read_at(self, address):
+        """Returns an expression reading the word at an address expression."""
+        if address.isdigit() and int(address) + WORD_SIZE <= self.core.size:
+            return 'unpack_u32(core.bytes, %s)[0]' % address
+        return 'read_u32(%s)' % address
+
+    def operand(self, mode, number):
+        """Returns an expression for the value of an operand, see read_operand
+        in build_dispatch_table."""
+        if mode == IMMEDIATE:
+            return str(number)
+        elif mode == RELATIVE:
+            return self.read_at(self.address(mode, number))
+        elif mode == REGISTER_DIRECT:
+            return REGISTER_NAMES[number]
+        return 'read_u32(%s)' % REGISTER_NAMES[number]
+
+    def word(self, mode, number):
+        """Returns an expression for the word an operand refers to, see
+        read_word in build_dispatch_table."""
+        if mode == IMMEDIATE:
+            return self.read_at(self.address(mode, number))
+        return self.operand(mode, number)
+
+    def store(self, mode, number, value):
+        """Returns a statement storing value into the location an operand
+        refers to, see write_word in build_dispatch_table."""
+        if mode == IMMEDIATE or mode == RELATIVE:
+            return 'write_u32(%s, %s)' % (self.address(mode, number), value)
+        elif mode == REGISTER_DIRECT:
+            return '%s = %s' % (REGISTER_NAMES[number], value)
+        return 'write_u32(%s, %s)' % (REGISTER_NAMES[number], value)
+
+    def target(self, mode, number):
+        """Returns an expression for the target of a jump, see resolve in
+        build_dispatch_table."""
+        size = self.core.size
+        if mode == IMMEDIATE:
+            return str(number % size)
+        elif mode == RELATIVE:
+            return '(pc + %d) %% %d' % (number, size)
+        elif mode == REGISTER_DIRECT:
+            return '%s %% %d' % (REGISTER_NAMES[number], size)
+        return 'read_u32(%s) %% %d' % (REGISTER_NAMES[number], size)
@@ -1,26 +1,328 @@
 # coding: utf-8
 
+from array import array
+from collections import Counter
 from copy import copy
-from struct import unpack
+from multiprocessing import resource_tracker, shared_memory
+from struct import pack, pack_into, unpack, unpack_from
+import mmap, os
 
-__all__ = ['Core']
+__all__ = ['Core', 'CoreSnapshot']
+
+def _open_segment(name, create=False, size=0):
+    """Opens the shared memory segment called name, creating it if asked to.
+       Python's resource tracker would unlink the segment when the process
+       that opened it exits, crashed or not, so it is told to forget the
+       segment: it lives on until somebody unlinks it, like a backing file.
+    """
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
 
 class Core(object):
     """The Core itself. An array-like object with a bunch of instructions and
        warriors, and tasks.
     """
 
-    def __init__(self, initial_value=b'\x00', size=8000, core_event_recorder=lambda *args : None):
-        self.owner = [-1 for i in range(size)]
+    def __init__(self, initial_value=b'\x00', size=8000, core_event_recorder=None, page_size=64,
+                 backing_file=None, shared_memory_name=None, readonly=False, owner_block_size=256):
+        # player id of whoever last wrote each byte, -1 if nobody has
+        self.owner = array('h', [-1]) * size
         self.size = size
-        self.clear(initial_value)
+        # how many bytes each player owns, in total and per block of
+        # owner_block_size bytes. Both are kept up to date by every change of
+        # owner so that territory and owners_in_range never scan the core
+        self.owner_block_size = owner_block_size
+        self.owner_counts = Counter({-1: size})
+        self.block_owners = [Counter({-1: min(owner_block_size, size - start)}) \
+            for start in range(0, size, owner_block_size)]
+        # one flag per page_size bytes, set whenever a page is written to
+        self.page_size = page_size
+        self.page_count = (size + page_size - 1) // page_size
+        # the byte store is a plain bytearray unless it is backed by a file or
+        # a shared memory segment that other processes can map
+        self._mmap = None
+        self._shared_memory = None
+        if backing_file:
+            fd = os.open(backing_file, os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if not readonly:
+                    os.ftruncate(fd, size)
+                self._mmap = mmap.mmap(fd, size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+            finally:
+                os.close(fd)
+            self.bytes = self._mmap
+        elif shared_memory_name:
+            try:
+                self._shared_memory = _open_segment(shared_memory_name, create=not readonly, size=size)
+            except FileExistsError:
+                self._shared_memory = _open_segment(shared_memory_name)
+            if self._shared_memory.size < size:
+                raise Exception("Shared memory segment %s is smaller than the core" % shared_memory_name)
+            self.bytes = self._shared_memory.buf[:size]
+            if readonly:
+                self.bytes = self.bytes.toreadonly()
+        # write_listener, if set, is called with (start, length) after every
+        # write so that anything cached from the core's contents can be dropped
+        self.write_listener = None
+        if readonly:
+            self.dirty_pages = bytearray(self.page_count)
+        else:
+            self.clear(initial_value)
+        # core_event_recorder is called with a list of (start, bytes) range events
         self.core_event_recorder = core_event_recorder
+        self._pending_event = None
+
+    @classmethod
+    def attach(cls, backing_file=None, shared_memory_name=None):
+        """Opens a read-only view of a core backed by a file or shared memory
+           segment, e.g. from a spectator process or to inspect the core left
+           behind by an engine that died.
+        """
+        if backing_file:
+            size = os.path.getsize(backing_file)
+        else:
+            segment = _open_segment(shared_memory_name)
+            size = segment.size
+            segment.close()
+        return cls(size=size, backing_file=backing_file, shared_memory_name=shared_memory_name, readonly=True)
+
+    def close(self):
+        """Releases the backing file or shared memory segment, if any. The core
+           is unusable afterwards. Shared memory segments are left in place for
+           other readers, even once every process that opened them exited,
+           until unlink() removes them.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._shared_memory is not None:
+            self.bytes.release()
+            self._shared_memory.close()
+
+    def unlink(self):
+        """Removes the core's shared memory segment, if any. Processes that
+           have it open keep their view of it.
+        """
+        if self._shared_memory is not None:
+            # unlink() tells the resource tracker to forget the segment again,
+            # which _open_segment already did
+            resource_tracker.register(self._shared_memory._name, 'shared_memory')
+            self._shared_memory.unlink()
 
     def clear(self, byte):
         """Writes the same byte thorough the entire core.
         """
-        self.bytes = bytearray(byte)*self.size
+        if self._mmap is None and self._shared_memory is None:
+            self.bytes = bytearray(byte)*self.size
+        else:
+            self.bytes[:] = bytes(byte)*self.size
+        self.dirty_pages = bytearray(b'\x01') * self.page_count
+        if self.write_listener:
+            self.write_listener(0, self.size)
         
+    def read_u8(self, address):
+        """Returns the byte at address.
+        """
+        return self.bytes[address % self.size]
+
+    def write_u8(self, address, value):
+        """Writes a single byte at address.
+        """
+        address %= self.size
+        self.bytes[address] = value
+        self.dirty_pages[address // self.page_size] = 1
+        if self.write_listener:
+            self.write_listener(address, 1)
+        if self.core_event_recorder:
+            self._record(address, bytes((value,)))
+
+    def read_u32(self, address):
+        """Returns the big endian word starting at address. Only accesses that
+           cross the end of the core pay for the wrap around.
+        """
+        address %= self.size
+        if address + 4 <= self.size:
+            return unpack_from('>I', self.bytes, address)[0]
+        return unpack('>I', self.__getslice__(address, address + 4))[0]
+
+    def write_u32(self, address, value):
+        """Writes value as a big endian word starting at address.
+        """
+        address %= self.size
+        if address + 4 <= self.size:
+            pack_into('>I', self.bytes, address, value)
+            self.dirty_pages[address // self.page_size] = 1
+            self.dirty_pages[(address + 3) // self.page_size] = 1
+            if self.write_listener:
+                self.write_listener(address, 4)
+            if self.core_event_recorder:
+                self._record(address, self.bytes[address : address + 4])
+        else:
+            self._write(address, pack('>I', value))
+
+    def mark_dirty(self, start, length):
+        """Flags every page overlapping length bytes from start as written.
+           The range must not wrap around the end of the core.
+        """
+        if length > 0:
+            first = start // self.page_size
+            last = (start + length - 1) // self.page_size
+            self.dirty_pages[first : last + 1] = b'\x01' * (last - first + 1)
+
+    def take_dirty_pages(self):
+        """Returns the sorted indices of every page written since the last call
+           and swaps in a clean bitmap. Call it at tick boundaries.
+        """
+        dirty, self.dirty_pages = self.dirty_pages, bytearray(self.page_count)
+        pages = []
+        page = dirty.find(1)
+        while page != -1:
+            pages.append(page)
+            page = dirty.find(1, page + 1)
+        return pages
+
+    def page_bounds(self, page):
+        """Returns the (start, stop) byte offsets covered by page.
+        """
+        start = page * self.page_size
+        return start, min(start + self.page_size, self.size)
+
+    def flush_events(self):
+        """Hands the pending range event, if any, to the core event recorder.
+           Writes are combined until this is called, MARS calls it once per step.
+        """
+        if self._pending_event:
+            start, data = self._pending_event
+            self._pending_event = None
+            self.core_event_recorder([(start, bytes(data))])
+
+    def _record(self, address, data):
+        """Merges a write into the pending range event when it overlaps or
+           directly follows it, otherwise flushes the pending event first.
+        """
+        if self._pending_event:
+            start, pending = self._pending_event
+            offset = address - start
+            if 0 <= offset <= len(pending):
+                pending[offset : offset + len(data)] = data
+                return
+            self.flush_events()
+        self._pending_event = (address, bytearray(data))
+
+    def _write(self, address, data):
+        """Writes a bytes-like object starting at address, splitting it at the
+           end of the core when it wraps around.
+        """
+        address %= self.size
+        offset = 0
+        while offset < len(data):
+            chunk = data[offset : offset + self.size - address]
+            self.bytes[address : address + len(chunk)] = chunk
+            self.mark_dirty(address, len(chunk))
+            if self.write_listener:
+                self.write_listener(address, len(chunk))
+            if self.core_event_recorder:
+                self._record(address, chunk)
+            offset += len(chunk)
+            address = 0
+
+    def set_owner(self, address, player):
+        """Marks the byte at address as owned by player.
+        """
+        address %= self.size
+        previous = self.owner[address]
+        if previous != player:
+            self.owner[address] = player
+            self.owner_counts[previous] -= 1
+            self.owner_counts[player] += 1
+            block = self.block_owners[address // self.owner_block_size]
+            block[previous] -= 1
+            block[player] += 1
+
+    def set_owners(self, addresses, players):
+        """Marks each of addresses as owned by the matching player, for bulk
+           writes scattered across the core.
+        """
+        for address, player in zip(addresses, players):
+            self.set_owner(address, player)
+
+    def set_owner_range(self, start, length, player):
+        """Marks length bytes starting at start as owned by player.
+        """
+        start %= self.size
+        length = min(length, self.size)
+        end = start + length
+        if end <= self.size:
+            self._set_owners(start, end, player)
+        else:
+            self._set_owners(start, self.size, player)
+            self._set_owners(0, end - self.size, player)
+
+    def _set_owners(self, start, end, player):
+        """Marks the bytes from start to end, which must not wrap around the
+           core, as owned by player, one block at a time.
+        """
+        owner, block_size = self.owner, self.owner_block_size
+        while start < end:
+            stop = min(end, (start // block_size + 1) * block_size)
+            previous = owner[start:stop]
+            changed = stop - start - previous.count(player)
+            if changed:
+                block = self.block_owners[start // block_size]
+                for previous_owner, count in Counter(previous).items():
+                    if previous_owner != player:
+                        block[previous_owner] -= count
+                        self.owner_counts[previous_owner] -= count
+                block[player] += changed
+                self.owner_counts[player] += changed
+                owner[start:stop] = array('h', [player]) * (stop - start)
+            start = stop
+
+    def owners_in_range(self, start, length):
+        """Returns the set of owners of length bytes starting at start. Unowned
+           bytes are reported as -1. Blocks that lie entirely within the range
+           are answered from their summary instead of being scanned.
+        """
+        start %= self.size
+        length = min(length, self.size)
+        end = start + length
+        if end <= self.size:
+            return self._owners_between(start, end)
+        return self._owners_between(start, self.size) | self._owners_between(0, end - self.size)
+
+    def _owners_between(self, start, end):
+        """owners_in_range for a range that doesn't wrap around the core.
+        """
+        block_size = self.owner_block_size
+        # blocks first to last lie entirely within the range, the last block
+        # of the core may be shorter than the others
+        first = -(-start // block_size)
+        last = len(self.block_owners) if end == self.size else end // block_size
+        if first >= last:
+            return set(self.owner[start:end])
+        owners = set(self.owner[start : first * block_size])
+        for block in self.block_owners[first:last]:
+            # arenas answer this from another thread than the one writing,
+            # which may add players to the block while it is iterated
+            owners.update(player for player, count in list(block.items()) if count)
+        owners.update(self.owner[last * block_size : end])
+        return owners
+
+    def territory(self, player):
+        """Returns how many bytes of the core player owns.
+        """
+        return self.owner_counts[player]
+
+    def view(self, start, length):
+        """Returns a memoryview over length bytes starting at start. The view is
+           zero-copy unless the range wraps around the end of the core, in which
+           case it is a view over a copy.
+        """
+        start %= self.size
+        if start + length <= self.size:
+            return memoryview(self.bytes)[start : start + length]
+        return memoryview(self.__getslice__(start, start + length))
+
     def __getitem__(self, address):
         # Python3 seems to have deprecated __getslice__
         if isinstance(address, slice):
@@ -32,26 +334,25 @@ class Core(object):
         if not stop: stop = -1
         if start > stop:
             return []
-        else:
-            return bytearray([self.bytes[(start + i) % self.size] for i in range(stop - start)])
+        length = stop - start
+        start %= self.size
+        if start + length <= self.size:
+            # slices are bytearrays whatever backs the core, slicing an mmap or
+            # a shared memory view gives bytes or a view
+            data = self.bytes[start : start + length]
+            return data if isinstance(data, bytearray) else bytearray(data)
+        return bytearray([self.bytes[(start + i) % self.size] for i in range(length)])
 
     def __setitem__(self, address, value):
         if isinstance(value, str):
             value = bytes(value, 'UTF-8')
 
         if isinstance(value, int):
-            self.bytes[address % self.size] = value
-            self.core_event_recorder(((address % self.size, value)))
+            self.write_u8(address, value)
         else:
-            events = []
-            for ctr, byte in enumerate(value):
-                if not isinstance(byte, int):
-                    converted = ord(byte)
-                else:
-                    converted = byte
-                self.bytes[(address + ctr) % self.size] = byte
-                events.append(((address + ctr) % self.size, converted))
-            self.core_event_recorder(events)
+            if not isinstance(value, (bytes, bytearray)):
+                value = bytes([byte if isinstance(byte, int) else ord(byte) for byte in value])
+            self._write(address, value)
 
     def __iter__(self):
         return iter(self.bytes)
@@ -62,5 +363,102 @@ class Core(object):
     def __repr__(self):
         return "<Core size=%d>" % self.size
 
+class CoreSnapshot(object):
+    """An immutable, tick-stamped copy of a Core's bytes. The copy is split
+       into chunks so that a new snapshot only copies the chunks that were
+       written since the previous one and shares the rest with it.
+    """
+
+    def __init__(self, tick, chunks, chunk_size, size):
+        self.tick = tick
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.size = size
+        self._bytes = None
+
+    @classmethod
+    def capture(cls, core, tick=0, previous=None, dirty_pages=None, chunk_size=4096):
+        """Snapshots core. When previous and the dirty pages taken from the core
+           since previous was captured are given, only the chunks overlapping
+           those pages are copied.
+        """
+        if previous is None or dirty_pages is None:
+            # chunks must line up with the core's dirty pages
+            chunk_size = max(chunk_size // core.page_size, 1) * core.page_size
+            return cls(tick, tuple(bytes(core.bytes[start : start + chunk_size]) \
+                for start in range(0, core.size, chunk_size)), chunk_size, core.size)
+
+        chunk_size = previous.chunk_size
+        chunks = list(previous.chunks)
+        last_chunk = -1
+        for page in dirty_pages:
+            chunk = page * core.page_size // chunk_size
+            if chunk != last_chunk:
+                start = chunk * chunk_size
+                chunks[chunk] = bytes(core.bytes[start : start + chunk_size])
+                last_chunk = chunk
+        return cls(tick, tuple(chunks), chunk_size, core.size)
+
+    def changes_since(self, previous, pages, page_size, gap=4):
+        """Returns where the snapshot differs from previous as (start, bytes)
+           segments in address order. Only pages, the core's pages written
+           since previous was captured, are compared, so bytes that were
+           written but ended up unchanged aren't included. Differences less
+           than gap bytes apart are sent as a single segment.
+        """
+        runs = []
+        start = stop = None
+        for page in pages:
+            page_start = page * page_size
+            chunk, offset = divmod(page_start, self.chunk_size)
+            if self.chunks[chunk] is previous.chunks[chunk]:
+                continue
+            end = offset + page_size
+            new, old = self.chunks[chunk][offset:end], previous.chunks[chunk][offset:end]
+            if new == old:
+                continue
+            for i in range(len(new)):
+                if new[i] != old[i]:
+                    address = page_start + i
+                    if stop is not None and address - stop < gap:
+                        stop = address + 1
+                    else:
+                        if start is not None:
+                            runs.append((start, stop))
+                        start, stop = address, address + 1
+        if start is not None:
+            runs.append((start, stop))
+        return [(start, self.slice(start, stop)) for start, stop in runs]
+
+    def slice(self, start, stop):
+        """Returns the bytes from start to stop without joining the whole
+           snapshot.
+        """
+        first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+        if first == last:
+            offset = first * self.chunk_size
+            return self.chunks[first][start - offset : stop - offset]
+        offset = first * self.chunk_size
+        return b''.join(self.chunks[first : last + 1])[start - offset : stop - offset]
+
+    def tobytes(self):
+        """Returns the whole snapshot as a single bytes object.
+        """
+        if self._bytes is None:
+            self._bytes = b''.join(self.chunks)
+        return self._bytes
+
+    def __getitem__(self, address):
+        return self.tobytes()[address]
+
+    def __iter__(self):
+        return iter(self.tobytes())
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<CoreSnapshot tick=%d size=%d>" % (self.tick, self.size)
+
 if __name__ == "__main__":
     a = Core()
\ No newline at end of file
@@ -1,13 +1,13 @@
 #! /usr/bin/env python
 # coding: utf-8
 
-from copy import copy, deepcopy
-from random import randint, shuffle, choice
-import operator, struct
+from random import randint, choice
+import operator
 
-from binascii import hexlify
 from .core import Core
-from time import sleep
+from .pacing import TickPacer
+from .profiling import ExecutionProfile
+from time import perf_counter
 from .yeetcode import *
 from .players import *
 
@@ -31,9 +31,30 @@ EVENT_B_WRITE  = 10
 EVENT_A_ARITH  = 11
 EVENT_B_ARITH  = 12
 
+# arithmetic applied by the mov-like instructions as op(destination, source).
+# YEET has none since it only ever writes its destination
+MOV_OPS = {YEET: None, YOINK: operator.add, KNIOY: operator.sub, MUL: operator.mul,
+           DIV: operator.floordiv, FITS: operator.mod}
+
+DIVIDE_BY_ZERO_MESSAGES = {DIV: "Divided by 0", FITS: "Modulo by 0"}
+
+def _ignore_event(*args):
+    """The default event handler. MARS.run() skips the callbacks entirely
+       while every handler is this one.
+    """
+    pass
+
 class yeetTimeException(Exception):
     def __init__(self, message: str, thread: Thread, instr: Instruction):
-        self.message = "Emulator Runtime Exception (%s) - thread: %s Instruction: %s" % (message, thread, instr)
+        # the message is only formatted if somebody looks at it, crashes are
+        # common and usually go unreported when running headless
+        self.reason = message
+        self.thread = thread
+        self.instr = instr
+
+    @property
+    def message(self):
+        return "Emulator Runtime Exception (%s) - thread: %s Instruction: %s" % (self.reason, self.thread, self.instr)
 
     def __str__(self):
         return self.message
@@ -43,21 +64,47 @@ class MARS(object):
     """
 
     def __init__(self, core=None, minimum_separation=100, max_processes=10, players={}, seconds_per_tick=0, \
-        runtime_event_handler=lambda *args: None, update_thread_event_handler=lambda *args: None, \
-        kill_thread_event_handler=lambda *args: None, ticket_event_handler=lambda *args: None):
+        runtime_event_handler=_ignore_event, update_thread_event_handler=_ignore_event, \
+        kill_thread_event_handler=_ignore_event, ticket_event_handler=_ignore_event):
         self.core = core if core else Core()
         self.minimum_separation = minimum_separation
         self.max_processes = max_processes if max_processes else len(self.core)
-        self.thread_pool = []
-        self.next_tick_pool = []
+        # index of every live thread's pc for the LOCATE_* syscalls
+        self.thread_locator = ThreadLocator(self.core.size)
+        self.thread_pool = ThreadQueue()
+        self.next_tick_pool = ThreadQueue()
         self.tick_count = 0
+        # the tick tick_event_handler was last called for, so that a tick that
+        # is resumed isn't announced twice
+        self.announced_tick = None
         self.players = players
         self.thread_counter = 0
-        self.seconds_per_tick = seconds_per_tick
+        # threads that crashed or were killed, reused by the next spawns
+        self.free_threads = []
+        # sleeps out whatever is left of each tick() once its threads have run
+        self.pacer = TickPacer(seconds_per_tick)
         self.runtime_event_handler = runtime_event_handler
         self.update_thread_event_handler = update_thread_event_handler
         self.kill_thread_event_handler = kill_thread_event_handler
         self.tick_event_handler = ticket_event_handler
+        # decoded instructions keyed by address, dropped whenever the core
+        # writes to any of the instruction's bytes
+        self.decode_cache = {}
+        self.decode_cache_hits = 0
+        self.decode_cache_misses = 0
+        # execution counters, only kept while profiling is enabled
+        self.profile = None
+        self.core.write_listener = self.invalidate_decoded
+        self.dispatch_table = self.build_dispatch_table()
+
+    @property
+    def seconds_per_tick(self):
+        return self.pacer.seconds_per_tick
+
+    @seconds_per_tick.setter
+    def seconds_per_tick(self, seconds):
+        # takes effect on the tick in progress
+        self.pacer.seconds_per_tick = seconds
 
     def __iter__(self):
         return iter(self.core)
@@ -68,267 +115,329 @@ class MARS(object):
     def __getitem__(self, address):
         return self.core[address]
         
-    def kill_thread(self, thread_id):
-        for idx, thread in enumerate(self.thread_pool):
-            if thread.id == thread_id:
-                self.runtime_event_handler("Killing thread in thread pool %s" % thread)
-                del self.thread_pool[idx]
-                self.kill_thread_event_handler(thread.id)
-                return
-        
-        for idx, thread in enumerate(self.next_tick_pool):
-            if thread.id == thread_id:
-                self.runtime_event_handler("Killing thread in next tick's thread pool %s" % thread)
-                del self.next_tick_pool[idx]
-                self.kill_thread_event_handler(thread.id)
-                return
+    def decode(self, address):
+        """Decode the instruction at address into a (handler, a_number, b_number,
+        instruction) tuple, see build_dispatch_table. Instructions with invalid
+        register operands get a handler that crashes the thread.
+        Results are cached until the core writes over the instruction.
+        """
+        entry = self.decode_cache.get(address)
+        if entry is not None:
+            self.decode_cache_hits += 1
+            return entry
+        self.decode_cache_misses += 1
+
+        instr = Instruction()
+        instr.mcode = self.core[address : address + INSTRUCTION_WIDTH]
+        return self.cache_decoded(address, self.select_handler(instr), instr)
+
+    def select_handler(self, instr):
+        """Returns the dispatch table's handler for instr, or one that crashes
+        the thread if instr has invalid register operands.
+        """
+        if (instr.a_mode == REGISTER_DIRECT or instr.a_mode == REGISTER_INDIRECT) and instr.a_number not in [0, 1]:
+            return self.fault_handler("a_number is not within the range of valid registers")
+        elif (instr.b_mode == REGISTER_DIRECT or instr.b_mode == REGISTER_INDIRECT) and instr.b_number not in [0, 1]:
+            return self.fault_handler("b_number is not within the range of valid registers")
+        return self.dispatch_table[instr.mcode[0]]
+
+    def cache_decoded(self, address, handler, instr):
+        """Caches handler as the decoded instruction at address and returns the
+        decode cache entry. While profiling is enabled the cached handler also
+        counts its executions.
+        """
+        if self.profile is not None:
+            handler = self.profile.wrap(handler, address, instr)
+        entry = self.decode_cache[address] = (handler, instr.a_number, instr.b_number, instr)
+        return entry
+
+    def enable_profiling(self, top=20):
+        """Starts counting executions by instruction, player and address, and
+        crashes by reason. Stepping is only slower while profiling is enabled.
+        """
+        self.profile = ExecutionProfile(top)
+        self.decode_cache.clear()
+
+    def disable_profiling(self):
+        """Stops profiling and returns the final profile snapshot, if any"""
+        snapshot = self.profile_snapshot()
+        self.profile = None
+        self.decode_cache.clear()
+        return snapshot
+
+    def profile_snapshot(self, top=None):
+        """Returns the execution counters collected since profiling was
+        enabled, None if it isn't"""
+        profile = self.profile
+        return profile.snapshot(top) if profile is not None else None
+
+    def fault_handler(self, message):
+        """Returns an instruction handler that crashes the thread with message"""
+        def handler(thread, a_number, b_number, instr):
+            raise yeetTimeException(message, thread, instr)
+        return handler
+
+    def invalidate_decoded(self, start, length):
+        """Drop every cached instruction overlapping length bytes from start
+        """
+        cache = self.decode_cache
+        if not cache:
+            return
+        if length >= self.core.size:
+            cache.clear()
+            return
+        first = start - INSTRUCTION_WIDTH + 1
+        if first < 0:
+            # instructions at the end of the core wrap around to the start
+            for address in range(first + self.core.size, self.core.size):
+                cache.pop(address, None)
+            first = 0
+        for address in range(first, start + length):
+            cache.pop(address, None)
+
+    def decode_cache_stats(self):
+        """Returns the decoded instruction cache's hit and miss counters"""
+        return {'hits': self.decode_cache_hits, 'misses': self.decode_cache_misses,
+                'entries': len(self.decode_cache)}
         
-        raise Exception("Couldn't find player %s's oldest thread")
+    @property
+    def thread_pool(self):
+        return self._thread_pool
+
+    @thread_pool.setter
+    def thread_pool(self, threads):
+        self._thread_pool = self.replace_pool(getattr(self, '_thread_pool', None), threads)
+
+    @property
+    def next_tick_pool(self):
+        return self._next_tick_pool
+
+    @next_tick_pool.setter
+    def next_tick_pool(self, threads):
+        self._next_tick_pool = self.replace_pool(getattr(self, '_next_tick_pool', None), threads)
+
+    def replace_pool(self, old_pool, threads):
+        """Returns threads as a ThreadQueue, moving the thread locator over
+        from the threads in the pool being replaced"""
+        for thread in old_pool or ():
+            self.thread_locator.discard(thread)
+        pool = threads if isinstance(threads, ThreadQueue) else ThreadQueue(threads)
+        for thread in pool:
+            self.thread_locator.add(thread)
+        return pool
+
+    def swap_pools(self):
+        """Make the next tick's thread pool current, reusing the drained pool
+        for the tick after"""
+        drained = self._thread_pool
+        drained.clear()
+        self._thread_pool = self._next_tick_pool
+        self._next_tick_pool = drained
+
+    def kill_thread(self, thread_id):
+        if thread_id in self.thread_pool:
+            thread = self.thread_pool.remove(thread_id)
+            self.runtime_event_handler("Killing thread in thread pool %s" % thread)
+        elif thread_id in self.next_tick_pool:
+            thread = self.next_tick_pool.remove(thread_id)
+            self.runtime_event_handler("Killing thread in next tick's thread pool %s" % thread)
+        else:
+            raise Exception("Couldn't find thread %s" % thread_id)
+        self.release_thread(thread)
+        self.kill_thread_event_handler(thread.id)
     
     def kill_oldest_thread(self, player_id):
-        if len(self.players[player_id].threads) == 0:
+        oldest = self.players[player_id].threads.oldest()
+        if oldest is None:
             return
-        self.kill_thread(self.players[player_id].threads.pop(0))
+        self.kill_thread(oldest)
+
+    def thread_count(self, player_id):
+        """Returns the number of live threads owned by player_id"""
+        return len(self.players[player_id].threads)
 
     def crash_thread(self, thread, message):
         self.kill_thread_event_handler(thread.id)
         self.runtime_event_handler("====THREAD CRASH====\n%s" % message)
-        self.players[thread.owner].threads.remove(thread.id)
-    
-    def get_a_value(self, instr, thread):
-        if instr.a_mode == IMMEDIATE:
-            l_val = bytearray(instr.a_number)
-        elif instr.a_mode == RELATIVE:
-            l_val = self.core[instr.a_number + thread.pc : instr.a_number + thread.pc + WORD_SIZE]
-        elif instr.a_mode == REGISTER_DIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                l_val = thread.xd_bytes if instr.a_number == 0 else thread.dx_bytes
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-        elif instr.a_mode == REGISTER_INDIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                loc = struct.unpack('>I', thread.xd_bytes)[0] if instr.a_number == 0 else struct.unpack('>I', thread.dx_bytes)[0]
-                l_val = self.core[loc : loc + WORD_SIZE]
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-            
-        else:
-            raise yeetTimeException("a_mode is not within usable range", thread, instr)
-        return l_val
-                        
-    def get_a_int(self, instr, thread):
-        if instr.a_mode == IMMEDIATE:
-            l_val = instr.a_number
-        elif instr.a_mode == RELATIVE:
-            l_val = struct.unpack('>I', self.core[instr.a_number + thread.pc : instr.a_number + thread.pc + WORD_SIZE])[0]
-        elif instr.a_mode == REGISTER_DIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                l_val = thread.xd if instr.a_number == 0 else thread.dx
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-        elif instr.a_mode == REGISTER_INDIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                loc = thread.xd if instr.a_number == 0 else thread.dx
-                l_val = struct.unpack('>I', self.core[loc : loc + WORD_SIZE])[0]
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-        else:
-            raise yeetTimeException("a_mode is not within usable range", thread, instr)
-        return l_val
-
-    # currently unused
-    def get_a_blame(self, instr, thread):
-        if instr.a_mode == IMMEDIATE:
-            blame = instr.owner
-        elif instr.a_mode == RELATIVE:
-            addr = (instr.a_number + thread.pc) % self.core.size
-            possible_owners = set()
-            for i in WORD_SIZE:
-                possible_owners.add(self.core.owner[(addr + i) % self.core.size])
-            possible_owners_count = len(possible_owners)
-            if possible_owners_count > 1:
-                # If there are 2 or more unique owners, return a random choice of whoever is not the thread owner
-                possible_owners = filter(lambda owner: owner != thread.owner, possible_owners)
-                shuffle(possible_owners)
-            blame = list(possible_owners)[0]
-        elif instr.a_mode == REGISTER_DIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                blame = thread.xd_blame if instr.a_number == 0 else thread.dx_blame
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-        elif instr.a_mode == REGISTER_INDIRECT:
-            if instr.a_number == 0 or instr.a_number == 1:
-                addr = thread.xd if instr.a_number == 0 else thread.dx
-                possible_owners = set()
-                for i in WORD_SIZE:
-                    possible_owners.add(self.core.owner[(addr + i) % self.core.size])
-                possible_owners_count = len(possible_owners)
-                if possible_owners_count > 1:
-                    # If there are 2 or more unique owners, return a random choice of whoever is not the thread owner
-                    possible_owners = filter(lambda owner: owner != thread.owner, possible_owners)
-                    shuffle(possible_owners)
-                blame = list(possible_owners)[0]
-            else:
-                raise yeetTimeException("register a_number is not 1 or 0", thread, instr)
-        else:
-            raise yeetTimeException("a_mode is not within usable range", thread, instr)
-        return l_val
-                        
-    def get_b_value(self, instr, thread):
-        if instr.a_mode == IMMEDIATE:
-            r_val = struct.pack('>H', instr.b_number)
-        elif instr.a_mode == RELATIVE:
-            r_val = self.core[instr.b_number + thread.pc : instr.b_number + thread.pc + WORD_SIZE]
-        elif instr.a_mode == REGISTER_DIRECT:
-            if instr.b_number == 0 or instr.b_number == 1:
-                r_val = thread.xd_bytes if instr.b_number == 0 else thread.dx_bytes
-            else:
-                raise yeetTimeException("register b_number is not 1 or 0", thread, instr)
-        elif instr.a_mode == REGISTER_INDIRECT:
-            if instr.b_number == 0 or instr.b_number == 1:
-                loc = struct.unpack('>I', thread.xd_bytes)[0] if instr.b_number == 0 else struct.unpack('>I', thread.dx_bytes)[0]
-                r_val = self.core[loc : loc + WORD_SIZE]
-            else:
-                raise yeetTimeException("register b_number is not 1 or 0", thread, instr)
-        else:
-            raise yeetTimeException("b_mode is not within usable range", thread, instr)
-        return r_val
-                        
-    def get_b_int(self, instr, thread):
-        if instr.b_mode == IMMEDIATE:
-            r_val = instr.b_number
-        elif instr.b_mode == RELATIVE:
-            r_val = struct.unpack('>I', self.core[instr.b_number + thread.pc : instr.b_number + thread.pc + WORD_SIZE])[0]
-        elif instr.b_mode == REGISTER_DIRECT:
-            if instr.b_number == 0 or instr.b_number == 1:
-                r_val = thread.xd if instr.b_number == 0 else thread.dx
-            else:
-                raise yeetTimeException("register b_number is not 1 or 0", thread, instr)
-        elif instr.b_mode == REGISTER_INDIRECT:
-            if instr.b_number == 0 or instr.b_number == 1:
-                loc = thread.xd if instr.b_number == 0 else thread.dx
-                r_val = struct.unpack('>I', self.core[loc : loc + WORD_SIZE])[0]
-            else:
-                raise yeetTimeException("register b_number is not 1 or 0", thread, instr)
-        else:
-            raise yeetTimeException("b_mode is not within usable range", thread, instr)
-        return r_val
-        
-    def mov_template(self, instr, thread, op):
-        """Simulate a generic move instruction
-        """
-        l_int = self.get_a_int(instr, thread)
-        r_int = self.get_b_int(instr, thread)
-        if instr.a_mode == IMMEDIATE and instr.b_mode != REGISTER_DIRECT:
-            # mov with an immediate as the src is an implicit movb, with the exception of register direct
-            struct_type = '>B'
-            max_size = BYTE_MAX
-            width = 1
-            r_int = r_int >> 24
-        else:
-            struct_type = '>I'
-            max_size = WORD_MAX
-            width = 4
-            
-        if instr.b_mode == IMMEDIATE:
-            # Move into absolute address
-            derefed_immediate = struct.unpack(struct_type, self.core[instr.b_number : instr.b_number + width])[0]
-            self.core[instr.b_number] = struct.pack(struct_type, op(l_int, derefed_immediate) % max_size)
-            self.core.owner[instr.b_number % self.core.size] = thread.owner
-        elif instr.b_mode == RELATIVE:
-            # Move into a relative offset
-            self.core[instr.b_number + thread.pc] = struct.pack(struct_type, op(l_int, r_int) % max_size)
-            self.core.owner[(instr.b_number + thread.pc) % self.core.size] = thread.owner
-        elif instr.b_mode == REGISTER_DIRECT:
-            # Move into a register
-            if instr.b_number == 0:
-                thread.xd = struct.pack('>I', op(l_int, r_int) % max_size)
-            else:
-                thread.dx = struct.pack('>I', op(l_int, r_int) % max_size)
-        elif instr.b_mode == REGISTER_INDIRECT:
-            # Move into an absolute address held by a register
-            loc = thread.xd if instr.b_number == 0 else thread.dx
-            self.core[loc] = struct.pack(struct_type, op(l_int, r_int) % max_size)
-            for i in range(WORD_SIZE):
-                self.core.owner[(loc + i) % self.core.size] = thread.owner
-
-    def resolve_address(self, thread, instr):
-        if instr.b_mode == IMMEDIATE:
-            return instr.b_number % self.core.size
-        elif instr.b_mode == RELATIVE:
-            return (thread.pc + instr.b_number) % self.core.size
-        elif instr.b_mode == REGISTER_DIRECT:
-            loc = thread.xd if instr.b_number == 0 else thread.dx
-            return loc % self.core.size
-        elif instr.b_mode == REGISTER_INDIRECT:
-            loc = struct.unpack(">I", self.core[thread.xd : thread.xd + 4])[0] if \
-                instr.b_number == 0 else \
-                struct.unpack(">I", self.core[thread.dx : thread.dx + 4])[0]
-            return loc % self.core.size
-            
-    def jmp_template(self, thread, instr):
-        """Simulate a generic jump instruction
+        self.release_thread(thread)
+
+    def release_thread(self, thread):
+        """Forgets a thread that has already left the thread pools and keeps
+           the object around for the next spawn to reuse.
         """
-        thread.pc = self.resolve_address(thread, instr)
-        self.next_tick_pool.append(thread)
-        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color)
+        self.thread_locator.discard(thread)
+        self.players[thread.owner].threads.discard(thread.id)
+        self.free_threads.append(thread)
     
-    def yeb_template(self, thread, instr):
-        """Simulate a generic xchg instruction
+    def build_dispatch_table(self):
+        """Build the table of instruction handlers indexed by an instruction's
+        first byte, i.e. by its (opcode, a_mode, b_mode) combination.
+        Each handler is specialized for its addressing modes, resolves its
+        operands only when it needs them, and is called as
+        handler(thread, a_number, b_number, instr). It returns the address
+        execution continues at when it transfers control, None otherwise.
         """
-        l_val = self.get_a_int(instr, thread)
-        r_val = self.get_b_int(instr, thread)
-
-        # Resolve A value based on mode
-        if instr.a_mode == IMMEDIATE:
-            deref_lval = self.core[l_val : l_val + 4]
-        elif instr.a_mode == RELATIVE:
-            deref_lval = struct.pack(">I", l_val)
-        elif instr.a_mode == REGISTER_DIRECT:
-            deref_lval = struct.pack(">I", thread.xd) if instr.a_number == XD_REGISTER else \
-                struct.pack(">I", thread.dx)
-        else:
-            deref_lval = struct.pack(">I", l_val)
-
-        # Resolve B value based on mode
-        if instr.b_mode == IMMEDIATE:
-            deref_rval = self.core[r_val : r_val + 4]
-        elif instr.b_mode == RELATIVE:
-            deref_rval = struct.pack(">I", r_val)
-        elif instr.b_mode == REGISTER_DIRECT:
-            deref_rval = struct.pack(">I", thread.xd) if instr.b_number == XD_REGISTER else \
-                struct.pack(">I", thread.dx)
-        else:
-            deref_rval = struct.pack(">I", r_val)
-
-        # Set A value based on mode
-        if instr.a_mode == IMMEDIATE:
-            self.core[l_val] = deref_rval
-        elif instr.a_mode == RELATIVE:
-            self.core[instr.a_number + thread.pc] = deref_rval
-        elif instr.a_mode == REGISTER_DIRECT:
-            if instr.a_number == XD_REGISTER:
-                thread.xd = struct.unpack(">I", deref_rval)[0]
+        core = self.core
+        read_u8, write_u8 = core.read_u8, core.write_u8
+        read_u32, write_u32 = core.read_u32, core.write_u32
+        set_owner_range = core.set_owner_range
+
+        def register(thread, number):
+            return thread.xd if number == XD_REGISTER else thread.dx
+
+        def set_register(thread, number, value):
+            if number == XD_REGISTER:
+                thread.xd = value
             else:
-                thread.dx = struct.unpack(">I", deref_rval)[0]
-        else:
-            loc = thread.xd if instr.a_number == XD_REGISTER else thread.dx
-            self.core[loc] = deref_rval
-
-        # Set B value based on mode
-        if instr.b_mode == IMMEDIATE:
-            self.core[r_val] = deref_lval
-        elif instr.b_mode == RELATIVE:
-            self.core[instr.b_number + thread.pc] = deref_lval
-        elif instr.b_mode == REGISTER_DIRECT:
-            if instr.b_number == XD_REGISTER:
-                thread.xd = struct.unpack(">I", deref_lval)[0]
+                thread.dx = value
+
+        # The value of an operand, by mode. Immediates are plain numbers here,
+        # instructions that treat them as addresses use locate instead
+        read_operand = {
+            IMMEDIATE: lambda thread, number: number,
+            RELATIVE: lambda thread, number: read_u32(thread.pc + number),
+            REGISTER_DIRECT: register,
+            REGISTER_INDIRECT: lambda thread, number: read_u32(register(thread, number)),
+        }
+        # The address an operand refers to, by mode. Register direct operands
+        # refer to the register itself and have no address
+        locate = {
+            IMMEDIATE: lambda thread, number: number,
+            RELATIVE: lambda thread, number: thread.pc + number,
+            REGISTER_INDIRECT: register,
+        }
+        # The word an operand refers to, by mode. Immediates are treated as
+        # absolute addresses
+        read_word = {
+            IMMEDIATE: lambda thread, number: read_u32(number),
+            RELATIVE: lambda thread, number: read_u32(thread.pc + number),
+            REGISTER_DIRECT: register,
+            REGISTER_INDIRECT: lambda thread, number: read_u32(register(thread, number)),
+        }
+        # Stores a word into the location an operand refers to, by mode
+        write_word = {
+            IMMEDIATE: lambda thread, number, value: write_u32(number, value),
+            RELATIVE: lambda thread, number, value: write_u32(thread.pc + number, value),
+            REGISTER_DIRECT: set_register,
+            REGISTER_INDIRECT: lambda thread, number, value: write_u32(register(thread, number), value),
+        }
+        size = core.size
+        # Resolves the target of a control flow instruction from its b operand
+        resolve = {
+            IMMEDIATE: lambda thread, number: number % size,
+            RELATIVE: lambda thread, number: (thread.pc + number) % size,
+            REGISTER_DIRECT: lambda thread, number: register(thread, number) % size,
+            REGISTER_INDIRECT: lambda thread, number: read_u32(register(thread, number)) % size,
+        }
+
+        def make_mov(opcode, a_mode, b_mode):
+            """Simulate a generic move instruction
+            """
+            op = MOV_OPS[opcode]
+            zero_check = DIVIDE_BY_ZERO_MESSAGES.get(opcode)
+            get_a = read_operand[a_mode]
+
+            if b_mode == REGISTER_DIRECT:
+                # Move into a register
+                def handler(thread, a_number, b_number, instr):
+                    value = get_a(thread, a_number)
+                    if zero_check and value == 0:
+                        raise yeetTimeException(zero_check, thread, instr)
+                    if op:
+                        value = op(register(thread, b_number), value)
+                    set_register(thread, b_number, value % WORD_MAX)
+                return handler
+
+            if a_mode == IMMEDIATE:
+                # mov with an immediate as the src is an implicit movb, with the exception of register direct
+                read, write, max_size, width = read_u8, write_u8, BYTE_MAX, 1
             else:
-                thread.dx = struct.unpack(">I", deref_lval)[0]
-        else:
-            loc = thread.xd if instr.b_number == XD_REGISTER else thread.dx
-            self.core[loc] = deref_lval
-        
+                read, write, max_size, width = read_u32, write_u32, WORD_MAX, WORD_SIZE
+            get_address = locate[b_mode]
+
+            def handler(thread, a_number, b_number, instr):
+                value = get_a(thread, a_number)
+                if zero_check and value == 0:
+                    raise yeetTimeException(zero_check, thread, instr)
+                address = get_address(thread, b_number)
+                if op:
+                    value = op(read(address), value)
+                write(address, value % max_size)
+                set_owner_range(address, width, thread.owner)
+            return handler
+
+        def make_jmp(opcode, a_mode, b_mode):
+            """Simulate a generic jump instruction
+            """
+            get_a = read_operand[a_mode]
+            get_target = resolve[b_mode]
+
+            if opcode == BOUNCE:
+                def handler(thread, a_number, b_number, instr):
+                    return get_target(thread, b_number)
+            elif opcode == BOUNCEZ:
+                def handler(thread, a_number, b_number, instr):
+                    if get_a(thread, a_number) == 0:
+                        return get_target(thread, b_number)
+            elif opcode == BOUNCEN:
+                def handler(thread, a_number, b_number, instr):
+                    if get_a(thread, a_number) != 0:
+                        return get_target(thread, b_number)
+            else:
+                load, store = read_word[a_mode], write_word[a_mode]
+                def handler(thread, a_number, b_number, instr):
+                    value = load(thread, a_number) - 1
+                    if value < 0:
+                        value = WORD_MAX - 1
+                    store(thread, a_number, value)
+                    if value != 0:
+                        return get_target(thread, b_number)
+            return handler
+
+        def make_zoop(opcode, a_mode, b_mode):
+            get_target = resolve[b_mode]
+            def handler(thread, a_number, b_number, instr):
+                if self.thread_count(thread.owner) < self.max_processes:
+                    self.spawn_thread_from_parent(get_target(thread, b_number), thread)
+            return handler
+
+        def make_yeb(opcode, a_mode, b_mode):
+            """Simulate a generic xchg instruction
+            """
+            load_a, load_b = read_word[a_mode], read_word[b_mode]
+            store_a, store_b = write_word[a_mode], write_word[b_mode]
+            def handler(thread, a_number, b_number, instr):
+                a_value = load_a(thread, a_number)
+                b_value = load_b(thread, b_number)
+                store_a(thread, a_number, b_value)
+                store_b(thread, b_number, a_value)
+            return handler
+
+        def make_nope(opcode, a_mode, b_mode):
+            def handler(thread, a_number, b_number, instr):
+                pass
+            return handler
+
+        def make_yeetcall(opcode, a_mode, b_mode):
+            syscall_handler = self.syscall_handler
+            def handler(thread, a_number, b_number, instr):
+                syscall_handler(thread)
+            return handler
+
+        def make_invalid(opcode, a_mode, b_mode):
+            def handler(thread, a_number, b_number, instr):
+                raise yeetTimeException("Invalid instruction", thread, instr)
+            return handler
+
+        factories = {YEET: make_mov, YOINK: make_mov, KNIOY: make_mov, MUL: make_mov,
+                     DIV: make_mov, FITS: make_mov, BOUNCE: make_jmp, BOUNCEZ: make_jmp,
+                     BOUNCEN: make_jmp, BOUNCED: make_jmp, ZOOP: make_zoop, YEB: make_yeb,
+                     NOPE: make_nope, YEETCALL: make_yeetcall}
+        table = []
+        for first_byte in range(256):
+            opcode, a_mode, b_mode = first_byte >> 4, (first_byte >> 2) & 0x3, first_byte & 0x3
+            table.append(factories.get(opcode, make_invalid)(opcode, a_mode, b_mode))
+        return table
 
     def syscall_handler(self, thread):
         """Parse and simulate a syscall.
@@ -342,35 +451,23 @@ class MARS(object):
         ERROR_CODE = "teey"
         num = thread.xd
         if num == TRANSFER_OWNERSHIP:
-            if thread.dx in self.players.keys() and len(self.players[thread.xd].threads) < int(self.max_processes*1.5):
-                self.players[thread.owner].threads.remove(thread.id)
+            if thread.dx in self.players and self.thread_count(thread.dx) < int(self.max_processes*1.5):
+                self.players[thread.owner].threads.discard(thread.id)
                 thread.owner = thread.dx
-                self.players[thread.owner].threads.append(thread.id)
-                sorted(self.players[thread.owner].threads)
+                self.players[thread.owner].threads.add(thread)
             else:
                 thread.dx = ERROR_CODE
             
         elif num == LOCATE_NEAREST_THREAD:
-            all_threads = self.thread_pool + self.next_tick_pool
-            closest_distance = self.core.size
-            max_distance = 256
-            closest_pc = None
-            for t in all_threads:
-                curr_distance = max(t.pc, thread.pc) - min(t.pc, thread.pc)
-                if curr_distance < closest_distance and curr_distance <= max_distance and t.owner != thread.owner:
-                    closest_distance = curr_distance
-                    closest_pc = t.pc
-            if closest_pc:
-                thread.dx = closest_pc
+            closest = self.thread_locator.nearest(thread.pc, 256, exclude_owner=thread.owner)
+            if closest is not None:
+                thread.dx = closest.pc
             else:
                 thread.dx = ERROR_CODE
             
         elif num == LOCATE_RANDOM_THREAD:
-            all_threads = self.thread_pool + self.next_tick_pool
-            all_threads.append(thread)
-            max_distance = 1024
-            in_range = [t for t in all_threads if max(t.pc, thread.pc) - min(t.pc, thread.pc) <= max_distance]
-            thread.dx = choice(in_range).pc
+            # the calling thread is always in range of itself
+            thread.dx = choice(self.thread_locator.in_range(thread.pc, 1024)).pc
             
         elif num == RANDOM_INT:
             thread.dx = randint(0, WORD_MAX)
@@ -381,150 +478,161 @@ class MARS(object):
     def spawn_thread_from_parent(self, pc, parent):
         """Create a new thread given a parent thread and place it in the next tick's thread pool.
         The child thread inherits everything from the parent except for its PC register and thread ID"""
-        thread = deepcopy(parent)
-        thread.pc = pc
-        thread.id = self.thread_counter
+        thread = parent.clone(pc, self.thread_counter, self.free_threads.pop() if self.free_threads else None)
         self.thread_counter += 1
-        self.players[parent.owner].threads.append(thread.id)
+        self.players[parent.owner].threads.add(thread)
+        self.thread_locator.add(thread)
         self.next_tick_pool.append(thread)
-        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color)
-    
+        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color, thread.owner)
+
     def spawn_new_thread(self, thread):
         """Create a new thread given a thread object and place it in the current thread pool."""
-        thread = deepcopy(thread)
+        thread = thread.clone(thread.pc, thread.id, self.free_threads.pop() if self.free_threads else None)
         if thread.id == -1:
             thread.id = self.thread_counter
             self.thread_counter += 1
-        self.players[thread.owner].threads.append(thread.id)
+        self.players[thread.owner].threads.add(thread)
+        self.thread_locator.add(thread)
         self.thread_pool.append(thread)
-        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color)
+        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color, thread.owner)
         
     def tick(self):
-        "Simulate one step for each thread in the thread pool"
-        self.tick_event_handler()
-        pool_size = len(self.thread_pool)
-        if not pool_size:
-            sleep(self.seconds_per_tick)
-            
+        "Simulate one step for each thread in the thread pool, then wait for the tick to end"
+        self.pacer.begin_tick()
+        self.announce_tick()
         while self.thread_pool:
-            self.step(float(self.seconds_per_tick)/pool_size)
-        self.thread_pool = self.next_tick_pool
-        self.next_tick_pool = []
+            self.step()
+        self.swap_pools()
         self.tick_count += 1
+        self.pacer.wait()
         
-    def step(self, sleep_length=None):
+    def announce_tick(self):
+        """Calls tick_event_handler for the current tick unless it already was
+        """
+        if self.announced_tick != self.tick_count:
+            self.announced_tick = self.tick_count
+            self.tick_event_handler()
+
+    def step(self):
         """Simulate one step.
         """
         if len(self.thread_pool) == 0:
             if len(self.next_tick_pool) == 0:
                 return
-            self.thread_pool = self.next_tick_pool
-            self.next_tick_pool = []
+            self.swap_pools()
             self.tick_count += 1
         
-        thread = self.thread_pool.pop(0)
-        instr = Instruction()
-        instr.mcode = [byte for byte in self.core[thread.pc : thread.pc + 4]]
-        
-        opc = instr.opcode
+        thread = self.thread_pool.popleft()
+        pc = thread.pc % self.core.size
+        entry = self.decode_cache.get(pc)
+        if entry is None:
+            entry = self.decode(pc)
+        else:
+            self.decode_cache_hits += 1
+        handler, a_number, b_number, instr = entry
         
         self.players[thread.owner].score += 1
-        if sleep_length:
-            sleep(sleep_length)
-            
-        # copy the current instruction to the instruction register
         try:
-            if (instr.a_mode == REGISTER_DIRECT or instr.a_mode == REGISTER_INDIRECT) and instr.a_number not in [0, 1]:
-                raise yeetTimeException("a_number is not within the range of valid registers", thread, instr)
-            if (instr.b_mode == REGISTER_DIRECT or instr.b_mode == REGISTER_INDIRECT) and instr.b_number not in [0, 1]:
-                raise yeetTimeException("b_number is not within the range of valid registers", thread, instr)
-            
-            if opc == NOPE:
-                # Not technically necessary, but might as well be explicit
-                pass
-            
-            elif opc == YEET:
-                self.mov_template(instr, thread, lambda x, y : x)
-                
-            elif opc == YOINK:
-                self.mov_template(instr, thread, lambda x, y : y + x)
-                
-            elif opc == KNIOY:
-                self.mov_template(instr, thread, lambda x, y : y - x)
-                
-            elif opc == MUL:
-                self.mov_template(instr, thread, lambda x, y : y * x)
-                
-            elif opc == DIV:
-                if self.get_a_int(instr, thread) == 0:
-                    raise yeetTimeException("Divided by 0", thread, instr)
-                self.mov_template(instr, thread, lambda x, y : y // x)
-                    
-            elif opc == FITS:
-                if self.get_a_int(instr, thread) == 0:
-                    raise yeetTimeException("Modulo by 0", thread, instr)
-                self.mov_template(instr, thread, lambda x, y : y % x)
-                
-            elif opc == BOUNCE:
-                self.jmp_template(thread, instr)
-                return
-                
-            elif opc == BOUNCEZ:
-                if self.get_a_int(instr, thread) == 0:
-                    self.jmp_template(thread, instr)
-                    return
-                
-            elif opc == BOUNCEN:
-                if self.get_a_int(instr, thread) != 0:
-                    self.jmp_template(thread, instr)
-                    return
-                
-            elif opc == BOUNCED:
-                if instr.a_mode != IMMEDIATE:
-                    a = self.get_a_int(instr, thread) - 1
-                else: 
-                    # Immediates are treated as absolute addresses
-                    a = struct.unpack(">I", self.core[instr.a_number : instr.a_number + INSTRUCTION_WIDTH])[0] - 1
-                    
-                if a < 0:
-                    a = WORD_MAX - 1
-                    
-                if instr.a_mode == IMMEDIATE:
-                    self.core[instr.a_number] = struct.pack(">I", a)
-                elif instr.a_mode == RELATIVE:
-                    self.core[instr.a_number + thread.pc] = struct.pack(">I", a)
-                elif instr.a_mode == REGISTER_DIRECT:
-                    if instr.a_number == 0:
-                        thread.xd = a
-                    else:
-                        thread.dx = a
-                elif instr.a_mode == REGISTER_INDIRECT:
-                    if instr.a_number == 0:
-                        self.core[thread.xd] = struct.pack(">I", a)
-                    else:
-                        self.core[thread.dx] = struct.pack(">I", a)
-                if a != 0:
-                    self.jmp_template(thread, instr)
-                    return
-                
-            elif opc == ZOOP:
-                # add one more to length of thread_pool to account for the current thread thats been popped
-                if len(self.players[thread.owner].threads) < self.max_processes:
-                    self.spawn_thread_from_parent(self.resolve_address(thread, instr), thread)
-            
-            elif opc == YEB:
-                self.yeb_template(thread, instr)
-                    
-            elif opc == YEETCALL:
-                self.syscall_handler(thread)
-            
-            else:
-                raise yeetTimeException("Invalid instruction", thread, instr)
+            target = handler(thread, a_number, b_number, instr)
         except yeetTimeException as e:
             self.crash_thread(thread, e)
             return
+        finally:
+            # hand this step's combined writes to the core event recorder
+            self.core.flush_events()
                 
-        # Any instructions that altered control flow should have prematurely returned
-        thread.pc = (thread.pc + INSTRUCTION_WIDTH) % self.core.size
+        if target is None:
+            target = (thread.pc + INSTRUCTION_WIDTH) % self.core.size
+        thread.pc = target
+        self.thread_locator.move(thread)
         self.next_tick_pool.append(thread)
-        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color)
+        self.update_thread_event_handler(thread.id, thread.pc, self.players[thread.owner].color, thread.owner)
+
+    def observed(self):
+        """Returns whether anything is listening to the simulation's events.
+        """
+        return self.core.core_event_recorder is not None or any(handler is not _ignore_event for handler in \
+            (self.runtime_event_handler, self.update_thread_event_handler, self.kill_thread_event_handler,
+             self.tick_event_handler))
+
+    def step_headless(self):
+        """step() without event callbacks. Only valid while
+           observed() is false, see run().
+        """
+        thread_pool = self._thread_pool
+        if not thread_pool:
+            if not self._next_tick_pool:
+                return
+            self.swap_pools()
+            thread_pool = self._thread_pool
+            self.tick_count += 1
+
+        thread = thread_pool.popleft()
+        size = self.core.size
+        pc = thread.pc % size
+        entry = self.decode_cache.get(pc)
+        if entry is None:
+            entry = self.decode(pc)
+        else:
+            self.decode_cache_hits += 1
+        handler, a_number, b_number, instr = entry
+
+        self.players[thread.owner].score += 1
+        try:
+            target = handler(thread, a_number, b_number, instr)
+        except yeetTimeException:
+            self.release_thread(thread)
+            return
+
+        if target is None:
+            target = (thread.pc + INSTRUCTION_WIDTH) % size
+        thread.pc = target
+        self.thread_locator.move(thread)
+        self._next_tick_pool.append(thread)
+
+    def run_pool(self, max_steps, step):
+        """Steps through the current thread pool with step until it is empty or
+           max_steps steps were taken. Returns the number of steps taken.
+        """
+        steps = 0
+        thread_pool = self.thread_pool
+        while thread_pool and steps < max_steps:
+            step()
+            steps += 1
+        return steps
+
+    def run(self, ticks=None, max_steps=None):
+        """Simulates as fast as possible until ticks ticks have passed, max_steps
+           steps have been taken or every thread is dead, whichever comes first.
+           seconds_per_tick is ignored and event handlers are only called if
+           any were given. Returns a summary of the run.
+        """
+        observed = self.observed()
+        step = self.step if observed else self.step_headless
+        step_limit = float('inf') if max_steps is None else max_steps
+        start_tick = self.tick_count
+        steps = 0
+        started = perf_counter()
+        while (ticks is None or self.tick_count - start_tick < ticks) and steps < step_limit:
+            if not self.thread_pool and not self.next_tick_pool:
+                break
+            if observed:
+                self.announce_tick()
+            steps += self.run_pool(step_limit - steps, step)
+            if self.thread_pool:
+                # out of steps partway through the tick
+                break
+            self.swap_pools()
+            self.tick_count += 1
+        elapsed = perf_counter() - started
+
+        return {
+            'ticks': self.tick_count - start_tick,
+            'steps': steps,
+            'elapsed': elapsed,
+            'steps_per_second': steps / elapsed if elapsed else 0.0,
+            'scores': {player_id: player.score for player_id, player in self.players.items()},
+            'threads': {player_id: len(player.threads) for player_id, player in self.players.items()},
+            'territory': {player_id: self.core.territory(player_id) for player_id in self.players},
+        }
+    
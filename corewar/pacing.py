@@ -0,0 +1,93 @@
+# coding: utf-8
+
+from threading import Event
+from time import monotonic
+
+__all__ = ['TickPacer']
+
+class TickPacer(object):
+    """Paces ticks to seconds_per_tick of wall clock time each.
+
+    Ticks are simulated at full speed between begin_tick() and wait(), which
+    then sleeps once until the tick's deadline. Deadlines follow each other
+    seconds_per_tick apart on a monotonic clock, so time spent outside of the
+    tick or oversleeping doesn't accumulate into drift. A tick that takes
+    longer than its budget is counted as an overrun and the schedule restarts
+    from the time it finished instead of rushing the following ticks.
+    """
+
+    def __init__(self, seconds_per_tick=0, clock=monotonic):
+        self._seconds_per_tick = seconds_per_tick
+        self.clock = clock
+        self.tick_started = None
+        self.deadline = None
+        self.ticks = 0
+        self.overruns = 0
+        self.last_overrun = 0.0
+        self.max_overrun = 0.0
+        self.total_overrun = 0.0
+        # overrun_handler, if set, is called with (seconds over budget,
+        # seconds_per_tick) whenever a tick overruns
+        self.overrun_handler = None
+        self._retargeted = Event()
+
+    @property
+    def seconds_per_tick(self):
+        return self._seconds_per_tick
+
+    @seconds_per_tick.setter
+    def seconds_per_tick(self, seconds):
+        """Changes the tick length, moving the deadline of the tick in
+           progress and waking up wait() so that it takes effect immediately.
+        """
+        self._seconds_per_tick = seconds
+        if self.tick_started is not None:
+            self.deadline = self.tick_started + seconds
+        self._retargeted.set()
+
+    def begin_tick(self):
+        """Starts a tick's budget. A tick starts at the previous tick's deadline
+           unless the pacer sat idle for longer than a whole tick since then.
+        """
+        now = self.clock()
+        if self.deadline is None or now - self.deadline > self._seconds_per_tick:
+            self.tick_started = now
+        else:
+            self.tick_started = self.deadline
+        self.deadline = self.tick_started + self._seconds_per_tick
+
+    def wait(self):
+        """Sleeps until the current tick's deadline and ends the tick. Returns
+           how many seconds the tick overran its budget by, 0 if it didn't.
+        """
+        if self.tick_started is None:
+            self.begin_tick()
+        self.ticks += 1
+        overrun = self.clock() - self.deadline
+        if overrun > 0 and self._seconds_per_tick:
+            self.tick_started = None
+            self.overruns += 1
+            self.last_overrun = overrun
+            self.max_overrun = max(self.max_overrun, overrun)
+            self.total_overrun += overrun
+            self.deadline = self.clock()
+            if self.overrun_handler:
+                self.overrun_handler(overrun, self._seconds_per_tick)
+            return overrun
+
+        self._retargeted.clear()
+        remaining = self.deadline - self.clock()
+        while remaining > 0:
+            if self._retargeted.wait(remaining):
+                # seconds_per_tick changed, wait for the new deadline instead
+                self._retargeted.clear()
+            remaining = self.deadline - self.clock()
+        # the deadline only moves while a tick is in progress
+        self.tick_started = None
+        return 0.0
+
+    def stats(self):
+        """Returns the pacing counters"""
+        return {'seconds_per_tick': self._seconds_per_tick, 'ticks': self.ticks, 'overruns': self.overruns,
+                'last_overrun': self.last_overrun, 'max_overrun': self.max_overrun,
+                'total_overrun': self.total_overrun}
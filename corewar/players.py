@@ -1,17 +1,35 @@
+from collections import OrderedDict, deque
+from itertools import islice
+from operator import attrgetter
 from struct import pack, unpack
 import binascii
 
 class Thread(object):
+    __slots__ = ('pc', 'id', '_xd', '_dx', 'owner', 'xd_blame', 'dx_blame')
+
     def __init__(self, pc, xd=0, dx=0, owner=0, thread_id=-1):
         self.pc: int = pc
         self.id: int = thread_id
-        self._xd:int = self.reg_to_int(xd)
-        self._dx: int = self.reg_to_int(dx)
+        self._xd: int = xd if xd.__class__ is int else self.reg_to_int(xd)
+        self._dx: int = dx if dx.__class__ is int else self.reg_to_int(dx)
         self.owner: int = owner
         # blame represents the player id of whoever
         self.xd_blame = owner
         self.dx_blame = owner
 
+    def clone(self, pc, thread_id, into=None):
+        """Returns a copy of this thread with a new pc and id. The copy is made
+        into the unused thread into instead of a new one when given"""
+        thread = into if into is not None else Thread.__new__(Thread)
+        thread.pc = pc
+        thread.id = thread_id
+        thread._xd = self._xd
+        thread._dx = self._dx
+        thread.owner = self.owner
+        thread.xd_blame = self.xd_blame
+        thread.dx_blame = self.dx_blame
+        return thread
+
     def reg_to_int(self, reg):
         match reg:
             case bytes() | bytearray():
@@ -39,20 +57,232 @@ class Thread(object):
     
     @xd.setter
     def xd(self, val):
-        self._xd = self.reg_to_int(val)
+        self._xd = val if val.__class__ is int else self.reg_to_int(val)
     
     @dx.setter
     def dx(self, val):
-        self._dx = self.reg_to_int(val)
+        self._dx = val if val.__class__ is int else self.reg_to_int(val)
         
     def __str__(self):
         return "ID: {} PC: {} Owner: {} XD: {} DX: {}".format(self.id, self.pc, self.owner, binascii.hexlify(self.xd_bytes), binascii.hexlify(self.dx_bytes))
         
     
 
+class ThreadQueue(object):
+    """A FIFO run queue of threads with an index from thread id to thread.
+    Removing a thread by id is O(1): the thread is marked as removed and
+    skipped once it reaches the front of the queue.
+    """
+    def __init__(self, threads=()):
+        self._queue = deque()
+        self._threads = {}
+        # removed threads still in the queue, with how many times they are
+        self._removed = {}
+        self._live = 0
+        self.extend(list(threads))
+
+    def append(self, thread):
+        self._queue.append(thread)
+        self._threads[thread.id] = thread
+        self._live += 1
+
+    def extend(self, threads):
+        """Appends every thread in the list threads"""
+        self._queue.extend(threads)
+        self._threads.update(zip(map(attrgetter('id'), threads), threads))
+        self._live += len(threads)
+
+    def popleft(self):
+        queue = self._queue
+        removed = self._removed
+        while queue:
+            thread = queue.popleft()
+            if removed and thread in removed:
+                if removed[thread] == 1:
+                    del removed[thread]
+                else:
+                    removed[thread] -= 1
+                continue
+            if self._threads.get(thread.id) is thread:
+                del self._threads[thread.id]
+            self._live -= 1
+            return thread
+        raise IndexError("pop from an empty ThreadQueue")
+
+    def popleft_many(self, count):
+        """Pops the first count threads and returns them in order"""
+        if count > self._live:
+            raise IndexError("pop from an empty ThreadQueue")
+        if self._removed:
+            return [self.popleft() for _ in range(count)]
+        popleft, threads = self._queue.popleft, self._threads
+        popped = [popleft() for _ in range(count)]
+        for thread in popped:
+            if threads.get(thread.id) is thread:
+                del threads[thread.id]
+        self._live -= count
+        return popped
+
+    def remove(self, thread_id):
+        """Mark the thread with thread_id as removed and return it"""
+        thread = self._threads.pop(thread_id)
+        self._removed[thread] = self._removed.get(thread, 0) + 1
+        self._live -= 1
+        return thread
+
+    def get(self, thread_id, default=None):
+        return self._threads.get(thread_id, default)
+
+    def clear(self):
+        self._queue.clear()
+        self._threads.clear()
+        self._removed.clear()
+        self._live = 0
+
+    def __contains__(self, thread_id):
+        return thread_id in self._threads
+
+    def __len__(self):
+        return self._live
+
+    def __iter__(self):
+        if not self._removed:
+            return iter(self._queue)
+        return self._iter_live()
+
+    def _iter_live(self):
+        skip = dict(self._removed)
+        for thread in self._queue:
+            if thread in skip:
+                skip[thread] -= 1
+                if not skip[thread]:
+                    del skip[thread]
+                continue
+            yield thread
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._live
+        if index < 0 or index >= self._live:
+            raise IndexError("ThreadQueue index out of range")
+        return next(islice(iter(self), index, None))
+
+    def __repr__(self):
+        return "<ThreadQueue %s>" % [thread.id for thread in self]
+    
+
+class ThreadRegistry(object):
+    """The live threads owned by a player keyed by thread id, oldest first.
+    Adding, removing and finding the oldest thread are all O(1).
+    """
+    def __init__(self):
+        self._threads = OrderedDict()
+
+    def add(self, thread):
+        self._threads[thread.id] = thread
+
+    def remove(self, thread_id):
+        return self._threads.pop(thread_id)
+
+    def discard(self, thread_id):
+        return self._threads.pop(thread_id, None)
+
+    def get(self, thread_id, default=None):
+        return self._threads.get(thread_id, default)
+
+    def oldest(self):
+        """Returns the id of the oldest thread, None if there are no threads"""
+        return next(iter(self._threads), None)
+
+    def __contains__(self, thread_id):
+        return thread_id in self._threads
+
+    def __len__(self):
+        return len(self._threads)
+
+    def __iter__(self):
+        return iter(self._threads)
+
+    def __repr__(self):
+        return "<ThreadRegistry %s>" % list(self._threads)
+
+
+class ThreadLocator(object):
+    """Index of live threads by PC for a core of size bytes. Threads are kept
+    in buckets of bucket_size bytes so that range queries only look at the
+    buckets overlapping the range. Distances wrap around the end of the core.
+    """
+    def __init__(self, size, bucket_size=256):
+        self.size = size
+        self.bucket_size = bucket_size
+        self.bucket_count = (size + bucket_size - 1) // bucket_size
+        self._buckets = {}
+        self._bucket_of = {}
+
+    def add(self, thread):
+        bucket = (thread.pc % self.size) // self.bucket_size
+        self._bucket_of[thread] = bucket
+        self._buckets.setdefault(bucket, {})[thread] = None
+
+    def discard(self, thread):
+        bucket = self._bucket_of.pop(thread, None)
+        if bucket is not None:
+            members = self._buckets[bucket]
+            del members[thread]
+            if not members:
+                del self._buckets[bucket]
+
+    def move(self, thread):
+        """Re-index thread after its PC changed"""
+        bucket = (thread.pc % self.size) // self.bucket_size
+        if self._bucket_of.get(thread) != bucket:
+            self.discard(thread)
+            self._bucket_of[thread] = bucket
+            self._buckets.setdefault(bucket, {})[thread] = None
+
+    def distance(self, a, b):
+        """Returns the distance between two addresses, going around the end of
+        the core if that is shorter"""
+        distance = abs(a % self.size - b % self.size)
+        return min(distance, self.size - distance)
+
+    def in_range(self, pc, max_distance, exclude_owner=None):
+        """Returns every thread within max_distance bytes of pc, optionally
+        leaving out the threads owned by exclude_owner"""
+        pc %= self.size
+        if 2 * max_distance + 1 >= self.size:
+            buckets = range(self.bucket_count)
+        else:
+            start = (pc - max_distance) % self.size
+            end = (pc + max_distance) % self.size
+            first, last = start // self.bucket_size, end // self.bucket_size
+            count = (last - first) % self.bucket_count + 1
+            if end < start and first == last:
+                count = self.bucket_count
+            buckets = ((first + i) % self.bucket_count for i in range(count))
+
+        found = []
+        for bucket in buckets:
+            for thread in self._buckets.get(bucket, ()):
+                if thread.owner != exclude_owner and self.distance(thread.pc, pc) <= max_distance:
+                    found.append(thread)
+        return found
+
+    def nearest(self, pc, max_distance, exclude_owner=None):
+        """Returns the closest thread within max_distance bytes of pc not owned
+        by exclude_owner, ties going to the oldest thread. None if there is none"""
+        candidates = self.in_range(pc, max_distance, exclude_owner)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda thread: (self.distance(thread.pc, pc), thread.id))
+
+    def __len__(self):
+        return len(self._bucket_of)
+
+
 class Player(object):
     def __init__(self, name, player_id, token, score=0, color="#0000FF"):
-        self.threads = []
+        self.threads = ThreadRegistry()
         self.name = name
         self.id = player_id
         self.token = token
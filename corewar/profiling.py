@@ -0,0 +1,81 @@
+# coding: utf-8
+
+from collections import Counter
+from threading import Lock
+from time import perf_counter
+
+from .yeetcode import MODES, OPCODES
+
+__all__ = ['ExecutionProfile']
+
+OPCODE_NAMES = {opcode: name for name, opcode in OPCODES.items()}
+MODE_NAMES = {mode: name for name, mode in MODES.items()}
+
+class ExecutionProfile(object):
+    """Execution counters for a MARS with profiling enabled.
+
+    Nothing is checked while stepping. Instead, every handler MARS caches
+    while the profile is enabled is wrapped in one that counts the instruction
+    it executes, see wrap(), and MARS drops its cached handlers when
+    profiling is turned on or off.
+
+    Snapshots may be taken from another thread than the one stepping, the
+    counters are only updated and copied while holding the profile's lock.
+    """
+
+    def __init__(self, top=20):
+        self.top = top
+        self.started = perf_counter()
+        # executions by first byte, i.e. by (opcode, a_mode, b_mode)
+        self.executions = [0] * 256
+        self.players = Counter()
+        self.addresses = Counter()
+        self.crashes = Counter()
+        self.lock = Lock()
+
+    def wrap(self, handler, address, instr):
+        """Returns handler wrapped to count executions of instr at address."""
+        executions, players, addresses, crashes = self.executions, self.players, self.addresses, self.crashes
+        lock = self.lock
+        first_byte = instr.opcode << 4 | instr.a_mode << 2 | instr.b_mode
+
+        def profiled(thread, a_number, b_number, instr):
+            with lock:
+                executions[first_byte] += 1
+                players[thread.owner] += 1
+                addresses[address] += 1
+            try:
+                return handler(thread, a_number, b_number, instr)
+            except Exception as e:
+                with lock:
+                    crashes[getattr(e, 'reason', str(e))] += 1
+                raise
+        return profiled
+
+    def snapshot(self, top=None):
+        """Returns the counters as plain dicts and lists, with the top most
+        executed addresses."""
+        with self.lock:
+            executions = list(self.executions)
+            players = Counter(self.players)
+            addresses = Counter(self.addresses)
+            crashes = Counter(self.crashes)
+        opcodes = Counter()
+        modes = Counter()
+        for first_byte, count in enumerate(executions):
+            if count:
+                opcode = OPCODE_NAMES.get(first_byte >> 4, 'INVALID(%d)' % (first_byte >> 4))
+                opcodes[opcode] += count
+                modes['%s %s, %s' % (opcode, MODE_NAMES[(first_byte >> 2) & 0x3], MODE_NAMES[first_byte & 0x3])] += count
+        steps = sum(executions)
+        elapsed = perf_counter() - self.started
+        return {
+            'steps': steps,
+            'elapsed': elapsed,
+            'steps_per_second': steps / elapsed if elapsed else 0.0,
+            'opcodes': dict(opcodes.most_common()),
+            'modes': dict(modes.most_common()),
+            'players': dict(players.most_common()),
+            'crashes': dict(crashes.most_common()),
+            'hot_addresses': addresses.most_common(self.top if top is None else top),
+        }
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+from bisect import bisect_left, insort
+
+_LOWEST = float('-inf')
+
+__all__ = ['Scoreboard']
+
+class Scoreboard(object):
+    """Players' scores, kept in rank order as they change.
+
+    Scores are held in a list of (-score, player_id) keys that is always
+    sorted, so a player's rank is a binary search and moving a player is one
+    removal and one insertion, whichever way the rest of the board shifts.
+    A score change can only move the ranks of the players whose scores lie
+    between its old and new score, so the span of scores that changed is
+    remembered until take_changes(), and only the players in it whose rank or
+    score differs from what was last taken need to be sent to clients.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self._order = []
+        self._taken = {}
+        self._low = None
+        self._high = None
+
+    def _touch(self, low, high):
+        """Marks the scores from low to high as having changed ranks"""
+        self._low = low if self._low is None else min(self._low, low)
+        self._high = high if self._high is None else max(self._high, high)
+
+    def update(self, player_id, score):
+        """Sets player_id's score. Returns whether it changed."""
+        previous = self.scores.get(player_id)
+        if previous == score:
+            return False
+        if previous is not None:
+            del self._order[bisect_left(self._order, (-previous, player_id))]
+        insort(self._order, (-score, player_id))
+        self.scores[player_id] = score
+        # a new player pushes everyone below it down a rank
+        previous = _LOWEST if previous is None else previous
+        self._touch(min(previous, score), max(previous, score))
+        return True
+
+    def remove(self, player_id):
+        """Takes player_id off the board"""
+        score = self.scores.pop(player_id)
+        del self._order[bisect_left(self._order, (-score, player_id))]
+        self._taken.pop(player_id, None)
+        self._touch(_LOWEST, score)
+
+    def rank(self, player_id):
+        """Returns player_id's rank, starting at 1. Players with the same score
+        share a rank."""
+        return bisect_left(self._order, (-self.scores[player_id],)) + 1
+
+    def leaderboard(self, count=None):
+        """Returns the top count players, or all of them, as (rank,
+        player_id, score) from the highest score down."""
+        rows = []
+        rank = 0
+        previous = None
+        for position, (negated, player_id) in enumerate(self._order[:count]):
+            if negated != previous:
+                rank, previous = position + 1, negated
+            rows.append((rank, player_id, -negated))
+        return rows
+
+    def take_changes(self):
+        """Returns the (rank, player_id, score) of every player whose rank or
+        score changed since the last call, best first."""
+        if self._low is None:
+            return []
+        order = self._order
+        start = bisect_left(order, (-self._high,))
+        stop = bisect_left(order, (-self._low, float('inf')))
+        self._low = self._high = None
+        changes = []
+        rank = 0
+        previous = None
+        for position in range(start, stop):
+            negated, player_id = order[position]
+            # the span always starts on the first player of a score
+            if negated != previous:
+                rank, previous = position + 1, negated
+            row = (rank, player_id, -negated)
+            if self._taken.get(player_id) != row:
+                self._taken[player_id] = row
+                changes.append(row)
+        return changes
+
+    def __contains__(self, player_id):
+        return player_id in self.scores
+
+    def __len__(self):
+        return len(self.scores)
@@ -0,0 +1,223 @@
+# coding: utf-8
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from random import Random
+from time import perf_counter
+import csv, json, os, random
+
+from .core import Core
+from .mars import MARS
+from .players import Player, Thread
+from .yeetcode import assemble
+
+__all__ = ['Bot', 'load_bot', 'round_robin_pairings', 'swiss_pairings', 'play_match',
+           'run_tournament', 'write_scoreboard']
+
+class Bot(object):
+    """A bot file assembled once for every match it plays in."""
+
+    def __init__(self, name, path, program):
+        self.name = name
+        self.path = path
+        self.program = bytes(program)
+
+    def __repr__(self):
+        return "<Bot %s (%d bytes)>" % (self.name, len(self.program))
+
+def load_bot(path):
+    """Assembles the yeetcode in the file at path into a Bot named after the
+       file.
+    """
+    with open(path, 'r') as r:
+        program = assemble(r.read().splitlines())
+    if not program:
+        raise Exception("%s doesn't contain any instructions" % path)
+    return Bot(os.path.splitext(os.path.basename(path))[0], path, program)
+
+def round_robin_pairings(bot_count, games=1):
+    """Returns every pair of bots games times, swapping who loads first
+       every other game.
+    """
+    pairings = []
+    for game in range(games):
+        for first in range(bot_count):
+            for second in range(first + 1, bot_count):
+                pairings.append((first, second) if game % 2 == 0 else (second, first))
+    return pairings
+
+def swiss_pairings(standings, played, generator, had_bye=()):
+    """Pairs bots with similar standings that haven't played each other yet.
+       standings maps bot index to (points, score), played is a set of
+       frozenset pairs. Returns (pairings, bye), bye is the bot left out of an
+       odd round, the lowest ranked one that hasn't had a bye yet, or None.
+    """
+    ranked = sorted(standings, key=lambda bot: (standings[bot], generator.random()), reverse=True)
+    bye = None
+    if len(ranked) % 2:
+        bye = next((bot for bot in reversed(ranked) if bot not in had_bye), ranked[-1])
+        ranked.remove(bye)
+    pairings = []
+    while ranked:
+        first = ranked.pop(0)
+        opponent = next((bot for bot in ranked if frozenset((first, bot)) not in played), ranked[0])
+        ranked.remove(opponent)
+        pairings.append((first, opponent))
+    return pairings, bye
+
+# the bots' programs in each worker process, see _initialize_worker
+_worker_programs = None
+
+def _initialize_worker(programs):
+    global _worker_programs
+    _worker_programs = programs
+
+def play_match(match_id, bots, seed, core_size=8192, ticks=1000, max_processes=10, programs=None):
+    """Plays a headless match between the bots, given as indices into programs,
+       and returns its result. Everything random about the match, from where
+       the bots are loaded to the RANDOM_INT syscall, follows from seed.
+    """
+    programs = _worker_programs if programs is None else programs
+    generator = Random(seed)
+    random.seed(seed)
+    players = {player_id: Player("bot%d" % bot, player_id, "") for player_id, bot in enumerate(bots)}
+    runtime = MARS(Core(size=core_size), players=players, max_processes=max_processes)
+
+    # every bot gets its own slice of the core, in a random order
+    slot = core_size // len(bots)
+    slots = list(range(len(bots)))
+    generator.shuffle(slots)
+    for player_id, bot in enumerate(bots):
+        program = programs[bot]
+        if len(program) > slot:
+            raise Exception("Bot %d is too large for a %d byte core shared by %d bots" % (bot, core_size, len(bots)))
+        load_idx = slots[player_id] * slot + generator.randrange(slot - len(program) + 1)
+        runtime.core[load_idx] = program
+        runtime.core.set_owner_range(load_idx, len(program), player_id)
+        runtime.spawn_new_thread(Thread(load_idx, owner=player_id))
+
+    result = runtime.run(ticks=ticks)
+    return {
+        'match': match_id,
+        'bots': list(bots),
+        'seed': seed,
+        'scores': [result['scores'][player_id] for player_id in range(len(bots))],
+        'threads': [result['threads'][player_id] for player_id in range(len(bots))],
+        'territory': [result['territory'][player_id] for player_id in range(len(bots))],
+        'ticks': result['ticks'],
+        'steps': result['steps'],
+        'elapsed': result['elapsed'],
+    }
+
+def _executor(workers, programs):
+    """Returns a process pool whose workers are handed the programs once, when
+       they start, rather than with every match.
+    """
+    method = 'forkserver' if 'forkserver' in get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context(method),
+                               initializer=_initialize_worker, initargs=(programs,))
+
+def run_tournament(bots, mode='round-robin', rounds=None, games=1, seed=0, core_size=8192, ticks=1000,
+                   max_processes=10, workers=None, score='steps'):
+    """Plays a round robin or swiss tournament between bots and returns the
+       scoreboard and throughput stats. A match is won by the bot with the
+       highest score at the end, which is either the steps its threads took
+       or, with score='territory', how many bytes of the core it owns. Wins
+       are worth 1 point and draws half a point. Matches are played in a pool
+       of workers processes, or in this process when workers is 0.
+    """
+    if len(bots) < 2:
+        raise Exception("A tournament needs at least 2 bots")
+    if mode not in ('round-robin', 'swiss'):
+        raise Exception("Unknown tournament mode %s, expected 'round-robin' or 'swiss'" % mode)
+    if score not in ('steps', 'territory'):
+        raise Exception("Unknown score %s, expected 'steps' or 'territory'" % score)
+    score_key = 'scores' if score == 'steps' else 'territory'
+    programs = [bot.program for bot in bots]
+    generator = Random(seed)
+    standings = {bot: [0.0, 0] for bot in range(len(bots))}
+    records = {bot: {'wins': 0, 'draws': 0, 'losses': 0, 'byes': 0, 'matches': 0} for bot in range(len(bots))}
+    played = set()
+    matches = []
+    started = perf_counter()
+
+    executor = _executor(workers, programs) if workers != 0 else None
+    def play(pairings):
+        arguments = [(len(matches) + i, pair, "%s:%d" % (seed, len(matches) + i), core_size, ticks, max_processes)
+                     for i, pair in enumerate(pairings)]
+        if executor is None:
+            results = [play_match(*args, programs=programs) for args in arguments]
+        else:
+            results = executor.map(play_match, *zip(*arguments))
+        for result in results:
+            first, second = result['bots']
+            first_score, second_score = result[score_key]
+            if first_score == second_score:
+                outcomes = ((first, 'draws', 0.5), (second, 'draws', 0.5))
+            elif first_score > second_score:
+                outcomes = ((first, 'wins', 1.0), (second, 'losses', 0.0))
+            else:
+                outcomes = ((first, 'losses', 0.0), (second, 'wins', 1.0))
+            for bot, outcome, points in outcomes:
+                records[bot][outcome] += 1
+                records[bot]['matches'] += 1
+                standings[bot][0] += points
+            standings[first][1] += first_score
+            standings[second][1] += second_score
+            played.add(frozenset((first, second)))
+            matches.append(result)
+
+    try:
+        if mode == 'round-robin':
+            play(round_robin_pairings(len(bots), games))
+        else:
+            if rounds is None:
+                rounds = max((len(bots) - 1).bit_length(), 1)
+            for i in range(rounds):
+                pairings, bye = swiss_pairings({bot: tuple(standing) for bot, standing in standings.items()},
+                                               played, generator,
+                                               {bot for bot, record in records.items() if record['byes']})
+                if bye is not None:
+                    records[bye]['byes'] += 1
+                    standings[bye][0] += 1.0
+                play(pairings)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    elapsed = perf_counter() - started
+
+    scoreboard = []
+    for bot in sorted(standings, key=lambda bot: standings[bot], reverse=True):
+        row = {'rank': len(scoreboard) + 1, 'name': bots[bot].name, 'path': bots[bot].path,
+               'points': standings[bot][0], 'score': standings[bot][1]}
+        row.update(records[bot])
+        scoreboard.append(row)
+    steps = sum(match['steps'] for match in matches)
+    return {
+        'scoreboard': scoreboard,
+        'matches': [dict(match, bots=[bots[bot].name for bot in match['bots']]) for match in matches],
+        'stats': {
+            'matches': len(matches),
+            'ticks': sum(match['ticks'] for match in matches),
+            'steps': steps,
+            'elapsed': elapsed,
+            'steps_per_second': steps / elapsed if elapsed else 0.0,
+            'match_seconds': sum(match['elapsed'] for match in matches),
+        },
+    }
+
+SCOREBOARD_FIELDS = ['rank', 'name', 'path', 'points', 'score', 'matches', 'wins', 'draws', 'losses', 'byes']
+
+def write_scoreboard(results, output, output_format='json'):
+    """Writes a run_tournament result to the file object output, either all of
+       it as JSON or the scoreboard as CSV.
+    """
+    if output_format == 'json':
+        json.dump(results, output, indent=2)
+        output.write('\n')
+    elif output_format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=SCOREBOARD_FIELDS)
+        writer.writeheader()
+        writer.writerows(results['scoreboard'])
+    else:
+        raise Exception("Unknown output format %s, expected 'json' or 'csv'" % output_format)
@@ -0,0 +1,325 @@
+# coding: utf-8
+
+from collections import Counter
+from operator import attrgetter
+
+from .mars import MARS, yeetTimeException
+from .yeetcode import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['VectorMARS']
+
+# Why a thread crashes, in the order decode() and the handlers check for them
+FAULT_NONE, FAULT_A_REGISTER, FAULT_B_REGISTER, FAULT_INVALID, FAULT_DIVIDE, FAULT_MODULO = range(6)
+FAULT_MESSAGES = {FAULT_A_REGISTER: "a_number is not within the range of valid registers",
+                  FAULT_B_REGISTER: "b_number is not within the range of valid registers",
+                  FAULT_INVALID: "Invalid instruction",
+                  FAULT_DIVIDE: "Divided by 0",
+                  FAULT_MODULO: "Modulo by 0"}
+
+VALID_OPCODES = (YEET, YOINK, KNIOY, MUL, DIV, FITS, BOUNCE, BOUNCEZ, BOUNCEN, BOUNCED,
+                 ZOOP, YEB, NOPE, YEETCALL)
+# instructions that touch the thread pools or the players, or that depend on
+# their own writes, are always stepped by MARS
+SCALAR_OPCODES = (ZOOP, YEB, YEETCALL)
+
+# first_writer value for bytes nobody in the wave writes to
+NO_WRITER = 2 ** 31 - 1
+
+class VectorMARS(MARS):
+    """A MARS that executes the thread pool with NumPy a wave of threads at a
+    time instead of stepping through it thread by thread.
+
+    A wave is the longest run of threads at the front of the thread pool that
+    neither execute an instruction only MARS can step nor read a byte that an
+    earlier thread in the same wave writes. Executing a wave all at once
+    against the core as it was before the wave is therefore the same as
+    stepping through it, and overlapping writes are applied in thread pool
+    order. Threads outside of waves are stepped by MARS as usual.
+    """
+
+    min_wave_size = 16
+    max_wave_size = 65536
+
+    def __init__(self, *args, **kwargs):
+        if np is None:
+            raise ImportError("VectorMARS requires numpy")
+        super().__init__(*args, **kwargs)
+        self.wave_size = 256
+        self.vector_steps = 0
+        self.scalar_steps = 0
+        # index of the first thread in the current wave that writes to each
+        # word, by the word's address
+        self._first_writer = np.full(self.core.size, NO_WRITER, dtype=np.int32)
+        self._valid = np.zeros(16, dtype=bool)
+        self._valid[list(VALID_OPCODES)] = True
+        self._scalar = np.zeros(16, dtype=bool)
+        self._scalar[list(SCALAR_OPCODES)] = True
+
+    def tick(self):
+        "Simulate one step for each thread in the thread pool, then wait for the tick to end"
+        self.pacer.begin_tick()
+        self.announce_tick()
+        self.run_pool(float('inf'), self.step)
+        self.swap_pools()
+        self.tick_count += 1
+        self.pacer.wait()
+
+    def run_pool(self, max_steps, step):
+        """Executes the current thread pool in waves until it is empty or
+        max_steps steps were taken, stepping threads that can't be part of a
+        wave with step. Returns the number of steps taken.
+        """
+        if self.profile is not None:
+            # waves don't go through the decoded handlers that count steps
+            return MARS.run_pool(self, max_steps, step)
+        observed = self.observed()
+        # writes made outside of steps go out before any of the waves' writes
+        self.core.flush_events()
+        steps = 0
+        thread_pool = self.thread_pool
+        while thread_pool and steps < max_steps:
+            threads = list(thread_pool)
+            position = 0
+            # threads executed in waves are only moved over to the next tick's
+            # pool in bulk, before MARS steps a thread and at the end
+            executed_total = 0
+            survivors = []
+            while position < len(threads) and steps < max_steps:
+                window = threads[position : position + int(min(self.wave_size, max_steps - steps))]
+                executed = self.execute_wave(window, observed, survivors)
+                if not executed:
+                    self.retire_threads(executed_total, survivors)
+                    executed_total = 0
+                    survivors = []
+                    step()
+                    self.scalar_steps += 1
+                    position += 1
+                    steps += 1
+                    continue
+                self.vector_steps += executed
+                executed_total += executed
+                position += executed
+                steps += executed
+                # grow waves while whole windows execute, shrink them when
+                # hazards keep cutting them short
+                if executed == self.wave_size:
+                    self.wave_size = min(self.wave_size * 2, self.max_wave_size)
+                elif executed < self.wave_size // 4:
+                    self.wave_size = max(self.wave_size // 2, self.min_wave_size)
+            self.retire_threads(executed_total, survivors)
+        return steps
+
+    def retire_threads(self, count, survivors):
+        """Removes the first count threads from the thread pool and queues the
+        survivors among them for the next tick.
+        """
+        if count == len(self.thread_pool):
+            self.thread_pool.clear()
+        elif count:
+            self.thread_pool.popleft_many(count)
+        self.next_tick_pool.extend(survivors)
+
+    def execute_wave(self, threads, observed, survivors):
+        """Executes the longest wave at the front of threads, which must be next
+        in line in the thread pool, and adds the threads that didn't crash to
+        survivors. Returns the number of threads executed, 0 if the first
+        thread has to be stepped by MARS.
+        """
+        core = self.core
+        size = core.size
+        try:
+            pc = np.fromiter(map(attrgetter('pc'), threads), dtype=np.int64, count=len(threads)) % size
+            xd = np.fromiter(map(attrgetter('xd'), threads), dtype=np.int64, count=len(threads))
+            dx = np.fromiter(map(attrgetter('dx'), threads), dtype=np.int64, count=len(threads))
+        except OverflowError:
+            return 0
+        memory = np.frombuffer(core.bytes, dtype=np.uint8)
+        offsets = np.arange(WORD_SIZE)
+
+        def read_words(addresses):
+            word = memory[(addresses[:, None] + offsets) % size].astype(np.int64)
+            return word[:, 0] << 24 | word[:, 1] << 16 | word[:, 2] << 8 | word[:, 3]
+
+        # decode
+        code = memory[(pc[:, None] + offsets) % size].astype(np.int64)
+        first_byte = code[:, 0]
+        opcode, a_mode, b_mode = first_byte >> 4, first_byte >> 2 & 0x3, first_byte & 0x3
+        a_number, b_number = code[:, 1], code[:, 2] << 8 | code[:, 3]
+        fault = np.where(self._valid[opcode], FAULT_NONE, FAULT_INVALID)
+        fault[(b_mode >= REGISTER_DIRECT) & (b_number > 1)] = FAULT_B_REGISTER
+        fault[(a_mode >= REGISTER_DIRECT) & (a_number > 1)] = FAULT_A_REGISTER
+
+        # registers outside of the word range only come from threads spawned
+        # with them, leave those to MARS
+        irregular = (xd < 0) | (xd > WORD_MAX) | (dx < 0) | (dx > WORD_MAX)
+        is_bounced = opcode == BOUNCED
+        scalar = irregular | ((fault == FAULT_NONE) & (self._scalar[opcode] | (is_bounced & (b_mode == REGISTER_INDIRECT))))
+        count = int(np.argmax(scalar)) if scalar.any() else len(threads)
+        if not count:
+            return 0
+        if count < len(threads):
+            pc, xd, dx, code, opcode, a_mode, b_mode, a_number, b_number, fault, is_bounced = (array[:count] \
+                for array in (pc, xd, dx, code, opcode, a_mode, b_mode, a_number, b_number, fault, is_bounced))
+
+        # operands
+        a_register = np.where(a_number == XD_REGISTER, xd, dx)
+        b_register = np.where(b_number == XD_REGISTER, xd, dx)
+        a_address = np.where(a_mode == IMMEDIATE, a_number, np.where(a_mode == RELATIVE, pc + a_number, a_register)) % size
+        # immediates are plain numbers except to BOUNCED, which treats them as addresses
+        a_reads = (a_mode == RELATIVE) | (a_mode == REGISTER_INDIRECT) | ((a_mode == IMMEDIATE) & is_bounced)
+        a_value = np.where(a_reads, read_words(a_address), np.where(a_mode == REGISTER_DIRECT, a_register, a_number))
+
+        # mov-like instructions
+        is_mov = (opcode >= YEET) & (opcode <= FITS)
+        fault[(fault == FAULT_NONE) & (opcode == DIV) & (a_value == 0)] = FAULT_DIVIDE
+        fault[(fault == FAULT_NONE) & (opcode == FITS) & (a_value == 0)] = FAULT_MODULO
+        live = fault == FAULT_NONE
+        to_register = is_mov & (b_mode == REGISTER_DIRECT)
+        to_memory = is_mov & ~to_register
+        byte_wide = to_memory & (a_mode == IMMEDIATE)
+        destination = np.where(b_mode == IMMEDIATE, b_number, np.where(b_mode == RELATIVE, pc + b_number, b_register)) % size
+        destination_reads = to_memory & (opcode != YEET)
+        old = np.where(to_register, b_register, np.where(byte_wide, memory[destination], read_words(destination)))
+        divisor = np.where(a_value == 0, 1, a_value)
+        product = (old.astype(np.uint64) * a_value.astype(np.uint64) % WORD_MAX).astype(np.int64)
+        result = np.select([opcode == YOINK, opcode == KNIOY, opcode == MUL, opcode == DIV, opcode == FITS],
+                           [old + a_value, old - a_value, product, old // divisor, old % divisor], a_value)
+        result %= np.where(byte_wide, BYTE_MAX, WORD_MAX)
+
+        # jumps
+        is_jump = (opcode >= BOUNCE) & (opcode <= BOUNCED)
+        decremented = np.where(a_value == 0, WORD_MAX - 1, a_value - 1)
+        decrements_register = is_bounced & (a_mode == REGISTER_DIRECT)
+        b_register = np.where(decrements_register & (a_number == b_number), decremented, b_register)
+        target_reads = is_jump & (b_mode == REGISTER_INDIRECT)
+        target = np.where(b_mode == IMMEDIATE, b_number, np.where(b_mode == RELATIVE, pc + b_number, b_register))
+        target = np.where(target_reads, read_words(b_register % size), target) % size
+        taken = (opcode == BOUNCE) | ((opcode == BOUNCEZ) & (a_value == 0)) | \
+            ((opcode == BOUNCEN) & (a_value != 0)) | (is_bounced & (decremented != 0))
+        next_pc = np.where(is_jump & taken, target, (pc + INSTRUCTION_WIDTH) % size)
+
+        # registers
+        sets_b = to_register & live
+        sets_a = decrements_register & live
+        new_xd = np.where(sets_b & (b_number == XD_REGISTER), result,
+                          np.where(sets_a & (a_number == XD_REGISTER), decremented, xd))
+        new_dx = np.where(sets_b & (b_number == DX_REGISTER), result,
+                          np.where(sets_a & (a_number == DX_REGISTER), decremented, dx))
+
+        # memory writes, at most one per thread
+        writes = live & (to_memory | (is_bounced & ~decrements_register))
+        write_start = np.where(to_memory, destination, a_address)
+        write_width = np.where(writes, np.where(byte_wide, 1, WORD_SIZE), 0)
+        write_value = np.where(to_memory, result, decremented)
+        write_mask = offsets < write_width[:, None]
+        write_bytes = (write_start[:, None] + offsets) % size
+        index = np.arange(count)
+
+        # cut the wave at the first thread reading a byte an earlier thread
+        # writes. Every read is a word, so first_writer is indexed by the
+        # addresses words overlapping a written byte start at
+        first_writer = self._first_writer
+        shifts = np.arange(1 - WORD_SIZE, WORD_SIZE)
+        overlapping = writes[:, None] & (shifts < write_width[:, None])
+        starts = (write_start[:, None] + shifts)[overlapping] % size
+        # np.unique keeps the first occurrence, which is the earliest writer
+        starts, first = np.unique(starts, return_index=True)
+        first_writer[starts] = np.broadcast_to(index[:, None], overlapping.shape)[overlapping][first]
+        read_starts = np.stack([pc, a_address, destination, b_register % size], axis=1)
+        read_mask = np.stack([np.ones(count, dtype=bool), a_reads, destination_reads, target_reads], axis=1)
+        earliest = np.where(read_mask, first_writer[read_starts], NO_WRITER).min(axis=1)
+        first_writer[starts] = NO_WRITER
+        hazards = np.flatnonzero(earliest < index)
+        executed = int(hazards[0]) if len(hazards) else count
+
+        write_mask[executed:] = False
+        if write_mask.any():
+            byte_values = np.where(write_width[:, None] == 1, write_value[:, None],
+                                   write_value[:, None] >> (8 * (WORD_SIZE - 1 - offsets))) & 0xff
+            self.apply_writes(write_bytes[write_mask], byte_values[write_mask],
+                              np.broadcast_to(index[:, None], write_mask.shape)[write_mask],
+                              np.broadcast_to(to_memory[:, None], write_mask.shape)[write_mask], threads)
+
+        executed_threads = threads[:executed]
+        for owner, steps in Counter(map(attrgetter('owner'), executed_threads)).items():
+            self.players[owner].score += steps
+        live = live[:executed]
+        moved = [thread for thread, alive in zip(executed_threads, live.tolist()) if alive]
+        for thread, thread_pc in zip(moved, next_pc[:executed][live].tolist()):
+            thread.pc = thread_pc
+        survivors += moved
+        for i in np.flatnonzero(new_xd[:executed] != xd[:executed]).tolist():
+            threads[i].xd = int(new_xd[i])
+        for i in np.flatnonzero(new_dx[:executed] != dx[:executed]).tolist():
+            threads[i].dx = int(new_dx[i])
+        bucket_size = self.thread_locator.bucket_size
+        for i in np.flatnonzero(live & (next_pc[:executed] // bucket_size != pc[:executed] // bucket_size)).tolist():
+            self.thread_locator.move(threads[i])
+
+        if observed:
+            recorder = core.core_event_recorder
+            color = {player_id: player.color for player_id, player in self.players.items()}
+            for i, (thread, thread_fault, width) in enumerate(zip(executed_threads, fault.tolist(), write_width.tolist())):
+                if thread_fault:
+                    instr = Instruction()
+                    instr.mcode = bytearray(code[i].tolist())
+                    self.crash_thread(thread, yeetTimeException(FAULT_MESSAGES[thread_fault], thread, instr))
+                    continue
+                if recorder and width:
+                    self.record_write(int(write_start[i]), int(write_value[i]), width)
+                self.update_thread_event_handler(thread.id, thread.pc, color[thread.owner], thread.owner)
+        else:
+            for i in np.flatnonzero(~live).tolist():
+                self.release_thread(threads[i])
+        return executed
+
+    def apply_writes(self, addresses, values, writers, owned, threads):
+        """Writes each byte value to its address in order, so the last write to
+        an address wins. writers are the indices in threads of the threads
+        writing each byte and owned flags the bytes that change hands, which
+        are the ones written by mov-like instructions.
+        """
+        core = self.core
+        last = self.last_writes(addresses)
+        written = addresses[last]
+        np.frombuffer(core.bytes, dtype=np.uint8)[written] = values[last]
+        np.frombuffer(core.dirty_pages, dtype=np.uint8)[written // core.page_size] = 1
+        if core.write_listener and len(written):
+            # written is sorted, the listener hears about each run of
+            # consecutive addresses once
+            breaks = np.flatnonzero(np.diff(written) != 1) + 1
+            starts = written[np.concatenate(([0], breaks))].tolist()
+            stops = (written[np.concatenate((breaks - 1, [-1]))] + 1).tolist()
+            for start, stop in zip(starts, stops):
+                core.write_listener(start, stop - start)
+
+        addresses, writers = addresses[owned], writers[owned]
+        if len(addresses):
+            owners = np.fromiter(map(attrgetter('owner'), threads), dtype=np.int16, count=len(threads))
+            last = self.last_writes(addresses)
+            addresses, owners = addresses[last], owners[writers[last]]
+            # only the bytes that change hands go through the core, which keeps
+            # its territory counts up to date
+            changed = np.frombuffer(core.owner, dtype=np.int16)[addresses] != owners
+            core.set_owners(addresses[changed].tolist(), owners[changed].tolist())
+
+    def last_writes(self, addresses):
+        """Returns the indices of the last write to each of addresses"""
+        return len(addresses) - 1 - np.unique(addresses[::-1], return_index=True)[1]
+
+    def record_write(self, start, value, width):
+        """Hands a single write to the core event recorder the way stepping
+        through it would have, split in two if it wraps around the core.
+        """
+        size = self.core.size
+        data = value.to_bytes(width, 'big')
+        if start + width <= size:
+            self.core.core_event_recorder([(start, data)])
+        else:
+            self.core.core_event_recorder([(start, data[:size - start])])
+            self.core.core_event_recorder([(0, data[size - start:])])
@@ -0,0 +1,207 @@
+from multiprocessing import get_all_start_methods, get_context
+import engine
+import os
+import threading
+
+# settings that only the web process uses
+WEB_SETTINGS = ('admin_token', 'arenas')
+
+# files every arena writes to, and their names when there is a single arena.
+# With several arenas each one gets its own, named after it, unless it sets
+# its own name
+ARENA_FILES = {'staging_file': 'staging.json', 'history_file': 'history.txt'}
+
+# events an arena can have in flight to the web process. Once the web process
+# falls this far behind, the arena's emitter thread blocks and the engine
+# coalesces its event batches instead, see emitter.py
+MAX_QUEUED_EVENTS = 256
+
+def arena_room(arena, room):
+    """
+    Name of the socket room for an arena's room, e.g. its 'player' room
+    """
+    return "%s/%s" % (arena, room)
+
+def arena_configs(config):
+    """
+    Split the server config into one engine config per arena. Arenas are
+    listed under 'arenas' either as names or as a mapping from name to the
+    settings that arena overrides, without it there is a single arena called
+    'default'. Returns an ordered dict of name to engine config
+    """
+    arenas = config.get('arenas') or ['default']
+    if not isinstance(arenas, dict):
+        arenas = {name: {} for name in arenas}
+    shared = {key: value for key, value in config.items() if key not in WEB_SETTINGS}
+    configs = {}
+    for name, overrides in arenas.items():
+        configs[name] = dict(shared, **overrides)
+        if len(arenas) > 1:
+            for setting, default in ARENA_FILES.items():
+                if setting not in overrides:
+                    root, extension = os.path.splitext(shared.get(setting, default))
+                    configs[name][setting] = "%s-%s%s" % (root, name, extension)
+
+    for setting in ('core_backing_file', 'core_shared_memory_name') + tuple(ARENA_FILES):
+        values = [arena_config[setting] for arena_config in configs.values() if arena_config.get(setting)]
+        if len(values) != len(set(values)):
+            raise Exception("Every arena needs its own %s" % setting)
+    return configs
+
+class EventQueueEmitter(object):
+    """
+    Stands in for the socketio server inside an arena's process, forwarding
+    everything the engine emits to the web process
+    """
+    def __init__(self, events):
+        self.events = events
+
+    def emit(self, event, *args, room=None, **kwargs):
+        self.events.put((event, args, room))
+
+def serve_requests(e, connection):
+    """
+    Answer the web process' requests for the arena's engine, see Arena.request
+    """
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            if command == 'core_bytes':
+                result = e.get_core_bytes()
+            elif command == 'set_tickrate':
+                e.mars.seconds_per_tick = args[0]
+                result = True
+            elif command == 'add_player':
+                result = e.add_player(*args)
+            elif command == 'stage':
+                player_id, instructions = args
+                e.staged_payloads[player_id] = [player_id, instructions[:e.max_staging_size]]
+                result = True
+            elif command == 'core_delta':
+                result = e.get_core_delta(*args)
+            elif command == 'palette':
+                result = e.get_palette()
+            elif command == 'stats':
+                result = e.get_stats()
+            elif command == 'leaderboard':
+                result = e.get_leaderboard()
+            elif command == 'territory':
+                result = e.get_territory(*args)
+            elif command == 'profile':
+                result = e.mars.profile_snapshot()
+            elif command == 'set_profiling':
+                if args[0]:
+                    e.mars.enable_profiling()
+                    result = None
+                else:
+                    result = e.mars.disable_profiling()
+            else:
+                raise Exception("Unknown arena request %s" % command)
+        except Exception as error:
+            result = error
+        connection.send(result)
+
+def run_arena(name, config, connection, events):
+    """
+    Entry point of an arena's process. Runs the engine's game loop while
+    another thread answers requests from the web process
+    """
+    e = engine.Engine(socketio=EventQueueEmitter(events), **config)
+    if not os.path.isfile(e.staging_file):
+        with open(e.staging_file, 'w') as w:
+            w.write('{}')
+    request_thread = threading.Thread(target=serve_requests, args=(e, connection))
+    request_thread.daemon = True
+    request_thread.start()
+    e.run()
+
+class Arena(object):
+    """
+    The web process' handle on an arena, whose engine runs in its own process
+    """
+    def __init__(self, name, config, socketio):
+        self.name = name
+        self.config = config
+        self.__socketio = socketio
+        # fork where possible so the arena doesn't re-import the server
+        context = get_context('fork' if 'fork' in get_all_start_methods() else None)
+        self.connection, arena_connection = context.Pipe()
+        self.events = context.Queue(MAX_QUEUED_EVENTS)
+        self.lock = threading.Lock()
+        self.process = context.Process(target=run_arena, name="arena-%s" % name, \
+            args=(name, config, arena_connection, self.events))
+        self.process.daemon = True
+
+    def start_relay(self):
+        relay_thread = threading.Thread(target=self.relay_events)
+        relay_thread.daemon = True
+        relay_thread.start()
+
+    def relay_events(self):
+        """
+        Re-emit the arena's events to the sockets in the arena's rooms
+        """
+        while True:
+            event, args, room = self.events.get()
+            self.__socketio.emit(event, *args, room=arena_room(self.name, room or 'player'))
+
+    def request(self, command, *args):
+        """
+        Run command against the arena's engine and return the result
+        """
+        with self.lock:
+            self.connection.send((command, args))
+            result = self.connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_core_bytes(self):
+        return self.request('core_bytes')
+
+    def set_tickrate(self, seconds_per_tick):
+        return self.request('set_tickrate', seconds_per_tick)
+
+    def add_player(self, player_name, player_id, player_token):
+        return self.request('add_player', player_name, player_id, player_token)
+
+    def stage(self, player_id, instructions):
+        return self.request('stage', player_id, instructions)
+
+    def get_leaderboard(self):
+        return self.request('leaderboard')
+
+    def get_stats(self):
+        return self.request('stats')
+
+    def get_palette(self):
+        return self.request('palette')
+
+    def get_core_delta(self, since=None):
+        return self.request('core_delta', since)
+
+    def get_territory(self, start=None, length=None):
+        return self.request('territory', start, length)
+
+    def get_profile(self):
+        return self.request('profile')
+
+    def set_profiling(self, enabled):
+        return self.request('set_profiling', enabled)
+
+def start_arenas(config, socketio):
+    """
+    Start a process for every arena in the server config and return the
+    arenas by name
+    """
+    arenas = {name: Arena(name, arena_config, socketio) for name, arena_config in arena_configs(config).items()}
+    # start_server calls this before the server starts any threads, and
+    # every arena is forked before the relay threads are started
+    for arena in arenas.values():
+        arena.process.start()
+    for arena in arenas.values():
+        arena.start_relay()
+    return arenas
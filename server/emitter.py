@@ -0,0 +1,165 @@
+from collections import deque
+import threading
+import time
+import traceback
+
+def merge_rows(pending, rows):
+    """
+    Merge score rows into pending ones, a player's latest row wins
+    """
+    merged = {row[0]: row for row in pending}
+    merged.update((row[0], row) for row in rows)
+    return list(merged.values())
+
+# how a batch's event is combined with the same event of the batch before it
+# when batches are coalesced. Events that aren't listed are all kept, in order
+MERGE_EVENTS = {
+    'core_state': lambda pending, data: pending + data,
+    'kill_thread': lambda pending, data: pending + data,
+    # clients replace their threads with each update_thread
+    'update_thread': lambda pending, data: data,
+    'score_updates': merge_rows,
+    'tick': lambda pending, data: data,
+}
+
+class EventBatch(object):
+    """
+    The events emitted during a tick, in order
+    """
+    def __init__(self):
+        self.created = None
+        self.entries = []
+        # entries of the events in MERGE_EVENTS by (event, room)
+        self.mergeable = {}
+
+    def add(self, event, data, room):
+        """
+        Add an event, merging it into the batch's pending event of the same
+        kind if there is one. Returns whether it was merged
+        """
+        key = (event, room)
+        if event == 'core_connection':
+            # a full core supersedes every core update before it
+            self.entries = [entry for entry in self.entries if entry[0] not in ('core_state', 'core_connection') \
+                or entry[2] != room]
+            self.mergeable.pop(('core_state', room), None)
+        if key in self.mergeable:
+            entry = self.mergeable[key]
+            entry[1] = MERGE_EVENTS[event](entry[1], data)
+            return True
+        entry = [event, data, room]
+        self.entries.append(entry)
+        if event in MERGE_EVENTS:
+            self.mergeable[key] = entry
+        return False
+
+    def core_update_size(self, room):
+        """
+        Return how many bytes of core updates the batch holds for room
+        """
+        entry = self.mergeable.get(('core_state', room))
+        return sum(len(data) for start, data in entry[1]) if entry else 0
+
+class BatchEmitter(object):
+    """
+    Emits the engine's events from a thread of its own, so that a slow
+    broadcast never holds up the simulation. Events are collected into one
+    batch per tick and handed over through a queue of at most max_pending
+    batches. When the queue is full the newest batches are coalesced: core
+    updates and thread kills are concatenated, thread and score updates
+    supersede the ones before them, and once the coalesced core updates
+    outgrow snapshot_bytes they are replaced by a full core from snapshot().
+    encode, if given, is called with each event as it is sent and returns the
+    (event, data, room) messages to send in its place. A batch that fails to
+    encode or send is dropped from there on, counted in errors, and the next
+    one is emitted as usual
+    """
+    def __init__(self, socketio, max_pending=8, snapshot=None, snapshot_bytes=None, encode=None):
+        self.socketio = socketio
+        self.encode = encode
+        self.max_pending = max_pending
+        self.snapshot = snapshot
+        self.snapshot_bytes = snapshot_bytes
+        self.batch = EventBatch()
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.batches = 0
+        self.emitted = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.snapshots = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="emitter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event, data, room='player'):
+        """
+        Add an event to the current batch, it is sent once the batch is flushed
+        """
+        self.batch.add(event, data, room)
+
+    def flush(self):
+        """
+        Queue the current batch for the emitter thread. Never blocks, when the
+        queue is full the batch is coalesced into the newest queued one
+        """
+        batch, self.batch = self.batch, EventBatch()
+        if not batch.entries:
+            return
+        batch.created = time.monotonic()
+        self.batches += 1
+        with self.condition:
+            if len(self.pending) < self.max_pending:
+                self.pending.append(batch)
+                self.max_depth = max(self.max_depth, len(self.pending))
+                self.condition.notify()
+                return
+            # the queued batch keeps its own creation time, so lag is measured
+            # from the oldest of the events it holds
+            newest = self.pending[-1]
+            for event, data, room in batch.entries:
+                self.superseded += newest.add(event, data, room)
+            self.coalesced += 1
+            if self.snapshot and self.snapshot_bytes is not None:
+                for room in {entry[2] for entry in newest.entries if entry[0] == 'core_state'}:
+                    if newest.core_update_size(room) > self.snapshot_bytes:
+                        newest.add('core_connection', bytes(self.snapshot()), room)
+                        self.snapshots += 1
+
+    def run(self):
+        """
+        Emit queued batches in order, forever
+        """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch = self.pending.popleft()
+            try:
+                for entry in batch.entries:
+                    for event, data, room in (self.encode(*entry) if self.encode else [entry]):
+                        self.socketio.emit(event, data, room=room)
+                        self.emitted += 1
+            except Exception:
+                # a dead emitter thread would silently cut every client off
+                self.errors += 1
+                print("Dropped the rest of a batch of events that failed to emit:")
+                traceback.print_exc()
+            self.last_lag = time.monotonic() - batch.created
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def stats(self):
+        """
+        Return the queue depth, coalescing, error and lag counters
+        """
+        return {'depth': len(self.pending), 'max_depth': self.max_depth, 'max_pending': self.max_pending,
+                'batches': self.batches, 'emitted': self.emitted, 'coalesced': self.coalesced,
+                'superseded': self.superseded, 'snapshots': self.snapshots,
+                'errors': self.errors, 'last_lag': self.last_lag, 'max_lag': self.max_lag}
@@ -1,9 +1,14 @@
+import corewar.compiled
 import corewar.core
 import corewar.mars
 import corewar.players
+import corewar.scoreboard
+import corewar.vector
+import emitter
+import protocol
+from collections import deque
 import random
 import time
-import copy
 
 class Engine(object):
     """Game engine
@@ -14,10 +19,18 @@ class Engine(object):
     def __init__(self, socketio=None, seconds_per_tick=10,
                  staging_file='staging.json', ticks_per_stage=1,
                  core_size=8192, load_interval=200,
-                 players=[{'name': 'User0', 'token': 'token1'}], max_processes=10, max_staging_size=50, batch_events=True):
-        self.__socketio = socketio
+                 players=[{'name': 'User0', 'token': 'token1'}], max_processes=10, max_staging_size=50, batch_events=True,
+                 core_page_size=64, core_backing_file=None, core_shared_memory_name=None, simulator='mars',
+                 profiling=False, score_mode='steps', max_pending_batches=8, max_core_deltas=256,
+                 history_file='history.txt'):
+        # events are emitted from a thread of their own, see emitter.py
+        self.emitter = emitter.BatchEmitter(socketio, max_pending=max_pending_batches, \
+            snapshot=self.get_core_bytes, snapshot_bytes=core_size // 2, encode=self.encode_event)
+        # how many players the clients' palette holds, see update_scoreboard
+        self.palette_size = 0
         self.seconds_per_tick = seconds_per_tick
         self.staging_file = staging_file
+        self.history_file = history_file
         self.ticks_per_stage = ticks_per_stage
         self.load_interval = load_interval
         self.players = {}
@@ -25,7 +38,14 @@ class Engine(object):
         self.max_staging_size = max_staging_size
         self.used_colors = []
         self.batch_events= batch_events
-        self.core_event_cache = []
+        if score_mode not in ('steps', 'territory'):
+            raise Exception("Unknown score mode %s, expected 'steps' or 'territory'" % score_mode)
+        self.score_mode = score_mode
+        # scores in rank order, only the rows that change are emitted each
+        # tick. The full leaderboard for newly connected clients is cached
+        # until a score changes
+        self.scoreboard = corewar.scoreboard.Scoreboard()
+        self.leaderboard = None
         self.update_thread_event_cache = []
         self.kill_thread_event_cache = []
         for i in range(len(players)):
@@ -33,16 +53,37 @@ class Engine(object):
         for idx, player in enumerate(players):
             self.players[idx] = corewar.players.Player(player['name'], idx, player['token'], color=self.used_colors[idx])
 
-        self.mars = corewar.mars.MARS(corewar.core.Core(size=core_size, \
-            core_event_recorder=self.core_event_handler), players=self.players, \
+        if simulator == 'vector':
+            mars_class = corewar.vector.VectorMARS
+        elif simulator == 'compiled':
+            mars_class = corewar.compiled.CompiledMARS
+        elif simulator == 'mars':
+            mars_class = corewar.mars.MARS
+        else:
+            raise Exception("Unknown simulator %s, expected 'mars', 'compiled' or 'vector'" % simulator)
+        self.mars = mars_class(corewar.core.Core(size=core_size, \
+            core_event_recorder=None if batch_events else self.core_event_handler, page_size=core_page_size, \
+            backing_file=core_backing_file, shared_memory_name=core_shared_memory_name), players=self.players, \
             max_processes=max_processes, seconds_per_tick=self.seconds_per_tick, \
             runtime_event_handler=self.runtime_event_handler, update_thread_event_handler=self.update_thread_event_handler, \
-            kill_thread_event_handler=self.kill_thread_event_handler, ticket_event_handler=self.tick_event_handler)
+            kill_thread_event_handler=self.kill_thread_event_handler)
         
-        if batch_events:
-            self.cached_core_bytes = copy.deepcopy(self.mars.core.bytes)
-        else:
-            self.cached_core_bytes = self.mars.core.bytes
+        self.mars.pacer.overrun_handler = self.tick_overrun_handler
+        if profiling:
+            self.mars.enable_profiling()
+
+        # the last tick published to clients, see end_tick. The core, the
+        # scores and the tick events all report this count
+        self.tick_count = self.mars.tick_count
+        # when events are batched, readers are served the core as of the end
+        # of the last published tick rather than the live core to avoid
+        # desyncronization. The changes between the last max_core_deltas
+        # snapshots are kept as (from tick, to tick, segments) for clients
+        # catching up, see get_core_delta. The first snapshot is from before
+        # the first tick
+        self.core_snapshot = None
+        self.core_deltas = deque(maxlen=max_core_deltas)
+        self.publish_core_snapshot()
   
     # TODO: these color functions should really be broken out 
     # code for color generation taken from https://gist.github.com/adewes/5884820 
@@ -77,52 +118,206 @@ class Engine(object):
         self.used_colors.append(new_color)
         return True
     
-    def emit_core_update(self, events: list[list[int]]):
+    def emit_core_update(self, events: list[tuple[int, bytes]]):
         if events:
-            self.__socketio.emit('core_state', events, room='player')
+            self.emitter.emit('core_state', [[start, bytes(data)] for start, data in events])
     
-    def emit_thread_update(self, events: list[tuple[int, int, list[str]]]):
+    def emit_thread_update(self, events: list[tuple[int, int, int]]):
         if events:
-            self.__socketio.emit('update_thread', events, room='player')
+            self.emitter.emit('update_thread', events)
     
     def emit_thread_kill(self, events: list[int]):
-        self.__socketio.emit('kill_thread', events, room='player')
+        if events:
+            self.emitter.emit('kill_thread', events)
         
-    def core_event_handler(self, events: list[list[int]]):
-        if self.batch_events:
-            self.core_event_cache += events
-        else:
-            self.emit_core_update(events)
+    def core_event_handler(self, events: list[tuple[int, bytes]]):
+        # only called when events aren't batched, batched core updates are
+        # worked out from the core snapshots instead
+        self.emit_core_update(events)
+        self.emitter.flush()
         
-    def update_thread_event_handler(self, pid, pc, color):
+    def update_thread_event_handler(self, pid, pc, color, owner):
+        # threads are sent with their owner, whose color is looked up when the
+        # update is encoded for clients
         if self.batch_events:
-            self.update_thread_event_cache.append((pid, pc, self.float_to_hex_colors(color)))
+            self.update_thread_event_cache.append((pid, pc, owner))
         else:
-            self.emit_thread_update([(pid, pc, self.float_to_hex_colors(color))])
+            self.emit_thread_update([(pid, pc, owner)])
+            self.emitter.flush()
         
     def kill_thread_event_handler(self, events):
         if self.batch_events:
             self.kill_thread_event_cache.append(events)
         else:
             self.emit_thread_kill(events)
+            self.emitter.flush()
 
-    def tick_event_handler(self):
+    def end_tick(self):
+        """
+        Publish the tick the simulator just finished. Its core snapshot,
+        thread events, scores and tick count go out as one batch, stamped
+        with the same tick that /state and the leaderboard report from then on
+        """
+        self.tick_count = self.mars.tick_count
         if self.batch_events:
-            # when events are batched, the /state endpoint must return a snapshot of the core rather than the live core to avoid desyncronization
-            self.cached_core_bytes = copy.deepcopy(self.mars.core.bytes)
-
-            self.emit_core_update(self.core_event_cache)
+            # a tick's core update is the difference between the snapshots
+            # taken before and after it, so every byte is sent once with its
+            # final value and bytes that were written back unchanged not at all
+            self.emit_core_update(self.publish_core_snapshot())
             self.emit_thread_kill(self.kill_thread_event_cache)
             self.emit_thread_update(self.update_thread_event_cache)
-            self.core_event_cache = []
             self.kill_thread_event_cache = []
             self.update_thread_event_cache = []
+        self.update_scoreboard()
+        self.emitter.flush()
         
+    def publish_core_snapshot(self):
+        """
+        Replace the published core snapshot with one for the published tick.
+        Only chunks written since the last snapshot are copied and readers
+        pick up the new snapshot through a single reference assignment.
+        Returns the changes since the last snapshot as (start, bytes) segments
+        """
+        previous = self.core_snapshot
+        dirty_pages = self.mars.core.take_dirty_pages()
+        snapshot = corewar.core.CoreSnapshot.capture(self.mars.core, self.tick_count, previous, dirty_pages)
+        if previous is None:
+            changes = []
+        else:
+            changes = snapshot.changes_since(previous, dirty_pages, self.mars.core.page_size)
+            # the delta goes in before the snapshot is published, so that it
+            # is there for anyone who sees the new snapshot
+            self.core_deltas.append((previous.tick, snapshot.tick, changes))
+        self.core_snapshot = snapshot
+        return changes
+
+    def get_core_delta(self, since=None):
+        """
+        Return the tick of the core as seen by clients and what changed in it
+        since the core of tick since, as (tick, changes, None) with changes
+        as (start, bytes) segments. When since is missing, is older than the
+        kept deltas or isn't a tick the core was published at, the whole
+        core is returned as (tick, None, core bytes) instead. Without batched
+        events clients see the live core, which has no tick, so the whole
+        core is always returned with a tick of None
+        """
+        snapshot = self.core_snapshot
+        if not self.batch_events:
+            return None, None, bytes(self.mars.core.bytes)
+        if since == snapshot.tick:
+            return snapshot.tick, [], None
+        deltas = [delta for delta in list(self.core_deltas) if delta[1] <= snapshot.tick]
+        if since is None or not deltas or not deltas[0][0] <= since < snapshot.tick \
+                or since not in {delta[0] for delta in deltas}:
+            return snapshot.tick, None, snapshot.tobytes()
+
+        # every byte's latest value, in address order
+        changed = {}
+        for first, last, changes in deltas:
+            if first >= since:
+                for start, data in changes:
+                    changed.update(zip(range(start, start + len(data)), data))
+        segments = []
+        for address in sorted(changed):
+            if segments and segments[-1][0] + len(segments[-1][1]) == address:
+                segments[-1][1].append(changed[address])
+            else:
+                segments.append((address, bytearray((changed[address],))))
+        return snapshot.tick, [(start, bytes(data)) for start, data in segments], None
+
+    def get_core_bytes(self):
+        """
+        Return the core as seen by clients, which is the published snapshot
+        when events are batched and the live core otherwise
+        """
+        if self.batch_events:
+            return self.core_snapshot.tobytes()
+        return bytes(self.mars.core.bytes)
+
+    def player_score(self, player_id):
+        """
+        Return the player's score, the steps its threads have taken or, when
+        scoring by territory, how many bytes of the core it owns
+        """
+        if self.score_mode == 'territory':
+            return self.mars.core.territory(player_id)
+        return self.players[player_id].score
+
+    def score_row(self, rank, player_id, score):
+        player = self.players[player_id]
+        return [player_id, player.name, score, rank, self.float_to_hex_colors(player.color)]
+
+    def get_palette(self):
+        """
+        Return every player's id and color, which binary clients look the
+        owners of thread updates up in
+        """
+        return [[player_id, self.float_to_hex_colors(player.color)] for player_id, player in list(self.players.items())]
+
+    def encode_event(self, event, data, room):
+        """
+        Return the messages to send for an event, the core and thread events
+        go to the clients of each protocol in their encoding, see protocol.py
+        """
+        if event not in protocol.ENCODED_EVENTS or room != 'player':
+            return [(event, data, room)]
+        colors = dict(self.get_palette()) if event == 'update_thread' else None
+        return [(event, protocol.encode_json(event, data, colors), protocol.protocol_room('json')), \
+            (event, protocol.encode_binary(event, data), protocol.protocol_room('binary'))]
+
+    def update_scoreboard(self):
+        """
+        Update the scoreboard with the players' current scores and emit the
+        rows of the players whose rank or score changed, followed by the tick
+        count. The palette is sent again whenever players joined
+        """
+        if len(self.players) != self.palette_size:
+            self.palette_size = len(self.players)
+            self.emitter.emit('palette', self.get_palette())
+        for player_id in self.players:
+            self.scoreboard.update(player_id, self.player_score(player_id))
+        changes = self.scoreboard.take_changes()
+        if changes:
+            self.leaderboard = None
+            self.emitter.emit('score_updates', [self.score_row(*change) for change in changes])
+        self.emitter.emit('tick', self.tick_count)
+
+    def get_leaderboard(self):
+        """
+        Return the tick count and every player's score row from the highest
+        score down, for newly connected clients
+        """
+        leaderboard = self.leaderboard
+        if leaderboard is None:
+            leaderboard = self.leaderboard = [self.score_row(*row) for row in self.scoreboard.leaderboard()]
+        return self.tick_count, leaderboard
+
+    def get_territory(self, start=None, length=None):
+        """
+        Return how many bytes each player owns and how many nobody does, and
+        the owners of length bytes from start if a range is given
+        """
+        core = self.mars.core
+        territory = {'players': {player_id: core.territory(player_id) for player_id in self.players}, \
+            'unowned': core.territory(-1)}
+        if start is not None:
+            territory['owners'] = sorted(core.owners_in_range(start, length))
+        return territory
+
+    def get_stats(self):
+        """
+        Return the tick pacing and event emission counters
+        """
+        return {'tick': self.mars.tick_count, 'pacing': self.mars.pacer.stats(), 'emitter': self.emitter.stats()}
+
+    def tick_overrun_handler(self, overrun, seconds_per_tick):
+        print("Tick %s overran its %ss budget by %.3fs" % (self.mars.tick_count, seconds_per_tick, overrun))
+
     def runtime_event_handler(self, events):
-        self.__socketio.emit('events', "Cycle number: %s\n%s\n\n%s" % (self.mars.tick_count, events, time.ctime(time.time())), room='player')
+        self.emitter.emit('events', "Cycle number: %s\n%s\n\n%s" % (self.mars.tick_count, events, time.ctime(time.time())))
 
     def save_payload_to_disk(self, payload):
-        with open("history.txt", "a+") as w:
+        with open(self.history_file, "a+") as w:
             w.write("%s (%s): [%s]\n" % (self.players[payload[0]], self.mars.tick_count, ":::".join(payload[1])))
 
     def load_staged_program(self, player_id):
@@ -145,10 +340,12 @@ class Engine(object):
         load_idx = random.randint(0, self.mars.core.size//self.load_interval) * self.load_interval
 
         self.mars.core[load_idx] = assembled_instructions
+        self.mars.core.set_owner_range(load_idx, len(assembled_instructions), player_id)
+        self.mars.core.flush_events()
         new_thread = corewar.players.Thread(pc=load_idx, owner=player_id)
         self.mars.spawn_new_thread(new_thread)
         
-        if len(self.mars.players[player_id].threads) > self.mars.max_processes:
+        if self.mars.thread_count(player_id) > self.mars.max_processes:
             self.mars.kill_oldest_thread(player_id)
         
         self.runtime_event_handler("Loading new thread for %s at pc %i: \n$ %s" % \
@@ -161,9 +358,10 @@ class Engine(object):
         """
         Main game loop
         Start loading staged data after 1 round
-        Do 1 tick then sleep for the amount of seconds
-        specified in the seconds_per_tick variable
+        Do 1 tick, which is paced to last seconds_per_tick
+        seconds including the time spent in this loop
         """
+        self.emitter.start()
         while True:
             # if its a staging round, stage a program from a player sequentially
             if self.mars.tick_count % self.ticks_per_stage == 0:
@@ -172,12 +370,6 @@ class Engine(object):
                     self.load_staged_program(target_player)
 
             self.mars.tick()
-            current_scores = []
-            for player in self.players:
-                current_scores.append(["%s: %s" % (str(self.players[player]), self.players[player].score), \
-                    self.float_to_hex_colors(self.players[player].color)])
-            # Shitty hack to show the current tick count
-            current_scores.append(["Current tick count: %s" % self.mars.tick_count, "#FFFFFF"])
-            self.__socketio.emit('player_scores', (current_scores, 'player'))
+            self.end_tick()
             for thread in self.mars.thread_pool: print(thread)
             print("\n==========================\n")
\ No newline at end of file
@@ -0,0 +1,59 @@
+from array import array
+import sys
+
+# the core and thread events are sent to clients in the protocol they picked
+# when they connected, either JSON arrays or packed little endian binary
+PROTOCOLS = ('json', 'binary')
+ENCODED_EVENTS = ('core_connection', 'core_state', 'update_thread', 'kill_thread')
+
+U32 = 'I' if array('I').itemsize == 4 else 'L'
+
+def protocol_room(protocol):
+    """
+    Name of the room for the clients that picked protocol, the encoded events
+    are sent there instead of to the 'player' room
+    """
+    return 'core-%s' % protocol
+
+def packed(typecode, values):
+    """
+    Pack values as a little endian array of typecode
+    """
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+def encode_json(event, data, colors):
+    """
+    Encode an event's data as JSON friendly lists. Threads are sent with the
+    color of the player they belong to, colors maps player ids to colors
+    """
+    if event == 'core_connection':
+        return list(data)
+    if event == 'core_state':
+        return [[start, list(values)] for start, values in data]
+    if event == 'update_thread':
+        return [[thread_id, pc, colors.get(owner)] for thread_id, pc, owner in data]
+    return list(data)
+
+def encode_binary(event, data):
+    """
+    Encode an event's data as a binary attachment, laid out as arrays that
+    line up with the typed arrays clients decode them with:
+    core_connection: the core's bytes
+    core_state: u32 count, count u32 starts, count u32 lengths, then the
+        segments' bytes back to back
+    update_thread: u32 count, count u32 thread ids, count u32 pcs, then count
+        u16 player ids, to be looked up in the palette for their color
+    kill_thread: u32 thread ids
+    """
+    if event == 'core_connection':
+        return bytes(data)
+    if event == 'core_state':
+        return b''.join([packed(U32, [len(data)]), packed(U32, [start for start, values in data]), \
+            packed(U32, [len(values) for start, values in data])] + [bytes(values) for start, values in data])
+    if event == 'update_thread':
+        return b''.join([packed(U32, [len(data)]), packed(U32, [update[0] for update in data]), \
+            packed(U32, [update[1] for update in data]), packed('H', [update[2] for update in data])])
+    return packed(U32, data)
@@ -1,8 +1,9 @@
 from flask import Flask, abort, jsonify, request
-from flask_socketio import SocketIO, emit, disconnect, join_room
+from flask_socketio import SocketIO, emit, join_room
 from functools import wraps
+import arenas as server_arenas
+import protocol as server_protocol
 import corewar.yeetcode
-import engine
 import json
 import os
 import threading
@@ -24,10 +25,34 @@ def load_env_vars():
     if staging_file:
         env_vars['staging_file'] = staging_file
 
+    history_file = os.getenv('YEET_HISTORY_FILE')
+    if history_file:
+        env_vars['history_file'] = history_file
+
     core_size = os.getenv('YEET_CORE_SIZE')
     if core_size:
         env_vars['core_size'] = int(core_size)
     
+    core_backing_file = os.getenv('YEET_CORE_FILE')
+    if core_backing_file:
+        env_vars['core_backing_file'] = core_backing_file
+
+    simulator = os.getenv('YEET_SIMULATOR')
+    if simulator:
+        env_vars['simulator'] = simulator
+
+    arena_names = os.getenv('YEET_ARENAS')
+    if arena_names:
+        env_vars['arenas'] = [name.strip() for name in arena_names.split(',') if name.strip()]
+
+    profiling = os.getenv('YEET_PROFILING')
+    if profiling:
+        env_vars['profiling'] = profiling.lower() in ('1', 'true', 'yes')
+
+    score_mode = os.getenv('YEET_SCORE_MODE')
+    if score_mode:
+        env_vars['score_mode'] = score_mode
+
     max_processes = os.getenv('YEET_MAX_PROCESSES')
     if max_processes:
         env_vars['config_file'] = max_processes
@@ -85,49 +110,168 @@ def player_authorize(f):
         return f(player, *args, **kwargs)
     return decorated_function
     
-e = engine.Engine(socketio=socketio, **config)
-if not os.path.isfile(e.staging_file):
-    with open(e.staging_file, 'w') as w:
-        w.write('{}')
-engine_thread = threading.Thread(target=e.run)
-engine_thread.daemon = True
-engine_thread.start()
+# every arena runs its own engine in its own process, see arenas.py. They are
+# started by start_server
+arenas = {}
+arena_names = list(server_arenas.arena_configs(config))
+arenas_lock = threading.Lock()
+
+def start_server():
+    """
+    Start the arenas unless they are running already and return the app.
+    Every entry point calls this before serving: running this file does and
+    WSGI servers load the app as server:start_server(). Requests never start
+    the arenas, they are forked before the server starts any threads
+    """
+    with arenas_lock:
+        if not arenas:
+            arenas.update(server_arenas.start_arenas(config, socketio))
+    return app
+
+def find_arena(name=None):
+    """
+    Return the arena called name, the first arena if name is None, or None
+    if there is no such arena
+    """
+    return arenas.get(arena_names[0] if name is None else name)
+
+def all_arenas():
+    """
+    Return every arena
+    """
+    return list(arenas.values())
+
+def requested_arena():
+    """
+    Return the arena named by the request's arena argument, in the query
+    string or the posted JSON, or the first arena if none is named
+    """
+    name = request.args.get('arena')
+    if name is None:
+        name = (request.get_json(silent=True) or {}).get('arena')
+    arena = find_arena(name)
+    if arena is None:
+        abort(404)
+    return arena
+
+@app.route('/arenas')
+@player_authorize
+def get_arenas(player):
+    """
+    GET /arenas
+    Returns the names of the arenas hosted by the server, the first one is
+    used by requests that don't name an arena
+    """
+    return jsonify(arena_names)
 
 @app.route('/state')
 @player_authorize
-def get_state():
+def get_state(player):
     """
-    GET /state
-    Returns the current bytearray of the yeetcode game core
+    GET /state?arena=<name>&since=<tick>
+    Returns the current bytearray of the arena's yeetcode game core. With
+    since, returns {"tick": <tick>, "changes": [[<start>, [<bytes>]], ...]}
+    holding only the bytes that changed since that tick instead, or
+    {"tick": <tick>, "core": [<bytes>]} when the tick is too old.
+    The tick is the response's ETag, requests whose If-None-Match is the
+    current tick get an empty 304 response. If-None-Match: * names no tick,
+    so it is answered like a request without it
     """
-    return jsonify(list(e.cached_core_bytes))
+    tick, changes, core = requested_arena().get_core_delta(request.args.get('since', type=int))
+    etag = str(tick)
+    if tick is not None and not request.if_none_match.star_tag and etag in request.if_none_match:
+        response = app.response_class(status=304)
+    elif 'since' not in request.args:
+        response = jsonify(list(core))
+    elif changes is None:
+        response = jsonify({'tick': tick, 'core': list(core)})
+    else:
+        response = jsonify({'tick': tick, 'changes': [[start, list(data)] for start, data in changes]})
+    if tick is not None:
+        response.set_etag(etag)
+    return response
 
 @app.route('/set_tickrate', methods=['POST'])
 @admin_authorize
 def seconds_per_tick():
     """
     POST /set_tickrate
-    updates the tick rate of the server
+    updates the tick rate of the arena named by "arena", or of every arena,
+    starting with the tick in progress
     Example:
     $ curl \
         -H 'content-type: application/json' \
         -H 'Authorization: Bearer admintokenyeet' \
-        -d '{"time": <number>}' \
+        -d '{"time": <number>, "arena": <name>}' \
         -XPOST localhost:5000/set_tickrate
     {'status': 'success'}
     """
     if not request.json:
         return jsonify({'status': 'error', 'message': 'no data posted'})
 
-    e.mars.seconds_per_tick = float(request.json['time'])
+    targets = [requested_arena()] if 'arena' in request.json else all_arenas()
+    for arena in targets:
+        arena.set_tickrate(float(request.json['time']))
     return jsonify({'status': 'success'})
 
+@app.route('/stats')
+@admin_authorize
+def stats():
+    """
+    GET /stats?arena=<name>
+    Returns the arena's tick count, how far its ticks overran their budget,
+    and how far its event emitter is behind: the depth of its queue of event
+    batches, how many were coalesced and how long the last one waited
+    """
+    return jsonify(requested_arena().get_stats())
+
+@app.route('/territory')
+@admin_authorize
+def territory():
+    """
+    GET /territory?arena=<name>&start=<address>&length=<bytes>
+    Returns how many bytes of the arena's core each player owns and how many
+    are unowned, plus the owners of the given range, -1 for nobody, if start
+    and length are given
+    """
+    arena = requested_arena()
+    if 'start' in request.args:
+        return jsonify(arena.get_territory(int(request.args['start']), int(request.args.get('length', 1))))
+    return jsonify(arena.get_territory())
+
+@app.route('/profile', methods=['GET', 'POST'])
+@admin_authorize
+def profile():
+    """
+    GET /profile?arena=<name>
+    Returns the arena's execution counters, by opcode, addressing modes,
+    player and address, and its crashes, or null when profiling is off
+    POST /profile
+    turns profiling of the arena named by "arena", or of every arena, on or
+    off. Turning it off returns the final counters
+    Example:
+    $ curl \
+        -H 'content-type: application/json' \
+        -H 'Authorization: Bearer admintokenyeet' \
+        -d '{"enabled": true, "arena": <name>}' \
+        -XPOST localhost:5000/profile
+    {'status': 'success', 'profiles': {<name>: null}}
+    """
+    if request.method == 'GET':
+        return jsonify(requested_arena().get_profile())
+    if not request.json or 'enabled' not in request.json:
+        return jsonify({'status': 'error', 'message': 'no data posted'})
+
+    targets = [requested_arena()] if 'arena' in request.json else all_arenas()
+    profiles = {arena.name: arena.set_profiling(bool(request.json['enabled'])) for arena in targets}
+    return jsonify({'status': 'success', 'profiles': profiles})
+
 @app.route('/add_player', methods=['POST'])
 @admin_authorize
 def add_player():
     """
     POST /add_player
-    Adds a player to the game
+    Adds a player to every arena
     Example:
     $ curl \
         -H 'content-type: application/json' \
@@ -149,8 +293,9 @@ def add_player():
         return jsonify({'status': 'error', 'message': 'token already in use'})
 
     app.config['PLAYER_TOKENS'][player_token] = {'name': player_name, 'id': len(app.config['PLAYER_TOKENS'])}
-    error = not e.add_player(player_name, app.config['PLAYER_TOKENS'][player_token]['id'], player_token)
-    print(e.players)
+    error = False
+    for arena in all_arenas():
+        error |= not arena.add_player(player_name, app.config['PLAYER_TOKENS'][player_token]['id'], player_token)
     if error:
         return jsonify({'status': 'error', 'message': 'failed to add player to engine'})
     
@@ -162,12 +307,13 @@ def stage_program(player):
     """
     POST /stage
     Expects a POST with JSON containing a player ID
-    and the yeetcode assembly instructions to stage for that player
+    and the yeetcode assembly instructions to stage for that player,
+    optionally in the arena named by "arena"
     Example:
     $ curl \
         -H 'content-type: application/json' \
         -H 'Authorization: Bearer token1' \
-        -d '{"instructions": "YEET #0, #4"}' \
+        -d '{"instructions": "YEET #0, #4", "arena": "default"}' \
         -XPOST localhost:5000/stage
     {"status":"success"} 
     """
@@ -178,25 +324,45 @@ def stage_program(player):
 
     player_id = player['id']
     instructions = str(request.json['instructions']).split('\n')
-    if len(instructions) > e.max_staging_size:
-        instructions = instructions[:e.max_staging_size]
-    e.staged_payloads[player_id] = [player_id, instructions]
+    # the arena cuts the instructions down to its max_staging_size
+    requested_arena().stage(player_id, instructions)
     return jsonify({'status': 'success'})
   
 @socketio.on('connect')
 def connected_client():
   token = request.args.get('token')
+  # raising here wouldn't reject the connection, returning False does
+  arena = find_arena(request.args.get('arena'))
+  if arena is None:
+    return False
+  # the core and thread events are sent as JSON unless the client asks for
+  # the binary protocol, see protocol.py
+  protocol = request.args.get('protocol', 'json')
+  if protocol not in server_protocol.PROTOCOLS:
+    return False
   if token in app.config['PLAYER_TOKENS']:
-    join_room('player')
+    join_room(server_arenas.arena_room(arena.name, 'player'))
   elif token == app.config['ADMIN_TOKEN']:
-    join_room('admin')
-    join_room('player')
+    join_room(server_arenas.arena_room(arena.name, 'admin'))
+    join_room(server_arenas.arena_room(arena.name, 'player'))
   else:
-    disconnect()
+    return False
+
+  join_room(server_arenas.arena_room(arena.name, server_protocol.protocol_room(protocol)))
 
-  emit('core_connection', list(e.cached_core_bytes), room='player')
-  emit('event_connection', "Events feed loaded", room='player')
+  # only the new client needs the whole core, everyone else is kept up to
+  # date by core_state
+  emit('palette', arena.get_palette())
+  core = arena.get_core_bytes()
+  emit('core_connection', core if protocol == 'binary' else list(core))
+  emit('event_connection', "Events feed loaded", room=server_arenas.arena_room(arena.name, 'player'))
+  # only the new client needs the whole scoreboard, everyone else is kept up
+  # to date by each tick's score_updates
+  tick, leaderboard = arena.get_leaderboard()
+  emit('player_scores', leaderboard)
+  emit('tick', tick)
 
 
 if __name__ == '__main__':
+  start_server()
   socketio.run(app, host='0.0.0.0', debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
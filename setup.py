@@ -156,6 +156,9 @@ setup(
     #    'dev': ['check-manifest'],
     #    'test': ['coverage'],
     #},
+    extras_require={
+        'vector': ['numpy'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.
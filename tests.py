@@ -3,7 +3,7 @@
 
 import unittest
 
-from tests.run_match import InstructionTests
+from tests.run_match import InstructionTests, CoreTests, TournamentTests, ServerTests
 
 if __name__=='__main__':
     unittest.main()
\ No newline at end of file
@@ -3,8 +3,14 @@ from corewar.core import *
 from corewar.players import *
 from corewar.yeetcode import *
 from struct import pack, unpack
-from random import randint
-import unittest
+from random import randint, seed, Random
+import corewar.compiled, corewar.scoreboard, corewar.tournament, corewar.vector
+import importlib, io, json, multiprocessing, os, struct, sys, tempfile, threading, time, unittest
+
+# the server's modules import each other by name, as they do when it runs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+import emitter, engine, protocol
+import arenas as server_arenas
 
 class InstructionTests(unittest.TestCase):
     def test_modifiers(self):
@@ -32,6 +38,25 @@ class InstructionTests(unittest.TestCase):
         runtime.step()
         self.assertEqual(runtime.core[80:84], b'YEET')
 
+    def test_self_modifying(self):
+        mem = Core()
+        runtime = MARS(mem, players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = parse(['YEET #12, #4'])[0].mcode
+        runtime.core[4] = parse(['NOPE'])[0].mcode
+        runtime.core[8] = parse(['BOUNCE $4'])[0].mcode
+        runtime.core[12] = parse(['YEET $7, %XD'])[0].mcode
+        runtime.spawn_new_thread(Thread(4, 0, 0, 0))
+        runtime.step() # NOPE
+        runtime.step() # BOUNCE $4
+        runtime.step() # NOPE, decoded from the cache
+        self.assertEqual(runtime.decode_cache_stats()['hits'], 1)
+        runtime.thread_pool = [Thread(0, 0, 0, 0)]
+        runtime.step() # overwrites the cached NOPE at 4
+        runtime.thread_pool = [Thread(4, 0, 0, 0)]
+        runtime.step()
+        self.assertEqual(runtime.next_tick_pool[-1].xd, 7)
+        self.assertEqual(runtime.decode_cache_stats()['misses'], 4)
+
     def test_yeetcode_assembler(self):
         mem = Core()
         runtime = MARS(mem, players={0: Player("Test", 0, "Token")})
@@ -174,6 +199,50 @@ class InstructionTests(unittest.TestCase):
         self.assertEqual(len(runtime.thread_pool), 1)
         self.assertEqual(len(runtime.next_tick_pool), 4)
  
+    def test_kill_thread(self):
+        runtime = MARS(players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = parse(['NOPE'])[0].mcode * 10
+        for pc in range(0, 20, 4):
+            runtime.spawn_new_thread(Thread(pc, 0, 0, 0))
+        runtime.step()
+        runtime.kill_oldest_thread(0)
+        runtime.kill_thread(2)
+        self.assertEqual([thread.id for thread in runtime.thread_pool], [1, 3, 4])
+        self.assertEqual(list(runtime.players[0].threads), [1, 3, 4])
+        self.assertEqual(runtime.thread_count(0), 3)
+        self.assertEqual(len(runtime.next_tick_pool), 0)
+        self.assertEqual(runtime.thread_pool[-1].id, 4)
+        runtime.step()
+        runtime.step()
+        runtime.kill_thread(1)
+        self.assertEqual(len(runtime.thread_pool), 1)
+        runtime.step()
+        self.assertEqual(len(runtime.thread_pool), 0)
+        self.assertEqual([thread.id for thread in runtime.next_tick_pool], [3, 4])
+        self.assertRaises(Exception, runtime.kill_thread, 1)
+
+    def test_thread_reuse(self):
+        runtime = MARS(players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = parse(['NOPE'])[0].mcode * 10
+        template = Thread(0, 7, b"teey", 0)
+        for pc in range(0, 12, 4):
+            runtime.spawn_new_thread(template)
+        self.assertNotIn(template, list(runtime.thread_pool))
+        self.assertEqual(template.id, -1)
+        killed = runtime.thread_pool[1]
+        runtime.kill_thread(killed.id)
+        self.assertEqual(runtime.free_threads, [killed])
+        # the killed thread is recycled while its stale entry is still queued
+        runtime.spawn_thread_from_parent(40, runtime.thread_pool[0])
+        self.assertEqual(runtime.free_threads, [])
+        self.assertIs(runtime.next_tick_pool[0], killed)
+        self.assertEqual((killed.pc, killed.id, killed.xd, killed.dx_bytes), (40, 3, 7, b"teey"))
+        self.assertEqual([thread.id for thread in runtime.thread_pool], [0, 2])
+        runtime.step()
+        runtime.step()
+        self.assertEqual([thread.id for thread in runtime.next_tick_pool], [3, 0, 2])
+        self.assertEqual(sorted(runtime.players[0].threads), [0, 2, 3])
+
     def test_syscall(self):
         runtime = MARS(players={0 : Player("yeet", 0, "Token1"), 1 : Player("rando", 1, "Token2"), 69 : Player("teey", 69, "Token3")})
         instrs = parse(['YEETCALL'])
@@ -195,6 +264,8 @@ class InstructionTests(unittest.TestCase):
         runtime.step()
         self.assertEqual(runtime.next_tick_pool[-1].pc, 4)
         self.assertEqual(runtime.next_tick_pool[-1].owner, 69)
+        self.assertEqual(list(runtime.players[69].threads), [2])
+        self.assertEqual(list(runtime.players[0].threads), [0, 1, 3])
         runtime.step()
         self.assertEqual(runtime.next_tick_pool[-1].pc, 4)
         self.assertEqual(runtime.next_tick_pool[-1].dx, 4)
@@ -230,6 +301,24 @@ class InstructionTests(unittest.TestCase):
         self.assertEqual(runtime.next_tick_pool[-1].pc, 4)
         self.assertEqual(runtime.next_tick_pool[-1].dx, 0)
 
+    def test_locate_wraparound(self):
+        runtime = MARS(players={0 : Player("yeet", 0, "Token1"), 1 : Player("rando", 1, "Token2")})
+        runtime.core[0] = parse(['YEETCALL'])[0].mcode
+        runtime.core[7988] = parse(['YEETCALL'])[0].mcode
+        runtime.spawn_new_thread(Thread(7988, LOCATE_NEAREST_THREAD, 0, 0))
+        runtime.spawn_new_thread(Thread(0, LOCATE_NEAREST_THREAD, 0, 1))
+        runtime.spawn_new_thread(Thread(7700, LOCATE_NEAREST_THREAD, 0, 1))
+        runtime.step()
+        self.assertEqual(runtime.next_tick_pool[-1].dx, 0)
+        runtime.step()
+        self.assertEqual(runtime.next_tick_pool[-1].dx, 7992)
+
+        locator = runtime.thread_locator
+        self.assertEqual(len(locator), 3)
+        self.assertEqual(sorted(t.pc for t in locator.in_range(100, 150)), [4, 7992])
+        self.assertEqual(sorted(t.pc for t in locator.in_range(100, 150, exclude_owner=0)), [4])
+        self.assertEqual(locator.nearest(7800, 256).pc, 7700)
+
     def test_xchg(self):
         mem = Core()
         runtime = MARS(mem, players={0: Player("Test", 0, "Token")})
@@ -275,7 +364,736 @@ class InstructionTests(unittest.TestCase):
         print("Test completed in %s cycles, %s threads remained" % (cycle_count, live_threads))
         for thread in runtime.thread_pool: print(thread, disassemble(runtime.core[thread.pc:thread.pc + 4]))
         for thread in runtime.next_tick_pool: print(thread, disassemble(runtime.core[thread.pc:thread.pc + 4]))
+
+    def test_tick_pacing(self):
+        runtime = MARS(players={0: Player("Test", 0, "Token")}, seconds_per_tick=0.02)
+        runtime.core[0] = parse(['NOPE'])[0].mcode * 10
+        runtime.spawn_new_thread(Thread(0, 0, 0, 0))
+        started = time.monotonic()
+        for i in range(5):
+            runtime.tick()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(runtime.pacer.stats()['ticks'], 5)
+
+        # a tick over budget is reported instead of slept
+        overruns = []
+        runtime.pacer.overrun_handler = lambda overrun, budget: overruns.append((overrun, budget))
+        runtime.tick_event_handler = lambda: time.sleep(0.05)
+        runtime.tick()
+        self.assertEqual(len(overruns), 1)
+        self.assertGreater(overruns[0][0], 0)
+        self.assertEqual(overruns[0][1], 0.02)
+        self.assertEqual(runtime.pacer.overruns, 1)
+
+        # changing the tick rate moves the deadline of the tick in progress
+        runtime.tick_event_handler = lambda: None
+        runtime.seconds_per_tick = 10
+        threading.Timer(0.05, setattr, (runtime, 'seconds_per_tick', 0.01)).start()
+        started = time.monotonic()
+        runtime.tick()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(runtime.tick_count, 7)
+
+    def test_headless_run(self):
+        runtime = MARS(players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = parse(['NOPE'])[0].mcode * 10
+        for pc in range(0, 12, 4):
+            runtime.spawn_new_thread(Thread(pc, 0, 0, 0))
+        result = runtime.run(ticks=5)
+        self.assertEqual((result['ticks'], result['steps']), (5, 15))
+        self.assertEqual(result['scores'], {0: 15})
+        self.assertEqual(result['threads'], {0: 3})
+        self.assertEqual(runtime.run(max_steps=4)['ticks'], 1)
+        self.assertEqual(len(runtime.thread_pool), 2)
+
+        # a tick that is resumed is only announced once
+        ticks = []
+        runtime.tick_event_handler = lambda: ticks.append(runtime.tick_count)
+        runtime.run(max_steps=1)
+        runtime.run(max_steps=1)
+        self.assertEqual(runtime.tick_count, 7)
+        runtime.run(max_steps=4)
+        runtime.tick()
+        self.assertEqual(ticks, [6, 7, 8])
+        self.assertEqual(runtime.tick_count, 9)
+
+        # headless and observed runs must simulate exactly the same thing
+        initial_core = bytes(randint(0, 255) for i in range(runtime.core.size))
+        runtimes = []
+        events = []
+        for handlers in ({}, {'update_thread_event_handler': lambda *args: events.append(args)}):
+            players = {i: Player("rando%d" % i, i, "Token%d" % i) for i in range(3)}
+            runtime = MARS(players=players, **handlers)
+            runtime.core[0] = initial_core
+            for i in range(0, runtime.core.size, 7):
+                runtime.spawn_new_thread(Thread(i, i, i * 3, i % 3))
+            result = runtime.run(ticks=50, max_steps=20000)
+            runtimes.append((bytes(runtime.core.bytes), result['scores'], result['threads'], result['steps']))
+        self.assertEqual(runtimes[0], runtimes[1])
+        self.assertTrue(events)
+
+    def assertSimulatesLikeMARS(self, mars_class):
+        # other engines must simulate exactly what MARS does, events included
+        for case in range(6):
+            generator = Random(case)
+            size = generator.choice([401, 4000])
+            initial_core = b""
+            while len(initial_core) < size:
+                a_mode, b_mode = generator.randrange(4), generator.randrange(4)
+                a_number = generator.randrange(2) if a_mode >= REGISTER_DIRECT else generator.randrange(256)
+                b_number = generator.randrange(2) if b_mode >= REGISTER_DIRECT else generator.randrange(65536)
+                opcode = generator.choice([YEET, YOINK, KNIOY, MUL, DIV, FITS, BOUNCE, BOUNCEZ, BOUNCEN,
+                                           BOUNCED, ZOOP, YEB, NOPE, YEETCALL, 0])
+                initial_core += Instruction(opcode, a_mode, a_number, b_mode, b_number).mcode
+            results = []
+            for mars_type in (MARS, mars_class):
+                events = []
+                record = lambda *args: events.append(args)
+                handlers = {} if case % 2 else {'runtime_event_handler': record, 'update_thread_event_handler': record,
+                                                'kill_thread_event_handler': record}
+                runtime = mars_type(Core(size=size, core_event_recorder=record if handlers else None),
+                                        players={i: Player("rando%d" % i, i, "Token%d" % i) for i in range(3)}, **handlers)
+                runtime.core[0] = initial_core[:size]
+                runtime.core.flush_events()
+                threads = Random(case)
+                for pc in range(0, size, 3):
+                    runtime.spawn_new_thread(Thread(pc, threads.randrange(WORD_MAX), threads.randrange(size), pc % 3))
+                seed(case)
+                for i in range(20):
+                    runtime.tick()
+                results.append((bytes(runtime.core.bytes), list(runtime.core.owner), runtime.tick_count,
+                                [(t.id, t.pc, t.xd, t.dx, t.owner) for t in runtime.next_tick_pool],
+                                {i: player.score for i, player in runtime.players.items()}, events))
+            self.assertEqual(results[0], results[1])
+        return runtime
+
+    @unittest.skipIf(corewar.vector.np is None, "numpy is not installed")
+    def test_vector_engine(self):
+        runtime = self.assertSimulatesLikeMARS(corewar.vector.VectorMARS)
+        self.assertTrue(runtime.vector_steps and runtime.scalar_steps)
+
+        # a wave's writes only drop the decodes they overlap
+        runtime = corewar.vector.VectorMARS(players={0: Player("Test", 0, "Token")}, max_processes=0)
+        runtime.core[0] = b"".join(instr.mcode for instr in parse(['YEET #0, [XD', 'BOUNCE $0']))
+        for i in range(64):
+            runtime.spawn_new_thread(Thread(0, 4000 + 8 * i, 0, 0))
+        for address in (100, 3996, 3998, 4002, 4004):
+            runtime.decode(address)
+        runtime.tick()
+        self.assertEqual(runtime.core[4000:4012], runtime.core[0:4] + bytes(4) + runtime.core[0:4])
+        self.assertEqual(sorted(runtime.decode_cache), [100, 3996, 4004])
+
+    def test_compiled_engine(self):
+        runtime = self.assertSimulatesLikeMARS(corewar.compiled.CompiledMARS)
+        self.assertTrue(runtime.functions_compiled)
+
+        runtime = corewar.compiled.CompiledMARS(players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = b"".join(instr.mcode for instr in parse(['YOINK $1, %XD', 'NOPE', 'YEET #4, #7996', 'BOUNCE $0']))
+        runtime.spawn_new_thread(Thread(0, 0, 0, 0))
+        for i in range(4):
+            runtime.step()
+        self.assertEqual(runtime.decode_cache_stats()['compiled'], 4)
+        # the code rewrote its own second instruction
+        self.assertEqual(runtime.core[4:8], runtime.core[12:16])
+        self.assertNotIn(4, runtime.decode_cache)
+        runtime.step()
+        runtime.step()
+        self.assertEqual(runtime.next_tick_pool[0].pc, 0)
+        self.assertEqual(runtime.next_tick_pool[0].xd, 2)
+        # the copy shares the original's decode instead of being compiled again
+        self.assertIs(runtime.decode_cache[4], runtime.decode_cache[12])
+        self.assertEqual(runtime.decode_cache_stats()['instructions'], 4)
+
+        # copies of a bot anywhere in the core run the same functions
+        runtime = corewar.compiled.CompiledMARS(players={0: Player("Test", 0, "Token")})
+        code = b"".join(instr.mcode for instr in parse(['YOINK $1, %XD', 'YEET %XD, #12', 'BOUNCE #7992']))
+        for base in range(0, 4000, 400):
+            runtime.core[base] = code
+            runtime.spawn_new_thread(Thread(base, 0, 0, 0))
+        runtime.run(ticks=30)
+        self.assertEqual(runtime.functions_compiled, 3)
+        for base in range(0, 4000, 400):
+            self.assertEqual(runtime.core.read_u32(base + 16), 10)
+            self.assertEqual(runtime.core.owner[base + 16], 0)
+
+        # once full, the least recently used instruction makes room
+        runtime = corewar.compiled.CompiledMARS(players={0: Player("Test", 0, "Token")})
+        runtime.max_compiled_instructions = 2
+        runtime.core[0] = b"".join(instr.mcode for instr in parse(['NOPE', 'YOINK $1, %XD', 'YOINK $2, %XD']))
+        nope, first = bytes(runtime.core[0:4]), bytes(runtime.core[4:8])
+        runtime.decode(0)
+        runtime.decode(4)
+        runtime.core[100] = nope
+        runtime.decode(100)
+        runtime.decode(8)
+        self.assertEqual(list(runtime.compiled_instructions), [nope, bytes(runtime.core[8:12])])
+        self.assertNotIn(first, runtime.compiled_instructions)
+        self.assertEqual(runtime.functions_compiled, 3)
+
+    def test_profiling(self):
+        for mars_class in (MARS, corewar.compiled.CompiledMARS):
+            runtime = mars_class(players={0: Player("Test", 0, "Token"), 1: Player("Test2", 1, "Token2")})
+            runtime.core[0] = b"".join(instr.mcode for instr in parse(['NOPE', 'BOUNCE $0']))
+            runtime.core[100] = b"\x00\x00\x00\x00"
+            runtime.spawn_new_thread(Thread(0, owner=0))
+            runtime.spawn_new_thread(Thread(100, owner=1))
+            self.assertIsNone(runtime.profile_snapshot())
+            runtime.step()
+            unprofiled = runtime.decode_cache[0][0]
+            runtime.enable_profiling()
+            for i in range(6):
+                runtime.step()
+            profile = runtime.profile_snapshot()
+            self.assertEqual(profile['steps'], 6)
+            self.assertEqual(profile['opcodes'], {'BOUNCE': 3, 'NOPE': 2, 'INVALID(0)': 1})
+            self.assertEqual(profile['modes']['BOUNCE $, $'], 3)
+            self.assertEqual(profile['players'], {0: 5, 1: 1})
+            self.assertEqual(profile['crashes'], {'Invalid instruction': 1})
+            self.assertEqual(profile['hot_addresses'][:2], [(4, 3), (0, 2)])
+            self.assertEqual(runtime.disable_profiling()['steps'], 6)
+            self.assertIsNone(runtime.profile)
+            runtime.step()
+            if mars_class is MARS:
+                self.assertIs(runtime.decode_cache[0][0], unprofiled)
+
+        # snapshots are taken from the arena's request thread while the
+        # simulation keeps counting new addresses
+        runtime = MARS(Core(size=4 * 30000), players={0: Player("Test", 0, "Token")})
+        runtime.core[0] = parse(['YEET #0, #4'])[0].mcode
+        runtime.spawn_new_thread(Thread(0, owner=0))
+        runtime.enable_profiling()
+        simulation = threading.Thread(target=runtime.run, kwargs={'ticks': 30000})
+        simulation.start()
+        while simulation.is_alive():
+            runtime.profile_snapshot()
+        simulation.join()
+        self.assertEqual(runtime.profile_snapshot()['steps'], 30000)
+
+class CoreTests(unittest.TestCase):
+    def test_word_access(self):
+        mem = Core(size=64)
+        mem.write_u32(8, 0x41424344)
+        self.assertEqual(mem[8:12], b'ABCD')
+        self.assertEqual(mem.read_u32(8), 0x41424344)
+        self.assertEqual(mem.read_u8(9), 0x42)
+        self.assertEqual(bytes(mem.view(8, 4)), b'ABCD')
+
+        # words that cross the end of the core wrap around to the start
+        mem.write_u32(62, 0xdeadbeef)
+        self.assertEqual(mem[62:64], b'\xde\xad')
+        self.assertEqual(mem[0:2], b'\xbe\xef')
+        self.assertEqual(mem.read_u32(62), 0xdeadbeef)
+        self.assertEqual(mem.read_u32(62 + 64 * 3), 0xdeadbeef)
+        self.assertEqual(bytes(mem.view(62, 4)), b'\xde\xad\xbe\xef')
+
+        mem.write_u8(64 + 5, 0xff)
+        self.assertEqual(mem[5], 0xff)
+
+    def test_ownership(self):
+        mem = Core(size=64)
+        self.assertEqual(mem.owners_in_range(0, 64), {-1})
+        mem.set_owner_range(60, 8, 3)
+        self.assertEqual(list(mem.owner[60:]), [3, 3, 3, 3])
+        self.assertEqual(list(mem.owner[:5]), [3, 3, 3, 3, -1])
+        self.assertEqual(mem.owners_in_range(58, 4), {-1, 3})
+        self.assertEqual(mem.owners_in_range(62, 4), {3})
+
+        runtime = MARS(mem, players={0: Player("Test", 0, "Token"), 1: Player("Test", 1, "Token")})
+        runtime.core[16] = parse(['YEET #0, #8'])[0].mcode
+        runtime.spawn_new_thread(Thread(16, 0, 0, 1))
+        runtime.step()
+        self.assertEqual(list(mem.owner[24:29]), [1, 1, 1, 1, -1])
+
+    def test_territory(self):
+        mem = Core(size=100, owner_block_size=16)
+        self.assertEqual(mem.territory(-1), 100)
+        mem.set_owner_range(90, 20, 2)
+        mem.set_owner_range(8, 40, 1)
+        mem.set_owner(40, 3)
+        self.assertEqual((mem.territory(1), mem.territory(2), mem.territory(3), mem.territory(-1)), (39, 18, 1, 42))
+        self.assertEqual(sum(mem.block_owners[2].values()), 16)
+        self.assertEqual(mem.block_owners[6][2], 4)
+        self.assertEqual(mem.owners_in_range(16, 32), {1, 3})
+        self.assertEqual(mem.owners_in_range(48, 42), {-1})
+        self.assertEqual(mem.owners_in_range(95, 20), {1, 2})
+        self.assertEqual(mem.owners_in_range(0, 100), {-1, 1, 2, 3})
+
+        runtime = MARS(mem, players={0: Player("Test", 0, "Token"), 1: Player("Test", 1, "Token")})
+        runtime.core[60] = parse(['YEET #60, #48'])[0].mcode
+        thread = Thread(60, 0, 0, 0)
+        runtime.spawn_new_thread(thread)
+        runtime.step()
+        self.assertEqual(list(mem.owner[8:12]), [0, 0, 0, 0])
+        self.assertEqual(runtime.run(ticks=1)['territory'], {0: 4, 1: 35})
+
+    def test_write_events(self):
+        events = []
+        mem = Core(size=64, core_event_recorder=events.extend)
+        mem.write_u32(8, 0x41424344)
+        mem.write_u32(12, 0x45464748)
+        mem.write_u8(9, 0x5a)
+        self.assertEqual(events, [])
+        mem.flush_events()
+        self.assertEqual(events, [(8, b'AZCDEFGH')])
+
+        # a write that crosses the end of the core is split at the boundary
+        del events[:]
+        mem[62] = b'wxyz'
+        mem.flush_events()
+        self.assertEqual(events, [(62, b'wx'), (0, b'yz')])
+
+        runtime = MARS(mem, players={0: Player("Test", 0, "Token")})
+        runtime.core[16] = parse(['YEET #0, #4'])[0].mcode
+        mem.flush_events()
+        del events[:]
+        runtime.spawn_new_thread(Thread(16, 0, 0, 0))
+        runtime.step()
+        self.assertEqual(events, [(20, b'\x15\x00\x00\x04')])
+
+    def test_dirty_pages(self):
+        mem = Core(size=1000, page_size=64)
+        # a fresh core is entirely dirty
+        self.assertEqual(len(mem.take_dirty_pages()), 16)
+        self.assertEqual(mem.take_dirty_pages(), [])
+        mem.write_u32(62, 1)
+        mem.write_u8(130, 1)
+        mem[998] = b'abcd'
+        self.assertEqual(mem.take_dirty_pages(), [0, 1, 2, 15])
+        self.assertEqual(mem.take_dirty_pages(), [])
+        self.assertEqual(mem.page_bounds(15), (960, 1000))
+
+    def test_backing_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'core.bin')
+            mem = Core(size=256, backing_file=path)
+            runtime = MARS(mem, players={0: Player("Test", 0, "Token")})
+            runtime.core[0] = parse(['YEET #0, #4'])[0].mcode
+            runtime.spawn_new_thread(Thread(0, 0, 0, 0))
+            runtime.step()
+
+            reader = Core.attach(backing_file=path)
+            self.assertEqual(reader.size, 256)
+            self.assertEqual(reader[:8], b'\x15\x00\x00\x04\x15\x00\x00\x04')
+            mem.write_u32(252, 0x1337beef)
+            self.assertEqual(reader.read_u32(252), 0x1337beef)
+            self.assertRaises(TypeError, reader.write_u8, 0, 1)
+            # slices are the same type whatever backs the core
+            for core in (reader, mem, Core(size=256)):
+                self.assertIs(type(core[4:8]), bytearray)
+                self.assertIs(type(core[254:258]), bytearray)
+            reader.close()
+            mem.close()
+            with open(path, 'rb') as r:
+                self.assertEqual(r.read(4), b'\x15\x00\x00\x04')
+
+    def test_shared_memory(self):
+        name = 'yeet_test_%d' % os.getpid()
+        mem = Core(size=256, shared_memory_name=name)
+        try:
+            mem[254] = b'wxyz'
+            reader = Core.attach(shared_memory_name=name)
+            self.assertEqual(reader[254:258], b'wxyz')
+            self.assertEqual(reader.read_u32(254), unpack('>I', b'wxyz')[0])
+            self.assertIs(type(reader[0:4]), bytearray)
+            self.assertIs(type(mem[0:4]), bytearray)
+            reader.close()
+        finally:
+            mem.close()
+        # the segment outlives its writer until it is unlinked
+        reader = Core.attach(shared_memory_name=name)
+        self.assertEqual(reader[254:258], b'wxyz')
+        reader.unlink()
+        reader.close()
+        with self.assertRaises(FileNotFoundError):
+            Core.attach(shared_memory_name=name)
+
+        # even when the writer's process dies without closing it
+        def write_and_die():
+            mem = Core(size=64, shared_memory_name=name)
+            mem[0] = b'left behind'
+            os._exit(0)
+        context = multiprocessing.get_context('fork')
+        writer = context.Process(target=write_and_die)
+        writer.start()
+        writer.join()
+        reader = Core.attach(shared_memory_name=name)
+        try:
+            self.assertEqual(reader[0:11], b'left behind')
+        finally:
+            reader.unlink()
+            reader.close()
+
+    def test_snapshots(self):
+        mem = Core(size=1000, page_size=64)
+        mem.take_dirty_pages()
+        first = CoreSnapshot.capture(mem, tick=1, chunk_size=128)
+        self.assertEqual(first.chunk_size, 128)
+        mem.write_u32(130, 0x41424344)
+        second = CoreSnapshot.capture(mem, 2, first, mem.take_dirty_pages())
+        self.assertEqual(second.tick, 2)
+        self.assertEqual(first.tobytes(), bytes(1000))
+        self.assertEqual(second.tobytes(), bytes(mem.bytes))
+        self.assertEqual(len(second), 1000)
+        # only the chunk that was written to is copied
+        self.assertIsNot(second.chunks[1], first.chunks[1])
+        self.assertEqual([a is b for a, b in zip(first.chunks, second.chunks)].count(False), 1)
+
+        # a tick's changes hold the final value of every byte that changed
+        for value in range(5):
+            mem.write_u32(124, value)
+        mem[250] = b"\x01\x00\x02"
+        mem.write_u8(300, 9)
+        mem.write_u8(300, 0)
+        mem.write_u32(990, 0x01020304)
+        third = CoreSnapshot.capture(mem, 3, second, mem.take_dirty_pages())
+        self.assertEqual(third.changes_since(second, [1, 3, 4, 15], 64),
+                         [(127, b"\x04"), (250, b"\x01\x00\x02"), (990, b"\x01\x02\x03\x04")])
+        self.assertEqual(third.changes_since(second, [1], 64, gap=8), [(127, b"\x04")])
+        self.assertEqual(third.slice(120, 260), bytes(mem.bytes[120:260]))
+
+class TournamentTests(unittest.TestCase):
+    def test_tournament(self):
+        sources = {'imp': 'YEET $0, #4', 'idle': 'NOPE\nBOUNCE #65532', 'spawner': 'ZOOP #8\nBOUNCE #0\nNOPE\nBOUNCE #65532'}
+        with tempfile.TemporaryDirectory() as directory:
+            bots = []
+            for name, source in sorted(sources.items()):
+                path = os.path.join(directory, name + '.yeet')
+                with open(path, 'w') as w:
+                    w.write(source)
+                bots.append(corewar.tournament.load_bot(path))
+        self.assertEqual(bots[0].name, 'idle')
+        self.assertEqual(bots[0].program, assemble(['NOPE', 'BOUNCE #65532']))
+
+        results = corewar.tournament.run_tournament(bots, games=2, ticks=200, core_size=4000, workers=0)
+        self.assertEqual(results['stats']['matches'], 6)
+        self.assertEqual(sum(row['points'] for row in results['scoreboard']), 6)
+        self.assertEqual(results['scoreboard'][0]['name'], 'spawner')
+        self.assertEqual(results['scoreboard'][-1]['name'], 'imp')
+        self.assertEqual(results['stats']['steps'], sum(row['score'] for row in results['scoreboard']))
+        # matches are seeded, wherever they are played
+        pooled = corewar.tournament.run_tournament(bots, games=2, ticks=200, core_size=4000, workers=2)
+        self.assertEqual(pooled['scoreboard'], results['scoreboard'])
+
+        swiss = corewar.tournament.run_tournament(bots, mode='swiss', rounds=3, ticks=50, workers=0)
+        self.assertEqual(swiss['stats']['matches'], 3)
+        self.assertEqual(sorted(row['byes'] for row in swiss['scoreboard']), [1, 1, 1])
+        self.assertEqual(len({frozenset(match['bots']) for match in swiss['matches']}), 3)
+
+        territory = corewar.tournament.run_tournament(bots, ticks=200, core_size=4000, workers=0, score='territory')
+        self.assertEqual(territory['scoreboard'][0]['name'], 'spawner')
+        self.assertEqual(territory['scoreboard'][0]['score'], sum(match['territory'][match['bots'].index('spawner')] \
+            for match in territory['matches'] if 'spawner' in match['bots']))
+
+        output = io.StringIO()
+        corewar.tournament.write_scoreboard(results, output, 'csv')
+        self.assertEqual(output.getvalue().splitlines()[0], ','.join(corewar.tournament.SCOREBOARD_FIELDS))
+        self.assertEqual(len(output.getvalue().splitlines()), 4)
  
+    def test_scoreboard(self):
+        scoreboard = corewar.scoreboard.Scoreboard()
+        for player_id, score in enumerate([5, 9, 5, 0]):
+            scoreboard.update(player_id, score)
+        self.assertEqual(scoreboard.leaderboard(), [(1, 1, 9), (2, 0, 5), (2, 2, 5), (4, 3, 0)])
+        self.assertEqual(len(scoreboard.take_changes()), 4)
+        self.assertFalse(scoreboard.update(1, 9))
+        self.assertEqual(scoreboard.take_changes(), [])
+        scoreboard.update(3, 12)
+        scoreboard.update(2, 6)
+        # players 1 and 0 only moved down, but their ranks are sent again too
+        self.assertEqual(scoreboard.take_changes(), [(1, 3, 12), (2, 1, 9), (3, 2, 6), (4, 0, 5)])
+        scoreboard.update(0, 7)
+        self.assertEqual(scoreboard.take_changes(), [(3, 0, 7), (4, 2, 6)])
+        self.assertEqual([scoreboard.rank(player_id) for player_id in range(4)], [3, 2, 4, 1])
+        scoreboard.remove(1)
+        self.assertEqual(scoreboard.leaderboard(2), [(1, 3, 12), (2, 0, 7)])
+        self.assertEqual(scoreboard.take_changes(), [(2, 0, 7), (3, 2, 6)])
+        self.assertEqual(scoreboard.rank(2), 3)
+        self.assertNotIn(1, scoreboard)
+        # clients applying only the changes always end up with the full board
+        rows = {row[1]: row for row in scoreboard.leaderboard()}
+        rng = Random(21)
+        for step in range(500):
+            player_id = rng.randrange(12)
+            if player_id in scoreboard and rng.random() < 0.1:
+                scoreboard.remove(player_id)
+                rows.pop(player_id)
+            else:
+                scoreboard.update(player_id, rng.randrange(8))
+            rows.update((row[1], row) for row in scoreboard.take_changes())
+            self.assertEqual(sorted(rows.values()), scoreboard.leaderboard())
+
+class RecordingSocketIO(object):
+    """Stands in for the socketio server, recording what is emitted"""
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+class ServerTests(unittest.TestCase):
+    def import_server(self):
+        """Imports the web server with a config of its own"""
+        if 'server' not in sys.modules:
+            config = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+            json.dump({'admin_token': 'admintoken', 'players': [{'name': 'Test', 'token': 'token1'}]}, config)
+            config.close()
+            os.environ['YEET_CONFIG_FILE'] = config.name
+            try:
+                importlib.import_module('server')
+            finally:
+                del os.environ['YEET_CONFIG_FILE']
+                os.unlink(config.name)
+        return sys.modules['server']
+
+    def test_event_batches(self):
+        batch = emitter.EventBatch()
+        self.assertFalse(batch.add('core_state', [[0, b'ab']], 'player'))
+        self.assertFalse(batch.add('events', 'first', 'admin'))
+        self.assertFalse(batch.add('update_thread', [(1, 0, 0)], 'player'))
+        self.assertFalse(batch.add('score_updates', [[0, 'a', 1], [1, 'b', 2]], 'player'))
+        self.assertTrue(batch.add('core_state', [[8, b'c']], 'player'))
+        self.assertFalse(batch.add('core_state', [[4, b'd']], 'admin'))
+        self.assertFalse(batch.add('events', 'second', 'admin'))
+        self.assertTrue(batch.add('update_thread', [(2, 4, 1)], 'player'))
+        self.assertTrue(batch.add('score_updates', [[1, 'b', 5]], 'player'))
+        # merged events keep the place of the first of them, the others are
+        # all kept in order
+        self.assertEqual(batch.entries, [
+            ['core_state', [[0, b'ab'], [8, b'c']], 'player'],
+            ['events', 'first', 'admin'],
+            ['update_thread', [(2, 4, 1)], 'player'],
+            ['score_updates', [[0, 'a', 1], [1, 'b', 5]], 'player'],
+            ['core_state', [[4, b'd']], 'admin'],
+            ['events', 'second', 'admin']])
+        self.assertEqual(batch.core_update_size('player'), 3)
+
+        # a full core drops the room's core updates before it, and those after
+        # it go after it
+        batch.add('core_connection', b'core', 'player')
+        batch.add('core_state', [[1, b'e']], 'player')
+        self.assertEqual([entry[0] for entry in batch.entries if entry[2] == 'player'], \
+            ['update_thread', 'score_updates', 'core_connection', 'core_state'])
+        self.assertEqual(batch.core_update_size('player'), 1)
+        self.assertEqual(batch.core_update_size('admin'), 1)
+
+    def test_batch_emitter(self):
+        socketio = RecordingSocketIO()
+        core = bytearray(b'0123')
+        batches = emitter.BatchEmitter(socketio, max_pending=2, snapshot=lambda: core, snapshot_bytes=3)
+        for tick in range(2):
+            batches.emit('core_state', [[tick, b'x']])
+            batches.emit('tick', tick)
+            batches.flush()
+        # the queue is full, the next batches are coalesced into the newest
+        batches.emit('core_state', [[2, b'yy']])
+        batches.emit('update_thread', [(0, 4, 0)])
+        batches.emit('tick', 2)
+        batches.flush()
+        self.assertEqual(batches.pending[-1].entries, [['core_state', [[1, b'x'], [2, b'yy']], 'player'], \
+            ['tick', 2, 'player'], ['update_thread', [(0, 4, 0)], 'player']])
+        self.assertEqual((batches.coalesced, batches.superseded, batches.snapshots), (1, 2, 0))
+        # once the coalesced core updates outgrow snapshot_bytes they are
+        # replaced by the whole core, and later updates go after it
+        core[2:4] = b'yz'
+        batches.emit('core_state', [[3, b'z']])
+        batches.emit('tick', 3)
+        batches.flush()
+        self.assertEqual(batches.snapshots, 1)
+        batches.emit('core_state', [[0, b'w']])
+        batches.flush()
+        self.assertEqual(batches.pending[-1].entries, [['tick', 3, 'player'], \
+            ['update_thread', [(0, 4, 0)], 'player'], ['core_connection', b'01yz', 'player'], \
+            ['core_state', [[0, b'w']], 'player']])
+        batches.flush()
+        self.assertEqual(len(batches.pending), 2)
+
+        batches.start()
+        deadline = time.monotonic() + 5
+        while (batches.pending or batches.emitted < 6) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(socketio.emitted, [('core_state', [[0, b'x']], 'player'), ('tick', 0, 'player'), \
+            ('tick', 3, 'player'), ('update_thread', [(0, 4, 0)], 'player'), \
+            ('core_connection', b'01yz', 'player'), ('core_state', [[0, b'w']], 'player')])
+
+        # a batch that fails to send doesn't stop the ones after it
+        def encode(event, data, room):
+            if data == 'bad':
+                raise OverflowError('ushort format requires 0 <= number <= 65535')
+            return [(event, data, room)]
+        socketio = RecordingSocketIO()
+        batches = emitter.BatchEmitter(socketio, encode=encode)
+        batches.start()
+        for data in ('bad', 'good'):
+            batches.emit('tick', data)
+            batches.emit('score_updates', [])
+            batches.flush()
+        deadline = time.monotonic() + 5
+        while batches.emitted < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(socketio.emitted, [('tick', 'good', 'player'), ('score_updates', [], 'player')])
+        self.assertEqual(batches.stats()['errors'], 1)
+
+    def test_arena_configs(self):
+        configs = server_arenas.arena_configs({'admin_token': 'admintoken', 'core_size': 1024, 'staging_file': 'stage.json', \
+            'arenas': {'div1': {}, 'div2': {'core_size': 2048, 'history_file': 'div2.log'}}})
+        self.assertEqual(list(configs), ['div1', 'div2'])
+        self.assertEqual(configs['div1'], {'core_size': 1024, 'staging_file': 'stage-div1.json', \
+            'history_file': 'history-div1.txt'})
+        self.assertEqual(configs['div2'], {'core_size': 2048, 'staging_file': 'stage-div2.json', \
+            'history_file': 'div2.log'})
+        # a single arena keeps the files it is configured with
+        self.assertEqual(server_arenas.arena_configs({'admin_token': 'admintoken', 'staging_file': 'stage.json'}), \
+            {'default': {'staging_file': 'stage.json'}})
+        self.assertEqual(list(server_arenas.arena_configs({'arenas': ['a', 'b']})), ['a', 'b'])
+        for shared in ({'core_backing_file': 'core.bin'}, {'core_shared_memory_name': 'core'}, \
+                {'staging_file': 'stage.json'}, {'history_file': 'history.txt'}):
+            with self.assertRaises(Exception):
+                server_arenas.arena_configs({'arenas': {'div1': dict(shared), 'div2': dict(shared)}})
+        server_arenas.arena_configs({'core_backing_file': 'core.bin'})
+
+    def test_arena_process(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = server_arenas.arena_configs({'seconds_per_tick': 0.01, 'core_size': 512, \
+            'staging_file': os.path.join(directory.name, 'staging.json'), \
+            'history_file': os.path.join(directory.name, 'history.txt'), 'arenas': ['div1', 'div2']})['div2']
+        socketio = RecordingSocketIO()
+        arena = server_arenas.Arena('div2', config, socketio)
+        arena.process.start()
+        self.addCleanup(arena.process.terminate)
+        arena.start_relay()
+
+        # requests go down the pipe to the arena's engine and come back
+        self.assertEqual([player_id for player_id, color in arena.get_palette()], [0])
+        self.assertTrue(os.path.isfile(os.path.join(directory.name, 'staging-div2.json')))
+        self.assertTrue(arena.add_player('Test', 1, 'token1'))
+        self.assertFalse(arena.add_player('Test', 1, 'token1'))
+        self.assertTrue(arena.stage(1, ['YEET #0, #4']))
+        self.assertEqual(len(arena.get_core_bytes()), 512)
+        tick, changes, core = arena.get_core_delta()
+        self.assertIsNone(changes)
+        self.assertEqual(len(core), 512)
+        self.assertEqual(arena.get_core_delta(tick)[1], [])
+        # errors are raised in the web process
+        with self.assertRaises(Exception):
+            arena.request('nonsense')
+        self.assertIn('tick', arena.get_stats())
+
+        # and the engine's events are relayed to the arena's rooms
+        deadline = time.monotonic() + 5
+        while not any(event == 'tick' for event, data, room in socketio.emitted) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        rooms = {room for event, data, room in socketio.emitted}
+        self.assertIn('div2/player', rooms)
+        self.assertTrue(all(room.startswith('div2/') for room in rooms))
+
+    def test_socket_connect(self):
+        server = self.import_server()
+        e = engine.Engine(seconds_per_tick=0, core_size=64)
+        # the engine stands in for its arena, which answers the same calls
+        e.name = server.arena_names[0]
+        # requests don't start the arenas
+        self.assertIsNone(server.find_arena())
+        self.assertEqual(server.all_arenas(), [])
+        server.arenas[e.name] = e
+        self.addCleanup(server.arenas.clear)
+        # the arenas are only started once
+        self.assertIs(server.start_server(), server.app)
+        self.assertEqual(server.all_arenas(), [e])
+
+        for query_string in ('token=token1&arena=nowhere', 'token=token1&protocol=morse', 'token=nobody'):
+            client = server.socketio.test_client(server.app, query_string=query_string)
+            self.assertFalse(client.is_connected())
+        client = server.socketio.test_client(server.app, query_string='token=token1')
+        self.assertTrue(client.is_connected())
+        self.assertEqual([message['name'] for message in client.get_received()], \
+            ['palette', 'core_connection', 'event_connection', 'player_scores', 'tick'])
+        client.disconnect()
+
+    def test_binary_protocol(self):
+        def typed_array(data, offset, count, code):
+            """Decodes data like new <type>Array(data, offset, count) does in
+            Core.js, on a little endian machine"""
+            width = struct.calcsize(code)
+            self.assertEqual(offset % width, 0)
+            self.assertLessEqual(offset + count * width, len(data))
+            return list(struct.unpack_from('<%d%s' % (count, code), data, offset))
+
+        segments = [(0, b'\x01\x02\x03'), (70000, b'\xff'), (12, b'')]
+        data = protocol.encode_binary('core_state', segments)
+        count = typed_array(data, 0, 1, 'I')[0]
+        self.assertEqual(count, 3)
+        self.assertEqual(typed_array(data, 4, count, 'I'), [0, 70000, 12])
+        lengths = typed_array(data, 4 + 4 * count, count, 'I')
+        self.assertEqual(lengths, [3, 1, 0])
+        self.assertEqual(data[4 + 8 * count:], b'\x01\x02\x03\xff')
+
+        updates = [(1, 4, 0), (70000, 8188, 3), (2 ** 32 - 1, 0, 65535)]
+        data = protocol.encode_binary('update_thread', updates)
+        count = typed_array(data, 0, 1, 'I')[0]
+        self.assertEqual(count, 3)
+        self.assertEqual(len(data), 4 + 10 * count)
+        self.assertEqual(list(zip(typed_array(data, 4, count, 'I'), typed_array(data, 4 + 4 * count, count, 'I'), \
+            typed_array(data, 4 + 8 * count, count, 'H'))), updates)
+        # an odd number of updates still leaves the owners aligned
+        data = protocol.encode_binary('update_thread', updates[:1])
+        self.assertEqual(typed_array(data, 4 + 8, 1, 'H'), [0])
+
+        data = protocol.encode_binary('kill_thread', [5, 70000, 2 ** 32 - 1])
+        self.assertEqual(len(data) % 4, 0)
+        self.assertEqual(typed_array(data, 0, len(data) // 4, 'I'), [5, 70000, 2 ** 32 - 1])
+        self.assertEqual(protocol.encode_binary('kill_thread', []), b'')
+
+        self.assertEqual(protocol.encode_binary('core_connection', bytearray(b'core')), b'core')
+        self.assertEqual(protocol.encode_binary('core_state', []), b'\x00\x00\x00\x00')
+
+    def test_core_deltas(self):
+        e = engine.Engine(seconds_per_tick=0, core_size=256, core_page_size=16, max_core_deltas=4)
+        self.assertEqual(e.get_core_delta(), (0, None, bytes(256)))
+        for address, value in [(10, b'ab'), (11, b'xy'), (200, b'z'), (40, b'q'), (12, b'!')]:
+            e.mars.core[address] = value
+            e.mars.tick()
+            e.end_tick()
+        core = e.get_core_bytes()
+        self.assertEqual(core[10:13], b'ax!')
+        # the core, the scores and the tick events are stamped alike
+        self.assertEqual(e.get_leaderboard()[0], 5)
+        self.assertEqual([data for event, data, room in e.emitter.pending[-1].entries if event == 'tick'], [5])
+        self.assertEqual(e.get_core_delta(5), (5, [], None))
+        self.assertEqual(e.get_core_delta(3), (5, [(12, b'!'), (40, b'q')], None))
+        # later writes win where the ticks' changes overlap
+        self.assertEqual(e.get_core_delta(1), (5, [(11, b'x!'), (40, b'q'), (200, b'z')], None))
+        # the delta from tick 0 was evicted, as are ticks that never were
+        for since in (None, 0, 6, -1):
+            self.assertEqual(e.get_core_delta(since), (5, None, core))
+
+    def test_state_etag(self):
+        server = self.import_server()
+        e = engine.Engine(seconds_per_tick=0, core_size=64)
+        server.arenas[server.arena_names[0]] = e
+        self.addCleanup(server.arenas.clear)
+        client = server.app.test_client()
+        headers = {'Authorization': 'Bearer token1'}
+        e.mars.core[4] = b'hi'
+        e.mars.tick()
+        e.end_tick()
+
+        response = client.get('/state', headers=headers)
+        self.assertEqual(response.get_json(), list(e.get_core_bytes()))
+        self.assertEqual(response.headers['ETag'], '"1"')
+        response = client.get('/state?since=0', headers=headers)
+        self.assertEqual(response.get_json(), {'tick': 1, 'changes': [[4, list(b'hi')]]})
+        response = client.get('/state?since=0', headers=dict(headers, **{'If-None-Match': '"1"'}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = client.get('/state?since=0', headers=dict(headers, **{'If-None-Match': '"0"'}))
+        self.assertEqual(response.status_code, 200)
+        # * doesn't name the tick the client has
+        response = client.get('/state?since=0', headers=dict(headers, **{'If-None-Match': '*'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['tick'], 1)
+
 def run_tests():
     unittest.main()
     